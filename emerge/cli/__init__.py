@@ -98,12 +98,103 @@ def node():
 
 @node.command(name="start")
 @click.option("-p", "--port", default=5558, help="Listen port for server")
+@click.option(
+    "--cache-size", default=10000, help="Objects kept in each connection's cache"
+)
+@click.option(
+    "--cache-size-bytes",
+    default=0,
+    help="Estimated bytes kept in each connection's cache, 0 for no limit",
+)
+@click.option(
+    "-w", "--workers", default=1, help="Threads serving RPC calls concurrently"
+)
+@click.option(
+    "--remote-cache",
+    default=None,
+    type=int,
+    help="Bytes of other nodes' objects to cache, 64MB on the broker by default",
+)
+@click.option(
+    "--placement",
+    is_flag=True,
+    default=False,
+    help="Broker moves objects to their node on the hash ring when nodes join",
+)
+@click.option(
+    "--replicas", default=1, help="Nodes the broker keeps each object on when placing"
+)
+@click.option(
+    "--changes-keep",
+    default=100000,
+    help="Latest changes kept for consumers resuming from a sequence number",
+)
+@click.option(
+    "--broker",
+    default=None,
+    help="Broker host or host:port, the BROKER environment variable by default",
+)
+@click.option("--host", default=None, help="Host name other nodes call this node at")
+@click.option("--node-id", default=None, help="Node name, host:port by default")
+@click.option(
+    "--hello-port",
+    default=None,
+    type=int,
+    help="Port the broker hears from nodes on, one below its RPC port by default",
+)
+@click.option(
+    "--notify-port",
+    default=None,
+    type=int,
+    help="Port changes are published on, two below --port by default",
+)
 @click.pass_context
-def start(context, port):
-    """Start emerge node server"""
+def start(
+    context,
+    port,
+    cache_size,
+    cache_size_bytes,
+    workers,
+    remote_cache,
+    placement,
+    replicas,
+    changes_keep,
+    broker,
+    host,
+    node_id,
+    hello_port,
+    notify_port,
+):
+    """Start emerge node server
+
+    Nodes sharing a machine need RPC ports at least 3 apart, the ports a node binds
+    by default are counted down from its RPC port
+    """
     from emerge.node.server import NodeServer
 
-    node = NodeServer(port=port)
+    options = {
+        "cache_size": cache_size,
+        "cache_size_bytes": cache_size_bytes,
+        "workers": workers,
+        "placement": placement,
+        "replicas": replicas,
+        "changes_keep": changes_keep,
+    }
+
+    if remote_cache is not None:
+        options["remote_cache"] = remote_cache
+
+    for name, value in [
+        ("broker", broker),
+        ("host", host),
+        ("node", node_id),
+        ("hello_port", hello_port),
+        ("notify_port", notify_port),
+    ]:
+        if value is not None:
+            options[name] = value
+
+    node = NodeServer(port=port, options=options)
     node.setup()
     node.start()
 
@@ -302,22 +393,27 @@ def ls(context, long, directory):
         return
 
     logging.debug("FILES:%s", files)
-    files = reversed(sorted(files))
+    files = [
+        fname
+        for fname in reversed(sorted(files))
+        if fname != "dir:/" and fname != "dir:/registry"
+    ]
 
-    for fname in files:
-        if fname.find("dir") == 0:
-            if fname == "dir:/" or fname == "dir:/registry":
-                continue
+    # Stat the whole listing in pages of 1000 instead of one get per entry
+    paths = [fname.replace("dir:", "", 1) for fname in files]
+    stats = []
+    for i in range(0, len(paths), 1000):
+        stats += client.stat_many(paths[i : i + 1000])
 
+    for fname, file in zip(files, stats):
+        if fname.find("dir") == 0:
             fname = fname.replace("dir:", "")
-            logging.debug("Getting fname {}".format(fname))
 
-            file = client.get(fname)
             if "error" in file:
                 click.echo(file["message"])
                 return
 
-            logging.debug("client.get({}) = {}".format(fname, file))
+            logging.debug("client.stat_many({}) = {}".format(fname, file))
             row = "{} {: <8} {: >10} {} {} {}".format(
                 file["perms"],
                 human_readable_size(file["size"], 1)
@@ -334,7 +430,6 @@ def ls(context, long, directory):
             else:
                 print(fname.replace(directory, ""))
         else:
-            file = client.get(fname)
             if type(file) is list:
                 pass
             else:
@@ -0,0 +1,66 @@
+""" Run object methods in a pool of worker processes """
+import logging
+import os
+from itertools import repeat
+
+from emerge.core import serialize
+
+pool = None
+
+
+def get_pool():
+    """Return the shared process pool, started on first use"""
+    global pool
+
+    if pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Spawned workers don't inherit the node's database connections and threads
+        pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    return pool
+
+
+def call(payload, method):
+    """Call method on a serialized object
+
+    Returns (called, result, payload, fields) where payload and fields are the
+    object's new serialized state and field data, or None when the method left the
+    object unchanged.
+    """
+    obj = serialize.loads(payload)
+
+    if not hasattr(obj, method):
+        return False, None, None, None
+
+    _method = getattr(obj, method)
+
+    if getattr(_method, "readonly", False):
+        return True, _method(), None, None
+
+    before = serialize.state(obj)
+    result = _method()
+
+    if serialize.state(obj) == before:
+        return True, result, None, None
+
+    # The node raises the version of its file pointer to match
+    obj.version = (getattr(obj, "version", 0) or 0) + 1
+
+    # Written back in the format the object was stored with
+    payload = serialize.frames(serialize.dumps(obj, type(payload) is list))
+
+    return True, result, payload, serialize.fields(obj)
+
+
+def call_many(payloads, method):
+    """Call method on every payload in the pool, results keep the payloads order"""
+    chunksize = max(1, len(payloads) // ((os.cpu_count() or 1) * 4))
+
+    logging.info("parallel: %s objects in chunks of %s", len(payloads), chunksize)
+
+    return list(get_pool().map(call, payloads, repeat(method), chunksize=chunksize))
@@ -0,0 +1,266 @@
+""" An asyncio client that keeps many requests in flight on one socket """
+import asyncio
+import logging
+from uuid import uuid4
+
+import dill
+import zope
+
+from emerge.core import serialize
+from emerge.core.client import IClient, _pack, _unpack_files
+
+
+@zope.interface.implementer(IClient)
+class AsyncClient:
+    """Talks to a node with the zerorpc protocol over a zmq.asyncio DEALER socket
+
+    Every call opens its own zerorpc channel, so any number of them can be awaited
+    concurrently on the one connection.
+
+    fs = AsyncClient("localhost", "5558")
+    widgets = await fs.getobjects(["/inventory/widget", "/inventory/gadget"])
+    """
+
+    def __init__(self, host, port, oob=False, timeout=30, heartbeat=5):
+        self.address = "tcp://{}:{}".format(host, port)
+
+        # Send large buffers as pickle protocol 5 out-of-band frames
+        self.oob = oob
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+
+        self.socket = None
+        self.tasks = []
+        self.channels = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def _connect(self):
+        import zmq
+        import zmq.asyncio
+
+        if self.socket is not None:
+            return
+
+        self.socket = zmq.asyncio.Context.instance().socket(zmq.DEALER)
+        self.socket.connect(self.address)
+
+        self.tasks = [
+            asyncio.ensure_future(self._receive()),
+            asyncio.ensure_future(self._heartbeat()),
+        ]
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+
+        if self.socket is not None:
+            self.socket.close(linger=0)
+            self.socket = None
+
+        self.tasks = []
+
+    async def _send(self, name, args, channel=None):
+        import msgpack
+
+        header = {"message_id": uuid4().hex.encode(), "v": 3}
+        if channel is not None:
+            header["response_to"] = channel
+
+        await self.socket.send_multipart(
+            [b"", msgpack.packb((header, name, args), use_bin_type=True)]
+        )
+
+        return header["message_id"]
+
+    async def _receive(self):
+        """Hand the node's events to the channels awaiting them"""
+        import msgpack
+
+        while True:
+            frames = await self.socket.recv_multipart()
+            header, name, args = msgpack.unpackb(frames[-1], raw=False)
+
+            channel = self.channels.get(header.get("response_to"))
+            if channel is None:
+                logging.debug("AsyncClient: event %s for a closed channel", name)
+                continue
+
+            channel["seen"] = asyncio.get_running_loop().time()
+
+            if name != "_zpc_hb":
+                channel["events"].put_nowait((name, args))
+
+    async def _heartbeat(self):
+        """Keep the node's side of open channels alive and detect a lost node"""
+        while True:
+            await asyncio.sleep(self.heartbeat)
+
+            now = asyncio.get_running_loop().time()
+
+            for channel_id, channel in list(self.channels.items()):
+                # Like zerorpc, the node's heartbeats are only expected from here on
+                if channel["seen"] is None:
+                    channel["seen"] = now
+
+                if now - channel["seen"] > self.heartbeat * 2:
+                    channel["events"].put_nowait(("_zpc_lost", None))
+                    continue
+
+                await self._send("_zpc_hb", (0,), channel_id)
+
+    async def _open(self, method, args):
+        self._connect()
+
+        channel_id = await self._send(method, args)
+        channel = self.channels[channel_id] = {
+            "events": asyncio.Queue(),
+            "seen": None,
+        }
+
+        return channel_id, channel
+
+    async def _event(self, channel):
+        from zerorpc import LostRemote, RemoteError
+
+        name, args = await asyncio.wait_for(channel["events"].get(), self.timeout)
+
+        if name == "ERR":
+            raise RemoteError(*args)
+
+        if name == "_zpc_lost":
+            raise LostRemote(
+                "Lost remote after {}s heartbeat".format(self.heartbeat * 2)
+            )
+
+        return name, args
+
+    async def call(self, method, *args):
+        """Call a method of the node's API"""
+        channel_id, channel = await self._open(method, args)
+
+        try:
+            name, args = await self._event(channel)
+            return args[0]
+        finally:
+            del self.channels[channel_id]
+
+    async def stream(self, method, *args):
+        """Iterate the results of a streaming method of the node's API"""
+        channel_id, channel = await self._open(method, args)
+
+        # The node sends one event, then only as many as we have room for
+        window = 100
+        credit = 1
+
+        try:
+            while True:
+                name, args = await self._event(channel)
+                credit -= 1
+
+                if name == "STREAM_DONE":
+                    return
+
+                if credit < window // 2:
+                    await self._send("_zpc_more", (window - credit,), channel_id)
+                    credit = window
+
+                yield args
+        finally:
+            del self.channels[channel_id]
+
+    async def searchtext(self, field, query, limit=0, order=None):
+        return await self.call("searchtext", field, query, limit, order)
+
+    async def index(self):
+        return await self.call("index")
+
+    async def search(self, where, limit=0, order=None):
+        from emerge.core.query import Predicate
+
+        if isinstance(where, Predicate):
+            return await self.call("search", where.to_list(), limit, order)
+
+        return await self.call("search", dill.dumps(where), limit, order)
+
+    async def store(self, obj):
+        return await self.call("put", *_pack(obj, self.oob))
+
+    async def store_many(self, objs):
+        """Store a list of objects with one round trip and one commit"""
+        return await self.call("put_many", [_pack(obj, self.oob) for obj in objs])
+
+    async def list(self, path, offset=0, size=0):
+        return dill.loads(await self.call("list", path, False, offset, size))
+
+    async def listpage(self, path, cursor=None, size=1000):
+        """Return {"files": [...], "cursor": ...}, pass cursor back for the next page"""
+        return await self.call("listpage", path, cursor, size)
+
+    def iterdir(self, path, size=1000):
+        """Iterate the entries of a directory with async for"""
+        return self.stream("liststream", path, size)
+
+    async def getobject(self, path, nodill, offset=0, size=0):
+        file = await self.call("getobject", path, nodill)
+
+        if file is None or type(file) is dict:
+            return file
+
+        return serialize.loads(file)
+
+    async def getobjects(self, paths, nodill=False):
+        """Fetch many objects concurrently, in the order of paths"""
+        return await asyncio.gather(*[self.getobject(path, nodill) for path in paths])
+
+    async def hello(self, query):
+        return await self.call("hello", query)
+
+    async def graphql(self, query):
+        return await self.call("graphql", query)
+
+    async def mkdir(self, directory):
+        return await self.call("mkdir", directory)
+
+    async def rm(self, path):
+        return await self.call("rm", path)
+
+    async def query(self, path):
+        result = await self.call("query", path)
+        try:
+            return dill.loads(result)
+        except:
+            return result
+
+    async def register(self, entry):
+        return await self.call("register", entry)
+
+    async def register_many(self, entries):
+        return await self.call("register_many", entries)
+
+    async def get(self, oid, offset=0, size=0):
+        return _unpack_files(await self.call("get", oid))
+
+    async def stat_many(self, paths):
+        """Return the file attributes of many paths in one round trip"""
+        return await self.call("stat_many", paths)
+
+    async def stats(self):
+        """Return the node's connection pool and cache statistics"""
+        return await self.call("stats")
+
+    async def changes(self, since=0, size=1000):
+        """Return {"changes": [...], "seq": ...}, pass seq back as since for more"""
+        return await self.call("changes", since, size)
+
+    async def run(self, oid, method, data=None, parallel=False):
+        """Execute a method on an object, or on every object of a directory"""
+        return await self.call("execute", oid, method, parallel)
+
+    async def run_many(self, oids, method):
+        """Execute a method on many objects concurrently, in the order of oids"""
+        return await asyncio.gather(*[self.run(oid, method) for oid in oids])
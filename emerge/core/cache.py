@@ -0,0 +1,195 @@
+""" Client side object cache kept fresh by the node's change notifications """
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+TOPIC = "NODE CHANGED"
+
+
+class ObjectCache:
+    """A least recently used cache of decoded objects bounded by their size in bytes
+
+    Entries are keyed by path. A change published by the node drops the path and
+    anything below it, whatever version of the object was cached.
+    """
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.thread = None
+
+    def get(self, path):
+        """Return the cached object for path or None"""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return entry["obj"]
+
+    def token(self):
+        """Taken before fetching an object, see put()"""
+        return self.generation
+
+    def put(self, path, obj, size, token):
+        """Cache an object fetched after token was taken
+
+        The object is dropped if a change arrived while it was being fetched, it may
+        already be stale.
+        """
+        if size > self.maxbytes:
+            return
+
+        with self.lock:
+            if token != self.generation:
+                return
+
+            self._pop(path)
+
+            self.entries[path] = {"obj": obj, "size": size}
+            self.bytes += size
+
+            while self.bytes > self.maxbytes:
+                self._pop(next(iter(self.entries)))
+
+    def invalidate(self, path):
+        """Drop path and every path below it"""
+        with self.lock:
+            self.generation += 1
+
+            for _path in [
+                _path
+                for _path in self.entries
+                if _path == path or _path.startswith(path.rstrip("/") + "/")
+            ]:
+                self._pop(_path)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.bytes = 0
+
+    def _pop(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.bytes -= entry["size"]
+
+    def subscribe(self, host, port="5556"):
+        """Listen for the node's change notifications in the background"""
+        self.thread = threading.Thread(
+            target=self.listen, args=(host, port), daemon=True
+        )
+        self.thread.start()
+
+    def listen(self, host, port):
+        import zmq
+
+        context = zmq.Context()
+        socket = context.socket(zmq.SUB)
+        socket.connect("tcp://{}:{}".format(host, port))
+        socket.subscribe(TOPIC)
+
+        while True:
+            message = socket.recv_string()
+            try:
+                change = json.loads(message[len(TOPIC) + 1 :])
+            except ValueError as ex:
+                logging.error("cache: bad change notification %s %s", message, ex)
+                continue
+
+            logging.debug("cache: invalidate %s", change)
+            self.invalidate(change["path"])
+
+
+class RemoteCache:
+    """A least recently used cache of payloads fetched from other nodes
+
+    Entries are keyed by uuid and version, so a newer registration of an object is
+    never answered from the cache. Owners register an object again when a method
+    changes it, which drops it too. ttl bounds how long a change the broker never
+    heard about is served stale.
+    """
+
+    def __init__(self, maxbytes, ttl=60):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uuid, version):
+        """Return the cached payload or None"""
+        import time
+
+        with self.lock:
+            entry = self.entries.get((uuid, version))
+            if entry is None or entry["expires"] < time.monotonic():
+                self._pop((uuid, version))
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end((uuid, version))
+            self.hits += 1
+            return entry["payload"]
+
+    def put(self, uuid, version, payload):
+        import time
+
+        from emerge.core import serialize
+
+        size = serialize.size(payload)
+        if size > self.maxbytes:
+            return
+
+        with self.lock:
+            self._pop((uuid, version))
+
+            self.entries[(uuid, version)] = {
+                "payload": payload,
+                "size": size,
+                "expires": time.monotonic() + self.ttl,
+            }
+            self.versions.setdefault(uuid, set()).add(version)
+            self.bytes += size
+
+            while self.bytes > self.maxbytes:
+                self._pop(next(iter(self.entries)))
+
+    def invalidate(self, uuid):
+        """Drop every version of an object"""
+        with self.lock:
+            for version in list(self.versions.get(uuid, [])):
+                self._pop((uuid, version))
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        self.bytes -= entry["size"]
+
+        versions = self.versions[key[0]]
+        versions.discard(key[1])
+        if not versions:
+            del self.versions[key[0]]
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
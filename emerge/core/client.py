@@ -1,16 +1,19 @@
 import logging
-from functools import partial
+from contextlib import contextmanager
+from functools import lru_cache, partial
 
 import dill
 import zerorpc
 import zope
 
+from emerge.core import serialize
+
 ZERORPC_CLIENT = zerorpc.Client
 HTTP_CLIENT = ""
 
 
 class IClient(zope.interface.Interface):
-    def search(self, where):
+    def search(self, where, limit=0, order=None):
         raise NotImplementedError()
 
     def proxy(self, path):
@@ -19,15 +22,24 @@ class IClient(zope.interface.Interface):
     def index(self):
         raise NotImplementedError()
 
-    def searchtext(self, field, query):
+    def searchtext(self, field, query, limit=0, order=None):
         raise NotImplementedError()
 
     def store(self, obj):
         raise NotImplementedError()
 
+    def store_many(self, objs):
+        raise NotImplementedError()
+
     def list(self, path, offset=0, size=0):
         raise NotImplementedError()
 
+    def listpage(self, path, cursor=None, size=1000):
+        raise NotImplementedError()
+
+    def iterdir(self, path, size=1000):
+        raise NotImplementedError()
+
     def getobject(self, path, nodill, offset=0, size=0):
         raise NotImplementedError()
 
@@ -49,12 +61,99 @@ class IClient(zope.interface.Interface):
     def register(self, entry):
         raise NotImplementedError()
 
+    def register_many(self, entries):
+        raise NotImplementedError()
+
     def get(self, oid, offset=0, size=0):
         raise NotImplementedError()
 
-    def run(self, oid, method, data=None):
+    def stat_many(self, paths):
+        raise NotImplementedError()
+
+    def stats(self):
         raise NotImplementedError()
 
+    def changes(self, since=0, size=1000):
+        raise NotImplementedError()
+
+    def nodes(self):
+        raise NotImplementedError()
+
+    def run(self, oid, method, data=None, parallel=False):
+        raise NotImplementedError()
+
+
+@lru_cache(maxsize=None)
+def _class_source(cls):
+    import inspect
+
+    try:
+        return inspect.getsource(cls)
+    except:
+        return "No source available"
+
+
+def _pack(obj, oob=False):
+    """Return the metadata and payload the node stores an object as"""
+    from uuid import uuid4
+
+    # Ensure a uuid or use existing one
+    if obj.uuid is None or len(obj.uuid) == 0:
+        obj.uuid = str(uuid4())
+
+    meta = serialize.meta(obj, _class_source(type(obj)))
+
+    return [meta, serialize.dumps(obj, oob)]
+
+
+def _key(obj):
+    """The registry key an object is stored under"""
+    return obj.path.rstrip("/") + "/" + obj.name
+
+
+def _unpack_files(file):
+    """Decode the files returned by a node's get"""
+    _files = []
+    if type(file) is list:
+        for f in file:
+            _f = dill.loads(f)
+            if "obj" in _f:
+                _f["obj"] = dill.loads(_f["obj"])
+            _files += [_f]
+    else:
+        if "obj" in file:
+            file["obj"] = dill.loads(file["obj"])
+        _files = file
+
+    return _files
+
+
+class StoreBatch:
+    """Collects objects and ships them to a node in chunks"""
+
+    def __init__(self, client, size=1000):
+        self.client = client
+        self.size = size
+        self.pending = []
+        self.results = []
+
+    def store(self, obj):
+        self.pending += [obj]
+
+        if len(self.pending) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        pending, self.pending = self.pending, []
+        self.results += self.client.store_many(pending)
+
+    @property
+    def errors(self):
+        return [result for result in self.results if result["error"]]
+
 
 @zope.interface.implementer(IClient)
 class RESTClient:
@@ -68,20 +167,52 @@ class AppSyncDynamoDBClient:
 
 @zope.interface.implementer(IClient)
 class Z0RPCClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, oob=False, cache=0):
         # TODO: This is where the client implemenation should change
         self.client = ZERORPC_CLIENT()
         self.client.connect("tcp://{}:{}".format(host, port))
 
-    def searchtext(self, field, query):
-        return self.client.searchtext(field, query)
+        # Send large buffers as pickle protocol 5 out-of-band frames
+        self.oob = oob
+
+        # Cache up to cache bytes of objects, dropped when the node changes them
+        self.cache = None
+        if cache > 0:
+            from emerge.core.cache import ObjectCache
+
+            # The node publishes its changes two below its RPC port
+            self.cache = ObjectCache(cache)
+            self.cache.subscribe(host, int(port) - 2)
+
+    def close(self):
+        self.client.close()
+
+    def call(self, method, *args, timeout=None):
+        """Call a node method with arguments already in their wire format"""
+        if timeout is not None:
+            return getattr(self.client, method)(*args, timeout=timeout)
+
+        return getattr(self.client, method)(*args)
+
+    def searchtext(self, field, query, limit=0, order=None):
+        return self.client.searchtext(field, query, limit, order)
 
     def index(self):
         return self.client.index()
 
-    def search(self, where):
+    def search(self, where, limit=0, order=None):
+        """Return the fields of matching objects
+
+        order names the field to sort on, "-field" sorts descending
+        """
+        from emerge.core.query import Predicate
+
+        if isinstance(where, Predicate):
+            # Predicates are planned against the node's field indexes
+            return self.client.search(where.to_list(), limit, order)
+
         lamd = dill.dumps(where)
-        return self.client.search(lamd)
+        return self.client.search(lamd, limit, order)
 
     def proxy(self, path):
         file = self.getobject(path, False)
@@ -95,16 +226,15 @@ class Z0RPCClient:
         funcs = {}
 
         def getatt(self, oid, name):
-            obj = self.client.getobject(oid, False)
+            obj = self.getobject(oid, False)
             if obj is None:
                 return obj
-            _obj = dill.loads(obj)
-            return getattr(_obj, name)
+            return getattr(obj, name)
 
         funcs["__getattr__"] = partial(getatt, self, path)
 
         def invoke(self, oid, method):
-            return self.client.execute(oid, method)
+            return self.run(oid, method)
 
         for method in method_list:
             funcs[method] = partial(invoke, self, path, method)
@@ -114,28 +244,75 @@ class Z0RPCClient:
         return proxy()
 
     def store(self, obj):
-        import inspect
+        uuid = self.client.put(*self._pack(obj))
+        self._invalidate(_key(obj))
+        return uuid
 
-        try:
-            _source = inspect.getsource(type(obj))
-        except:
-            _source = "No source available"
+    def store_many(self, objs):
+        """Store a list of objects with one round trip and one commit"""
+        results = self.client.put_many([self._pack(obj) for obj in objs])
+
+        for obj in objs:
+            self._invalidate(_key(obj))
+
+        return results
+
+    @contextmanager
+    def store_batch(self, size=1000):
+        """Store objects in chunks of size, committing each chunk once
+
+        with fs.store_batch() as batch:
+            for item in items:
+                batch.store(item)
 
-        self.client.store(obj.id, obj.path, obj.name, _source, dill.dumps(obj))
+        print(batch.errors)
+        """
+        batch = StoreBatch(self, size)
+
+        yield batch
+
+        batch.flush()
+
+    def _pack(self, obj):
+        return _pack(obj, self.oob)
 
     def list(self, path, offset=0, size=0):
-        return dill.loads(self.client.list(path, offset, size))
+        return dill.loads(self.client.list(path, False, offset, size))
+
+    def listpage(self, path, cursor=None, size=1000):
+        """Return {"files": [...], "cursor": ...}, pass cursor back for the next page"""
+        return self.client.listpage(path, cursor, size)
+
+    def iterdir(self, path, size=1000):
+        """Iterate the entries of a directory of any size in constant memory"""
+        return self.client.liststream(path, size)
 
     def getobject(self, path, nodill, offset=0, size=0):
+        if self.cache is not None and not nodill:
+            _file = self.cache.get(path)
+            if _file is not None:
+                return _file
+
+            token = self.cache.token()
+
         file = self.client.getobject(path, nodill, offset=offset, size=size)
         if type(file) is dict:
             return file
         else:
             if file is None:
                 return file
-            _file = dill.loads(file)
+            _file = serialize.loads(file)
+
+        if self.cache is not None and not nodill and hasattr(_file, "uuid"):
+            # Cached objects are shared by every caller reading the path
+            self.cache.put(path, _file, serialize.size(file), token)
+
         return _file
 
+    def getpayload(self, path):
+        """Return an object's stored payload without decoding it"""
+        return self.client.getobject(path, False)
+
     def hello(self, query):
 
         return self.client.hello(query)
@@ -150,6 +327,7 @@ class Z0RPCClient:
 
     def rm(self, path):
         self.client.rm(path)
+        self._invalidate(path)
         print(path + " removed.")
 
     def query(self, path):
@@ -164,21 +342,344 @@ class Z0RPCClient:
         logging.info("register entry %s", entry)
         self.client.register(entry)
 
+    def register_many(self, entries):
+        logging.info("register %s entries", len(entries))
+        return self.client.register_many(entries)
+
     def get(self, oid, offset=0, size=0):
-        file = self.client.get(oid, offset=offset, size=size)
-        _files = []
-        if type(file) is list:
-            for f in file:
-                _f = dill.loads(f)
-                if "obj" in _f:
-                    _f["obj"] = dill.loads(_f["obj"])
-                _files += [_f]
-        else:
-            if "obj" in file:
-                file["obj"] = dill.loads(file["obj"])
-            _files = file
+        return _unpack_files(self.client.get(oid, offset=offset, size=size))
+
+    def stat_many(self, paths):
+        """Return the file attributes of many paths in one round trip"""
+        return self.client.stat_many(paths)
+
+    def stats(self):
+        """Return the node's connection pool and cache statistics"""
+        return self.client.stats()
+
+    def changes(self, since=0, size=1000):
+        """Return {"changes": [...], "seq": ...}, pass seq back as since for more"""
+        return self.client.changes(since, size)
+
+    def nodes(self):
+        """Return the RPC addresses of the nodes registered with the broker"""
+        return self.client.nodes()
+
+    def run(self, oid, method, data=None, parallel=False):
+        """Execute a method on an object, or on every object of a directory
+
+        parallel calls the method on the directory's objects in a process pool
+        """
+        result = self.client.execute(oid, method, parallel)
+        self._invalidate(oid)
+        return result
+
+    def _invalidate(self, path):
+        """Drop my own changes from the cache without waiting for the notification"""
+        if self.cache is not None:
+            self.cache.invalidate(path)
+
+
+class ClusterClient(Z0RPCClient):
+    """Sends an object's reads and writes straight to the nodes that own it
+
+    Owners are placed on a consistent hash ring of the nodes registered with the
+    broker at host and port, keyed by the object's path. Everything else goes to
+    the broker, as do objects the owners don't hold. A directory's objects are
+    spread over every node, so methods and removals on a directory go to all of
+    them and a directory is read from the broker. The ring is fetched again
+    every refresh seconds. A replica that doesn't answer within timeout seconds
+    is skipped by reads.
+
+    With replicas above 1 an object is written to that many nodes and a store
+    returns once quorum of them, by default a majority, have it. Every replicated
+    store raises the object's version and reads are served by the replica with
+    the highest version that answers fastest. A method run on one replica is
+    passed on to the others when it changed the object.
+    """
+
+    def __init__(
+        self, host, port, oob=False, refresh=30, replicas=1, quorum=None, timeout=5
+    ):
+        super().__init__(host, port, oob)
+        self.refresh = refresh
+        self.timeout = timeout
+        self.ring = None
+        self.loaded = 0
+        self.replicas = replicas
+        self.quorum = quorum or replicas // 2 + 1
+
+        # Moving average of each node's response time in seconds
+        self.latency = {}
+
+    def _ring(self):
+        import time
+
+        from emerge.core.placement import HashRing
 
-        return _files
+        if self.ring is None or time.monotonic() - self.loaded > self.refresh:
+            self.ring = HashRing(self.client.nodes())
+            self.loaded = time.monotonic()
 
-    def run(self, oid, method, data=None):
-        return self.client.execute(oid, method)
+        return self.ring
+
+    def _node(self, address):
+        from urllib.parse import urlparse
+
+        from emerge.core.pool import clients
+
+        remote = urlparse(address)
+        return clients.get(remote.hostname, remote.port)
+
+    def _owners(self, path):
+        """Return the addresses of the nodes holding path, empty without nodes"""
+        return self._ring().owners_of(path.rstrip("/"), self.replicas)
+
+    def _freshest(self, path, owners):
+        """Return the address of the replica to read path from, None if none has it"""
+        import time
+
+        if len(owners) == 1:
+            return owners[0]
+
+        def stat(address):
+            start = time.monotonic()
+            file = self._node(address).call("get", path, timeout=self.timeout)
+            elapsed = time.monotonic() - start
+
+            self.latency[address] = 0.8 * self.latency.get(address, elapsed) + (
+                0.2 * elapsed
+            )
+            return file
+
+        stats = _gather([partial(stat, address) for address in owners])
+
+        replicas = [
+            (file.get("version", 0), -self.latency[address], address)
+            for address, file in zip(owners, stats)
+            if file is not None and not file.get("error")
+        ]
+
+        if not replicas:
+            return None
+
+        return max(replicas)[2]
+
+    def _directory(self, path):
+        """Return whether path is a directory, the broker knows every directory"""
+        return super().get(path).get("type") == "directory"
+
+    def _version(self, obj):
+        if self.replicas > 1:
+            # Readers pick the copy with the highest version
+            obj.version = (obj.version or 0) + 1
+
+    def store(self, obj):
+        owners = self._owners(_key(obj))
+        if not owners:
+            return super().store(obj)
+
+        self._version(obj)
+        meta, payload = self._pack(obj)
+
+        results = _quorum(
+            [
+                partial(
+                    self._node(owner).call,
+                    "put",
+                    meta,
+                    payload,
+                )
+                for owner in owners
+            ],
+            min(self.quorum, len(owners)),
+        )
+
+        return results[0]
+
+    def store_many(self, objs):
+        """Store a list of objects with one round trip to each owner
+
+        An object counts as stored when quorum of its replicas stored it
+        """
+        if len(self._ring()) == 0:
+            return super().store_many(objs)
+
+        batches = {}
+        packed = []
+        for i, obj in enumerate(objs):
+            self._version(obj)
+            packed += [self._pack(obj)]
+
+            for owner in self._owners(_key(obj)):
+                batches.setdefault(owner, [])
+                batches[owner] += [i]
+
+        owners = list(batches)
+        answers = _gather(
+            [
+                partial(
+                    self._node(owner).call,
+                    "put_many",
+                    [packed[i] for i in batches[owner]],
+                )
+                for owner in owners
+            ]
+        )
+
+        stored = [[] for obj in objs]
+        for owner, _results in zip(owners, answers):
+            for i, result in zip(batches[owner], _results or []):
+                if not result["error"]:
+                    stored[i] += [result]
+
+        results = []
+        for obj, _stored in zip(objs, stored):
+            quorum = min(self.quorum, len(self._owners(_key(obj))))
+
+            if len(_stored) >= quorum:
+                results += [_stored[0]]
+            else:
+                results += [
+                    {
+                        "error": True,
+                        "id": obj.id,
+                        "message": "Stored on {} replicas, {} needed".format(
+                            len(_stored), quorum
+                        ),
+                    }
+                ]
+
+        return results
+
+    def getobject(self, path, nodill, offset=0, size=0):
+        owners = self._owners(path)
+        if owners and not self._directory(path):
+            address = self._freshest(path, owners)
+            if address is not None:
+                obj = self._node(address).getobject(path, nodill)
+                if obj is not None:
+                    return obj
+
+        return super().getobject(path, nodill, offset, size)
+
+    def get(self, oid, offset=0, size=0):
+        owners = self._owners(oid)
+        if owners:
+            address = self._freshest(oid, owners)
+            if address is not None:
+                file = self._node(address).get(oid)
+                if not file.get("error"):
+                    return file
+
+        return super().get(oid, offset, size)
+
+    def rm(self, path):
+        """Remove an object from its replicas, or an empty directory everywhere"""
+        import zerorpc
+
+        if self._directory(path):
+            # Every node has its own copy of the directory, the broker last
+            for address in self._ring().nodes:
+                try:
+                    self._node(address).client.rm(path)
+                except zerorpc.RemoteError as ex:
+                    logging.info("rm: %s not on %s %s", path, address, ex)
+
+            return super().rm(path)
+
+        removed = False
+
+        for owner in self._owners(path):
+            try:
+                self._node(owner).client.rm(path)
+                removed = True
+            except zerorpc.RemoteError as ex:
+                logging.info("rm: %s not on %s %s", path, owner, ex)
+
+        if removed:
+            print(path + " removed.")
+            return
+
+        return super().rm(path)
+
+    def run(self, oid, method, data=None, parallel=False):
+        """Execute a method on the freshest replica of an object
+
+        A method that changes the object raises its version on that replica, which
+        then sends it on to the other replicas. On a directory every node runs the
+        method on the objects it holds and the results are combined, with replicas
+        above 1 each replica runs it on its own copy.
+        """
+        owners = self._owners(oid)
+        if owners and self._directory(oid):
+            answers = _gather(
+                [
+                    partial(self._node(address).call, "execute", oid, method, parallel)
+                    for address in self._ring().nodes
+                ]
+            )
+
+            # Nodes without the directory answer with a message instead
+            answers = [answer for answer in answers if type(answer) is list]
+            if answers:
+                self._invalidate(oid)
+                return [result for answer in answers for result in answer]
+
+        elif owners:
+            address = self._freshest(oid, owners)
+            if address is not None:
+                result = self._node(address).run(oid, method, data, parallel)
+                if result != "No such object {}".format(oid):
+                    others = [owner for owner in owners if owner != address]
+                    if others:
+                        self._node(address).call("replicate", oid, others)
+                    return result
+
+        return super().run(oid, method, data, parallel)
+
+
+def _gather(calls):
+    """Make calls concurrently, returns each result or None for the failed ones"""
+    import gevent
+
+    jobs = [gevent.spawn(call) for call in calls]
+    gevent.joinall(jobs)
+
+    for job in jobs:
+        if job.exception is not None:
+            logging.error("replica failed: %s", job.exception)
+
+    return [job.value if job.successful() else None for job in jobs]
+
+
+def _quorum(calls, quorum):
+    """Make calls concurrently and return the results of the first quorum to succeed
+
+    The other calls carry on in the background. Raises when too many fail for a
+    quorum.
+    """
+    import gevent
+
+    jobs = [gevent.spawn(call) for call in calls]
+    pending = list(jobs)
+
+    while True:
+        done = [job for job in jobs if job.successful()]
+        if len(done) >= quorum:
+            return [job.value for job in done]
+
+        if not pending:
+            break
+
+        for job in gevent.wait(pending, count=1):
+            pending.remove(job)
+
+    raise Exception(
+        "{} of {} replicas succeeded, {} needed: {}".format(
+            len(done),
+            len(jobs),
+            quorum,
+            [str(job.exception) for job in jobs if job.exception is not None],
+        )
+    )
@@ -13,6 +13,15 @@ def _default(self, obj):
 # JSONEncoder.default = _default
 
 
+def readonly(method):
+    """Mark a method that doesn't change its object
+
+    The node doesn't check or write the object back after calling it
+    """
+    method.readonly = True
+    return method
+
+
 class Server(metaclass=ABCMeta):
     @abstractmethod
     def setup(self, options: dict) -> bool:
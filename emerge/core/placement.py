@@ -0,0 +1,69 @@
+""" Decide which node owns an object with a consistent hash ring """
+import bisect
+import hashlib
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Places keys on nodes so adding a node only moves the keys it takes over
+
+    Every node is hashed onto the ring at vnodes points to spread the keys evenly.
+    A key belongs to the first node point at or after its own hash.
+    """
+
+    def __init__(self, nodes=(), vnodes=64):
+        self.vnodes = vnodes
+        self.nodes = set()
+        self.points = []
+        self.owners = {}
+
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+
+        self.nodes.add(node)
+
+        for replica in range(self.vnodes):
+            point = _hash("{}#{}".format(node, replica))
+            self.owners[point] = node
+            bisect.insort(self.points, point)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+
+        self.nodes.discard(node)
+        self.points = [point for point in self.points if self.owners[point] != node]
+        self.owners = {point: self.owners[point] for point in self.points}
+
+    def owners_of(self, key, n=1):
+        """Return the n distinct nodes after key's position on the ring"""
+        if not self.points:
+            return []
+
+        owners = []
+        start = bisect.bisect_left(self.points, _hash(key))
+
+        for i in range(len(self.points)):
+            node = self.owners[self.points[(start + i) % len(self.points)]]
+            if node not in owners:
+                owners += [node]
+                if len(owners) == n:
+                    break
+
+        return owners
+
+    def owner(self, key):
+        """Return the node that owns key, None for an empty ring"""
+        owners = self.owners_of(key)
+
+        return owners[0] if owners else None
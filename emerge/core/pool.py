@@ -0,0 +1,127 @@
+""" Reuse client connections to other nodes """
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ClientPool:
+    """Keeps one client per endpoint for each thread
+
+    zerorpc clients run on the gevent hub of the thread that made them, so clients
+    aren't shared between threads. A client unused for check seconds is pinged
+    before it is handed out again and one unused for idle seconds is closed.
+    """
+
+    def __init__(self, idle=300, check=30):
+        self.idle = idle
+        self.check = check
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.failed = 0
+
+    def get(self, host, port):
+        """Return a connected client for host and port"""
+        from emerge.core.client import Z0RPCClient
+
+        now = time.monotonic()
+        self._evict(now)
+
+        key = (threading.get_ident(), str(host), str(port))
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is not None and now - entry["used"] > self.check:
+            if not self._alive(entry["client"]):
+                self.discard(host, port)
+                entry = None
+
+        if entry is None:
+            entry = {"client": Z0RPCClient(host, port), "used": now}
+            with self.lock:
+                self.entries[key] = entry
+                self.misses += 1
+        else:
+            with self.lock:
+                self.hits += 1
+
+        entry["used"] = now
+
+        return entry["client"]
+
+    @contextmanager
+    def client(self, host, port):
+        """A pooled client that is dropped if the endpoint stops answering"""
+        import zerorpc
+
+        try:
+            yield self.get(host, port)
+        except (zerorpc.LostRemote, zerorpc.TimeoutExpired):
+            self.discard(host, port)
+            raise
+
+    def discard(self, host, port):
+        """Close and forget this thread's client for host and port"""
+        with self.lock:
+            entry = self.entries.pop(
+                (threading.get_ident(), str(host), str(port)), None
+            )
+            if entry is not None:
+                self.failed += 1
+
+        if entry is not None:
+            logging.info("clients: discarding client for %s:%s", host, port)
+            entry["client"].close()
+
+    def release(self):
+        """Close all of this thread's clients, for threads that are about to end"""
+        ident = threading.get_ident()
+
+        with self.lock:
+            entries = [
+                self.entries.pop(key) for key in list(self.entries) if key[0] == ident
+            ]
+
+        for entry in entries:
+            entry["client"].close()
+
+    def _alive(self, client):
+        try:
+            client.client._zerorpc_ping(timeout=2)
+            return True
+        except Exception as ex:
+            logging.warning("clients: ping failed %s", ex)
+            return False
+
+    def _evict(self, now):
+        """Close this thread's clients that have been idle too long"""
+        ident = threading.get_ident()
+
+        with self.lock:
+            idle = [
+                key
+                for key, entry in self.entries.items()
+                if key[0] == ident and now - entry["used"] > self.idle
+            ]
+            entries = [self.entries.pop(key) for key in idle]
+            self.evicted += len(entries)
+
+        for entry in entries:
+            entry["client"].close()
+
+    def stats(self):
+        return {
+            "clients": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "failed": self.failed,
+        }
+
+
+# Shared by everything in the process that calls other nodes
+clients = ClientPool()
@@ -0,0 +1,209 @@
+""" Declarative search predicates that a node can plan against its field indexes
+
+Predicates are built on the client with field():
+
+    fs.search((field("unit_price") < 20) & (field("name") == "widget1"))
+
+and travel to the node as plain lists such as ["and", ["<", "unit_price", 20], ...]
+"""
+
+COMPARISONS = ["==", "!=", "<", "<=", ">", ">=", "in", "contains"]
+LOGICAL = ["and", "or", "not"]
+
+
+class Predicate:
+    """A node in a predicate tree"""
+
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+
+    def __and__(self, other):
+        return Predicate("and", self, other)
+
+    def __or__(self, other):
+        return Predicate("or", self, other)
+
+    def __invert__(self):
+        return Predicate("not", self)
+
+    def __repr__(self):
+        return "Predicate({})".format(self.to_list())
+
+    def to_list(self):
+        if self.op in LOGICAL:
+            return [self.op] + [arg.to_list() for arg in self.args]
+
+        return [self.op] + list(self.args)
+
+    @classmethod
+    def from_list(cls, tree):
+        if tree[0] in LOGICAL:
+            return cls(tree[0], *[cls.from_list(arg) for arg in tree[1:]])
+
+        return cls(*tree)
+
+
+class Field:
+    """A named object field that builds comparison predicates"""
+
+    __hash__ = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, value):
+        return Predicate("==", self.name, value)
+
+    def __ne__(self, value):
+        return Predicate("!=", self.name, value)
+
+    def __lt__(self, value):
+        return Predicate("<", self.name, value)
+
+    def __le__(self, value):
+        return Predicate("<=", self.name, value)
+
+    def __gt__(self, value):
+        return Predicate(">", self.name, value)
+
+    def __ge__(self, value):
+        return Predicate(">=", self.name, value)
+
+    def isin(self, values):
+        return Predicate("in", self.name, list(values))
+
+    def contains(self, value):
+        return Predicate("contains", self.name, value)
+
+
+def field(name):
+    return Field(name)
+
+
+def validate(tree):
+    """Raise an exception if tree is not a well formed predicate tree"""
+    if not isinstance(tree, (list, tuple)) or len(tree) == 0:
+        raise Exception("Invalid predicate {}".format(tree))
+
+    if tree[0] in LOGICAL:
+        if tree[0] == "not" and len(tree) != 2:
+            raise Exception("Invalid predicate {}".format(tree))
+        for arg in tree[1:]:
+            validate(arg)
+    elif tree[0] in COMPARISONS:
+        if len(tree) != 3 or not isinstance(tree[1], str):
+            raise Exception("Invalid predicate {}".format(tree))
+    else:
+        raise Exception("Unknown predicate operator {}".format(tree[0]))
+
+
+def _value(obj, name):
+    if type(obj) is dict:
+        return obj[name]
+
+    return getattr(obj, name)
+
+
+def evaluate(tree, obj):
+    """Evaluate a predicate tree against an object"""
+    op = tree[0]
+
+    if op == "and":
+        return all(evaluate(arg, obj) for arg in tree[1:])
+
+    if op == "or":
+        return any(evaluate(arg, obj) for arg in tree[1:])
+
+    if op == "not":
+        return not evaluate(tree[1], obj)
+
+    try:
+        value = _value(obj, tree[1])
+
+        if op == "==":
+            return value == tree[2]
+        if op == "!=":
+            return value != tree[2]
+        if op == "<":
+            return value < tree[2]
+        if op == "<=":
+            return value <= tree[2]
+        if op == ">":
+            return value > tree[2]
+        if op == ">=":
+            return value >= tree[2]
+        if op == "in":
+            return value in tree[2]
+        if op == "contains":
+            return tree[2] in value
+    except (AttributeError, KeyError, TypeError):
+        return False
+
+    return False
+
+
+def plan(tree, index):
+    """Split a predicate tree into the uuids answered by the index and a residual
+
+    Returns (uuids, residual). uuids is None when the indexes can't narrow the
+    search and every object has to be scanned. residual is the part of the tree
+    still to be evaluated against the candidate objects, None if nothing is left.
+    """
+    from emerge.fs.index import index_key
+
+    op = tree[0]
+
+    if op == "==" and index_key(tree[2]) is not None:
+        return index.lookup(tree[1], tree[2]), None
+
+    if op in ["<", "<="] and index_key(tree[2]) is not None:
+        return index.range(tree[1], high=tree[2], excludehigh=op == "<"), None
+
+    if op in [">", ">="] and index_key(tree[2]) is not None:
+        return index.range(tree[1], low=tree[2], excludelow=op == ">"), None
+
+    if op == "in" and all(index_key(value) is not None for value in tree[2]):
+        uuids = set()
+        for value in tree[2]:
+            uuids |= index.lookup(tree[1], value)
+        return uuids, None
+
+    if op == "and":
+        uuids = None
+        residuals = []
+
+        for arg in tree[1:]:
+            _uuids, residual = plan(arg, index)
+
+            if _uuids is not None:
+                uuids = _uuids if uuids is None else uuids & _uuids
+
+            if residual is not None:
+                residuals += [residual]
+
+        if len(residuals) == 0:
+            return uuids, None
+
+        if len(residuals) == 1:
+            return uuids, residuals[0]
+
+        return uuids, ["and"] + residuals
+
+    if op == "or":
+        uuids = set()
+        exact = True
+
+        for arg in tree[1:]:
+            _uuids, residual = plan(arg, index)
+
+            if _uuids is None:
+                return None, tree
+
+            uuids |= _uuids
+            exact = exact and residual is None
+
+        # The candidates are a superset when any branch has a residual
+        return uuids, None if exact else tree
+
+    return None, tree
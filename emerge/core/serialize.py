@@ -0,0 +1,132 @@
+""" Object serialization with optional pickle protocol 5 out-of-band buffers
+
+Objects are normally a single dill blob. With oob the object is pickled with
+protocol 5 and its large buffers (NumPy arrays, DataFrame blocks, big bytes and
+bytearrays) are left out of the pickle and returned as separate frames:
+
+    [header, buffer1, buffer2, ...]
+
+The frames are handed on as memoryviews of the object's own memory, they are not
+copied into the pickle stream and are stored by the node as they arrive.
+"""
+import io
+import pickle
+
+import dill
+from persistent import Persistent
+
+# bytes and bytearrays at least this large are sent out-of-band
+OOB_THRESHOLD = 64 * 1024
+
+
+class OOBPickler(dill.Pickler):
+    """Sends large bytes and bytearrays through the buffer callback"""
+
+    def reducer_override(self, obj):
+        if type(obj) in (bytes, bytearray) and len(obj) >= OOB_THRESHOLD:
+            return type(obj), (pickle.PickleBuffer(obj),)
+
+        return NotImplemented
+
+
+def dumps(obj, oob=False):
+    """Serialize an object to a dill blob, or to a list of frames with oob"""
+    if not oob:
+        return dill.dumps(obj)
+
+    buffers = []
+    file = io.BytesIO()
+    OOBPickler(file, 5, buffer_callback=buffers.append).dump(obj)
+
+    return [file.getvalue()] + [buffer.raw() for buffer in buffers]
+
+
+def loads(data):
+    """Deserialize a dill blob or a list of frames"""
+    if type(data) in (list, tuple):
+        return dill.loads(data[0], buffers=data[1:])
+
+    return dill.loads(data)
+
+
+def frames(data):
+    """Copy the frames of an oob object into bytes, a dill blob is returned as is"""
+    if type(data) in (list, tuple):
+        return [bytes(frame) for frame in data]
+
+    return data
+
+
+def state(obj):
+    """Pickle the instance state of an object to tell whether a method changed it
+
+    Unlike the object's own pickle this leaves out the class, which dill pickles
+    differently after a round trip
+    """
+    getstate = getattr(obj, "__getstate__", None)
+
+    return dill.dumps(getstate() if getstate is not None else obj.__dict__)
+
+
+def size(data):
+    """Size in bytes of a dill blob or a list of frames"""
+    if type(data) in (list, tuple):
+        return sum(len(frame) for frame in data)
+
+    return len(data)
+
+
+class Payload(Persistent):
+    """The frames of an out-of-band object, stored as its own database record
+
+    Keeping the frames out of the uuids BTree buckets means a large object is
+    written once instead of with every bucket change around it.
+    """
+
+    def __init__(self, frames):
+        self.frames = [bytes(frame) for frame in frames]
+
+
+def fields(obj):
+    """Return the json field data of an object
+
+    Fields json can't encode, such as bytes or arrays, are left out
+    """
+    import dataclasses
+    import json
+
+    if type(obj) is dict:
+        return obj
+
+    try:
+        return json.loads(str(obj))
+    except (TypeError, ValueError):
+        if not dataclasses.is_dataclass(obj):
+            return {}
+
+        data = {}
+        for _field in dataclasses.fields(obj):
+            value = getattr(obj, _field.name, None)
+            if type(value) in (str, int, float, bool) or value is None:
+                data[_field.name] = value
+        return data
+
+
+def meta(obj, source=""):
+    """Return the metadata a node stores an object under
+
+    The node builds the file pointer, field indexes and graphql types from this,
+    so it never has to unpickle the object or import its class to store it.
+    """
+    return {
+        "id": obj.id,
+        "path": obj.path,
+        "name": obj.name,
+        "source": source,
+        "uuid": obj.uuid,
+        "type": obj.type,
+        "perms": obj.perms,
+        "class": obj.__class__.__name__,
+        "version": obj.version if obj.version else 0,
+        "fields": fields(obj),
+    }
@@ -1,8 +1,10 @@
 import logging
 import sys
+import threading
 from contextlib import contextmanager
 from typing import Any
 
+import BTrees.LOBTree
 import BTrees.OOBTree
 import ZODB
 import ZODB.FileStorage
@@ -25,6 +27,84 @@ class FileSystemFactory:
         return class_()
 
 
+class ConnectionPool:
+    """Keeps idle ZODB connections per thread so requests reuse warm object caches
+
+    Every connection has its own transaction manager. A connection checked out
+    again starts a new transaction, which brings it up to date with what other
+    connections committed in the meantime.
+    """
+
+    def __init__(self, db, size=7):
+        self.db = db
+        self.size = size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.stores = 0
+
+    def _idle(self):
+        if not hasattr(self.local, "idle"):
+            self.local.idle = []
+
+        return self.local.idle
+
+    def checkout(self):
+        import transaction
+
+        idle = self._idle()
+
+        if idle:
+            connection = idle.pop()
+            connection.transaction_manager.begin()
+            with self.lock:
+                self.hits += 1
+        else:
+            connection = self.db.open(transaction.TransactionManager())
+            with self.lock:
+                self.misses += 1
+
+        return connection
+
+    def checkin(self, connection):
+        # Discard whatever the caller didn't commit
+        connection.transaction_manager.abort()
+
+        loads, stores = connection.getTransferCounts(True)
+        with self.lock:
+            self.loads += loads
+            self.stores += stores
+
+        idle = self._idle()
+
+        if len(idle) < self.size:
+            idle.append(connection)
+        else:
+            connection.close()
+
+    @contextmanager
+    def connection(self):
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "idle": len(self._idle()),
+            "loads": self.loads,
+            "stores": self.stores,
+            "cache_size": self.db.getCacheSize(),
+            "cache_size_bytes": self.db.getCacheSizeBytes(),
+            "cached_objects": self.db.cacheSize(),
+        }
+
+
 class SQLFileSystem(FileSystem):
     pass
 
@@ -41,13 +121,26 @@ class Z0DBFileSystem(FileSystem):
     root: Any = None
     objects: Any = None
     uuids: Any = None
+    outbox: Any = None
+    indexes: Any = None
+    indexed: Any = None
+    unpublished: Any = None
+    changes: Any = None
 
     def setup(self, options: dict = {}) -> bool:
         import transaction
 
         logging.info("Z0DBFileSystem setup")
         storage = ZODB.FileStorage.FileStorage("emerge.fs")
-        db = self.db = ZODB.DB(storage)
+
+        # Objects kept per connection cache, by count and by estimated size
+        db = self.db = ZODB.DB(
+            storage,
+            pool_size=options.get("pool_size", 16),
+            cache_size=options.get("cache_size", 10000),
+            cache_size_bytes=options.get("cache_size_bytes", 0),
+        )
+        self.pool = ConnectionPool(db, options.get("idle_connections", 8))
         self.connection = db.open()
         # self.root.hello = "".join(["there" for i in range(0,100)])
         self.root = self.connection.root()
@@ -74,6 +167,16 @@ class Z0DBFileSystem(FileSystem):
 
             self.uuids = self.root.uuids = BTrees.OOBTree.BTree()
 
+            self.outbox = self.root.outbox = BTrees.OOBTree.BTree()
+
+            self.indexes = self.root.indexes = BTrees.OOBTree.BTree()
+
+            self.indexed = self.root.indexed = BTrees.OOBTree.BTree()
+
+            self.unpublished = self.root.unpublished = BTrees.OOBTree.BTree()
+
+            self.changes = self.root.changes = BTrees.LOBTree.BTree()
+
             transaction.commit()
         else:
             logging.info("Using loaded filesystem")
@@ -82,10 +185,37 @@ class Z0DBFileSystem(FileSystem):
             self.uuids = self.root.uuids
             self.nodes = self.root.nodes
             self.objects = self.root.objects
+
+            # Collections added since the filesystem was created
+            transaction.begin()
+            for name in ["outbox", "indexes", "indexed"]:
+                if not hasattr(self.root, name):
+                    logging.info("Creating new %s collection", name)
+                    setattr(self.root, name, BTrees.OOBTree.BTree())
+            if not hasattr(self.root, "changes"):
+                logging.info("Creating new changes collection")
+                self.root.unpublished = BTrees.OOBTree.BTree()
+                self.root.changes = BTrees.LOBTree.BTree()
+            transaction.commit()
+
+            self.outbox = self.root.outbox
+            self.indexes = self.root.indexes
+            self.indexed = self.root.indexed
+            self.unpublished = self.root.unpublished
+            self.changes = self.root.changes
         logging.info("self.root.objects %d", len(self.root.objects))
 
         return True
 
+    def connect(self):
+        """Check out a pooled connection for the length of a with block
+
+        with fs.connect() as connection:
+            with connection.transaction_manager:
+                ...
+        """
+        return self.pool.connection()
+
     @contextmanager
     def session(self):
         import transaction
@@ -0,0 +1,140 @@
+""" Persistent field indexes kept in the filesystem next to the objects they index """
+import BTrees.OOBTree
+
+# Numbers and strings share one BTree per field, numbers sort before strings
+NUMBER = 0
+STRING = 1
+
+
+def index_key(value):
+    """Return the BTree key for a field value or None if the value is not indexable"""
+    if type(value) is int or type(value) is float:
+        return (NUMBER, value)
+
+    if type(value) is str:
+        return (STRING, value)
+
+    return None
+
+
+class FieldIndex:
+    """Maps the scalar field values of stored objects to their uuids
+
+    fsroot.indexes holds an OOBTree per field keyed by value with an OOTreeSet of
+    uuids for each value. fsroot.indexed remembers the keys each uuid was indexed
+    under so an object can be unindexed without loading its previous version.
+    """
+
+    def __init__(self, fsroot):
+        self.indexes = fsroot.indexes
+        self.indexed = fsroot.indexed
+
+    def index_object(self, uuid, values):
+        """Index the str, int and float values of an object"""
+        self.unindex_object(uuid)
+
+        keys = {}
+
+        for field, value in values.items():
+            key = index_key(value)
+            if key is None:
+                continue
+
+            if field not in self.indexes:
+                self.indexes[field] = BTrees.OOBTree.BTree()
+
+            index = self.indexes[field]
+
+            uuids = index.get(key)
+            if uuids is None:
+                uuids = index[key] = BTrees.OOBTree.TreeSet()
+
+            uuids.insert(uuid)
+            keys[field] = key
+
+        self.indexed[uuid] = keys
+
+    def unindex_object(self, uuid):
+        """Remove an object from every index it was added to"""
+        keys = self.indexed.get(uuid)
+        if keys is None:
+            return
+
+        for field, key in keys.items():
+            index = self.indexes.get(field)
+            if index is None:
+                continue
+
+            uuids = index.get(key)
+            if uuids is None:
+                continue
+
+            if uuid in uuids:
+                uuids.remove(uuid)
+
+            if not uuids:
+                del index[key]
+
+        del self.indexed[uuid]
+
+    def clear(self):
+        self.indexes.clear()
+        self.indexed.clear()
+
+    def fields(self):
+        return list(self.indexes.keys())
+
+    def values(self, uuid):
+        """Return the field values an object was indexed with"""
+        return {field: key[1] for field, key in self.indexed.get(uuid, {}).items()}
+
+    def lookup(self, field, value):
+        """Return the set of uuids whose field equals value"""
+        key = index_key(value)
+        index = self.indexes.get(field)
+
+        if key is None or index is None:
+            return set()
+
+        return set(index.get(key, ()))
+
+    def range(self, field, low=None, high=None, excludelow=False, excludehigh=False):
+        """Return the set of uuids whose field lies between low and high
+
+        An open bound only ranges over values of the same type as the other bound
+        """
+        index = self.indexes.get(field)
+        if index is None:
+            return set()
+
+        bound = low if low is not None else high
+        kind = index_key(bound)
+        if kind is None:
+            return set()
+
+        if low is None:
+            low, excludelow = (kind[0],), False
+        else:
+            low = index_key(low)
+
+        if high is None:
+            high, excludehigh = (kind[0] + 1,), True
+        else:
+            high = index_key(high)
+
+        uuids = set()
+        for _uuids in index.values(
+            min=low, max=high, excludemin=excludelow, excludemax=excludehigh
+        ):
+            uuids.update(_uuids)
+
+        return uuids
+
+    def items(self, field):
+        """Iterate the (value, uuids) pairs of a field in value order"""
+        index = self.indexes.get(field)
+        if index is None:
+            return
+
+        for key, uuids in index.items():
+            yield key[1], uuids
@@ -0,0 +1,72 @@
+""" Resolve directory paths to their BTrees without walking the tree every time """
+import threading
+from collections import OrderedDict
+
+
+class PathCache:
+    """A least recently used map of directory path to the oid of its BTree
+
+    Persistent objects belong to the connection that loaded them, so the oid is
+    cached and every connection turns it back into its own copy of the BTree with
+    one lookup in its object cache.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, fsroot, path):
+        """Return the directory BTree at path
+
+        Raises KeyError if the path doesn't exist and NotADirectoryError if it is a
+        file.
+        """
+        path = path.rstrip("/")
+        if path == "":
+            return fsroot.objects
+
+        with self.lock:
+            oid = self.entries.get(path)
+            if oid is not None:
+                self.entries.move_to_end(path)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if oid is not None:
+            return fsroot._p_jar.get(oid)
+
+        parent, name = path.rsplit("/", 1)
+        file = self.resolve(fsroot, parent)[name]
+
+        if file["type"] != "directory":
+            raise NotADirectoryError(path)
+
+        directory = file["dir"]
+
+        # A directory created in this transaction has no oid until it commits
+        if directory._p_oid is not None:
+            with self.lock:
+                self.entries[path] = directory._p_oid
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+
+        return directory
+
+    def invalidate(self, path):
+        """Drop path and every path below it"""
+        path = path.rstrip("/")
+
+        with self.lock:
+            for _path in [
+                _path
+                for _path in self.entries
+                if _path == path or _path.startswith(path + "/")
+            ]:
+                del self.entries[_path]
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
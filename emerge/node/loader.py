@@ -0,0 +1,64 @@
+""" Batched object loading for a single GraphQL request """
+
+
+class ObjectLoader:
+    """Loads the objects matched during one request from a single connection
+
+    Decoded objects are cached for the lifetime of the request so resolvers that
+    match the same objects don't load and unpickle them again.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.connection = None
+        self.cache = {}
+
+    @property
+    def fsroot(self):
+        if self.connection is None:
+            self.connection = self.api.fs.pool.checkout()
+
+        return self.connection.root()
+
+    def load_many(self, uuids):
+        """Return the objects for uuids in order, loading the uncached ones"""
+        fsroot = self.fsroot
+
+        for uuid in uuids:
+            if uuid not in self.cache:
+                self.cache[uuid] = self.api._load_object(fsroot, uuid)
+
+        return [self.cache[uuid] for uuid in uuids]
+
+    def select(self, where):
+        """Return the objects matching a predicate tree"""
+        return list(self.api._select(self.fsroot, where, self))
+
+    def close(self):
+        if self.connection is not None:
+            self.api.fs.pool.checkin(self.connection)
+            self.connection = None
+
+        self.cache = {}
+
+
+def selected_fields(info, fields):
+    """Return the fields a GraphQL selection set asks for
+
+    Falls back to every field when the selection uses fragments.
+    """
+    selected = []
+
+    for node in info.field_nodes:
+        if node.selection_set is None:
+            continue
+
+        for selection in node.selection_set.selections:
+            name = getattr(selection, "name", None)
+            if name is None or not hasattr(selection, "selection_set"):
+                return list(fields)
+
+            if name.value in fields and name.value not in selected:
+                selected += [name.value]
+
+    return selected
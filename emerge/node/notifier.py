@@ -0,0 +1,102 @@
+""" The notifier publishes the node's committed changes in the order it numbers them """
+import json
+import logging
+import threading
+
+import transaction
+
+TOPIC = "NODE CHANGED"
+
+
+class Notifier:
+    """Publishes "NODE CHANGED {json}" messages on a PUB socket bound by the node
+
+    The changes of a transaction are written to fsroot.unpublished as one record as
+    it commits, so aborted transactions leave nothing to publish. This thread moves
+    them in commit order to the fsroot.changes log under increasing sequence numbers
+    and publishes them. The log keeps the last keep changes for consumers resuming from
+    the sequence number they last saw.
+
+    ZeroMQ sockets can't be shared between threads, so changes committed by the RPC
+    workers are all sent by the one thread that owns the socket.
+    """
+
+    def __init__(self, fs, port="5556", size=500, interval=1.0, keep=100000):
+        self.fs = fs
+        self.port = port
+        self.size = size
+        self.interval = interval
+        self.keep = max(keep, 1)
+        self.event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        """Wake the publisher, new changes were committed"""
+        self.event.set()
+
+    def run(self):
+        import zmq
+
+        context = zmq.Context()
+        socket = context.socket(zmq.PUB)
+        socket.bind("tcp://0.0.0.0:{}".format(self.port))
+        logging.info("notifier: publishing changes on %s", self.port)
+
+        # Publish anything committed before a restart
+        self.event.set()
+
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+
+            try:
+                for change in self.flush():
+                    socket.send_string("{} {}".format(TOPIC, json.dumps(change)))
+            except Exception as ex:
+                logging.error("notifier: publishing changes failed, retrying: %s", ex)
+
+    def flush(self):
+        """Number the unpublished changes, yields them once they are in the log"""
+        tx_mgr = transaction.TransactionManager()
+        connection = self.fs.db.open(tx_mgr)
+
+        try:
+            with tx_mgr:
+                # Records are keyed by transaction id, ordered by commit time. Those
+                # committed from here on wait for the next flush
+                keys = [
+                    key
+                    for key, record in sorted(
+                        connection.root().unpublished.items(),
+                        key=lambda item: item[1]["time"],
+                    )
+                ]
+
+            for start in range(0, len(keys), self.size):
+                with tx_mgr:
+                    fsroot = connection.root()
+
+                    try:
+                        seq = fsroot.changes.maxKey()
+                    except ValueError:
+                        seq = 0
+
+                    numbered = []
+                    for key in keys[start : start + self.size]:
+                        for change in fsroot.unpublished[key]["changes"]:
+                            seq += 1
+                            numbered += [dict(change, seq=seq)]
+                            fsroot.changes[seq] = numbered[-1]
+                        del fsroot.unpublished[key]
+
+                    # Drop the changes that have fallen out of the log
+                    for old in list(fsroot.changes.keys(max=seq - self.keep)):
+                        del fsroot.changes[old]
+
+                yield from numbered
+        finally:
+            connection.close()
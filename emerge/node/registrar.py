@@ -0,0 +1,123 @@
+""" The registrar sends a node's object registrations to the broker in the background """
+import logging
+import threading
+import time
+
+import transaction
+
+from emerge.core.client import Z0RPCClient as Client
+
+
+def outbox_record(entry):
+    """Return the outbox record of a registration, stamped with the time it was made"""
+    return {"time": time.time_ns(), "entry": entry}
+
+
+class Registrar:
+    """Drains the durable registration outbox to the broker in batches
+
+    Registrations are written to fsroot.outbox in the same transaction as the object
+    they describe, so nothing is lost if the broker is down or the node restarts.
+    They are keyed by the object's uuid, so concurrent writers add them all over the
+    outbox and only an object's latest registration is kept. Entries are sent in the
+    order they were made and only removed once the broker has accepted them.
+    """
+
+    def __init__(self, fs, broker, port="5558", size=500, interval=1.0, retry=30.0):
+        self.fs = fs
+        self.broker = broker
+        self.port = port
+        self.size = size
+        self.interval = interval
+        self.retry = retry
+        self.event = threading.Event()
+        self.thread = None
+        self.rejected = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        """Wake the sender, new registrations were committed to the outbox"""
+        self.event.set()
+
+    def run(self):
+        client = None
+        backoff = self.interval
+
+        # Send anything left over from before a restart
+        self.event.set()
+
+        while True:
+            self.event.wait(backoff)
+            self.event.clear()
+
+            try:
+                if client is None:
+                    client = Client(self.broker, self.port)
+
+                sent = self.flush(client)
+                if sent:
+                    logging.info("registrar: sent %s registrations", sent)
+
+                # Rejected registrations are retried less and less often
+                if self.rejected:
+                    backoff = min(backoff * 2, self.retry)
+                else:
+                    backoff = self.interval
+            except Exception as ex:
+                logging.error("registrar: broker unavailable, retrying: %s", ex)
+                client = None
+                backoff = min(backoff * 2, self.retry)
+
+    def flush(self, client):
+        """Send the outbox to the broker, returns the number of entries accepted
+
+        Entries the broker rejects stay in the outbox for the next flush.
+        """
+
+        tx_mgr = transaction.TransactionManager()
+        connection = self.fs.db.open(tx_mgr)
+
+        sent = 0
+        self.rejected = 0
+
+        try:
+            tx_mgr.begin()
+            # Registrations made from here on wait for the next flush
+            records = sorted(
+                connection.root().outbox.items(), key=lambda item: item[1]["time"]
+            )
+            tx_mgr.abort()
+
+            for start in range(0, len(records), self.size):
+                batch = records[start : start + self.size]
+
+                results = client.register_many(
+                    [record["entry"] for uuid, record in batch]
+                )
+
+                with tx_mgr:
+                    fsroot = connection.root()
+
+                    for (uuid, record), result in zip(batch, results):
+                        if result["error"]:
+                            logging.error(
+                                "registrar: broker rejected %s %s",
+                                uuid,
+                                result.get("message"),
+                            )
+                            self.rejected += 1
+                            continue
+
+                        # A registration made since is sent by the next flush
+                        current = fsroot.outbox.get(uuid)
+                        if current is not None and current["time"] == record["time"]:
+                            del fsroot.outbox[uuid]
+
+                        sent += 1
+
+            return sent
+        finally:
+            connection.close()
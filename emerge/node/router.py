@@ -0,0 +1,94 @@
+""" Serve the node's RPC port from several worker threads """
+import logging
+import threading
+from collections import OrderedDict
+
+BACKEND = "inproc://emerge-rpc-{}"
+
+
+class RPCRouter:
+    """Spreads the clients of one port over a number of zerorpc servers
+
+    zerorpc keeps a call's channel, heartbeats and stream on the connection that
+    opened it, so messages can't be handed out round robin. Each client connection
+    is pinned to one worker instead and concurrent clients are served by different
+    workers. Every worker thread checks out its own database connections.
+    """
+
+    def __init__(self, api, workers, clients=100000):
+        self.api = api
+        self.workers = workers
+        self.clients = clients
+        self.assigned = OrderedDict()
+        self.next = 0
+        self.context = None
+
+    def run(self, address):
+        """Start the workers and route messages for address, never returns"""
+        import zerorpc
+
+        self.context = zerorpc.Context()
+
+        for worker in range(self.workers):
+            threading.Thread(target=self.serve, args=(worker,), daemon=True).start()
+
+        self.route(address)
+
+    def serve(self, worker):
+        import zerorpc
+
+        server = zerorpc.Server(self.api, context=self.context)
+        server.bind(BACKEND.format(worker))
+        logging.info(
+            "router: worker %s listening on %s", worker, BACKEND.format(worker)
+        )
+        server.run()
+
+    def worker(self, identity):
+        """Return the worker a client connection is pinned to"""
+        worker = self.assigned.get(identity)
+
+        if worker is None:
+            worker = self.next
+            self.next = (self.next + 1) % self.workers
+            self.assigned[identity] = worker
+
+            # Forget the clients that have been quiet the longest
+            while len(self.assigned) > self.clients:
+                self.assigned.popitem(last=False)
+        else:
+            self.assigned.move_to_end(identity)
+
+        return worker
+
+    def route(self, address):
+        import zmq
+
+        # inproc endpoints only connect sockets of the same context
+        context = zmq.Context.shadow(self.context.underlying)
+
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind(address)
+
+        backends = []
+        for worker in range(self.workers):
+            backend = context.socket(zmq.DEALER)
+            backend.connect(BACKEND.format(worker))
+            backends += [backend]
+
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        for backend in backends:
+            poller.register(backend, zmq.POLLIN)
+
+        logging.info("router: %s workers on %s", self.workers, address)
+
+        while True:
+            for socket, _ in poller.poll():
+                frames = socket.recv_multipart(copy=False)
+
+                if socket is frontend:
+                    # The first frame is the identity of the client's connection
+                    backends[self.worker(frames[0].bytes)].send_multipart(frames)
+                else:
+                    frontend.send_multipart(frames)
@@ -0,0 +1,95 @@
+""" Fan a query out to the nodes of a cluster and merge their answers """
+import logging
+from urllib.parse import urlparse
+
+from emerge.core.pool import clients
+
+
+def nodes(fsroot):
+    """Return the RPC addresses of the nodes that said hello to the broker"""
+    return [
+        node["id"]
+        for node in fsroot.registry.values("/nodes/", "/nodes/\uffff")
+        if node.get("type") == "node"
+    ]
+
+
+def gather(addresses, method, args, timeout=10):
+    """Call method on every node concurrently
+
+    Returns the answers of the nodes that replied within timeout seconds, the others
+    are logged and left out.
+    """
+    import gevent
+
+    def call(address):
+        remote = urlparse(address)
+        with clients.client(remote.hostname, remote.port) as client:
+            return client.call(method, *args)
+
+    jobs = {address: gevent.spawn(call, address) for address in addresses}
+    gevent.joinall(list(jobs.values()), timeout=timeout)
+
+    results = []
+
+    for address, job in jobs.items():
+        if job.successful():
+            results += [job.value]
+        elif not job.ready():
+            logging.warning("scatter: %s timed out on %s", address, method)
+            job.kill(block=False)
+        else:
+            logging.error("scatter: %s failed on %s %s", address, method, job.exception)
+
+    return results
+
+
+def _sort_key(row, field):
+    value = row[field]
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value)
+
+    return (1, str(value))
+
+
+def merge(rows, order=None, limit=0):
+    """Sort rows by the order field, "-field" for descending, and keep limit rows
+
+    Rows without the field sort last in either direction.
+    """
+    rows = list(rows)
+
+    if order:
+        field = order.lstrip("-")
+
+        present = [
+            row for row in rows if type(row) is dict and row.get(field) is not None
+        ]
+        missing = [
+            row for row in rows if type(row) is not dict or row.get(field) is None
+        ]
+
+        present.sort(key=lambda row: _sort_key(row, field), reverse=order[0] == "-")
+        rows = present + missing
+
+    if limit:
+        rows = rows[:limit]
+
+    return rows
+
+
+def merge_data(datas):
+    """Merge the data of graphql results, lists of the same field are concatenated"""
+    merged = {}
+
+    for data in datas:
+        for key, value in (data or {}).items():
+            if type(value) is list:
+                merged.setdefault(key, [])
+                merged[key] += value
+            elif merged.get(key) is None:
+                # A single object field takes the first node that found one
+                merged[key] = value
+
+    return merged
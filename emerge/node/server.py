@@ -1,36 +1,59 @@
 import logging
 import os
 import platform
+import random
 import signal
 import threading
+from itertools import islice
 from typing import List
 from urllib.parse import urlparse
 
 import BTrees.OOBTree
 import dill
 import graphene
+import zerorpc
 import zope
-from littletable import Table
+from transaction.interfaces import TransientError
 
 from emerge.compute import Data
+from emerge.core import serialize
+from emerge.core.cache import RemoteCache
 from emerge.core.client import IClient
-from emerge.core.client import Z0RPCClient as Client
 from emerge.core.objects import EmergeFile, Server
+from emerge.core.pool import clients
+from emerge.core.query import evaluate, plan, validate
+from emerge.core.serialize import Payload
 from emerge.fs.filesystem import FileSystemFactory
+from emerge.fs.index import FieldIndex
+from emerge.fs.paths import PathCache
+from emerge.node import scatter
+from emerge.node.loader import ObjectLoader, selected_fields
+from emerge.node.notifier import Notifier
+from emerge.node.registrar import Registrar, outbox_record
+from emerge.node.router import RPCRouter
 
 IS_BROKER = "ISBROKER" in os.environ
 
-global broker
+# The broker's host, or host:port when its RPC port isn't the default
+BROKER = os.environ.get("BROKER", "broker")
 
-if not IS_BROKER:
-    BROKER = os.environ["BROKER"]
-    broker = Client(BROKER, "5558")
-    logging.info("Connected to BROKER %s:5558", BROKER)
-    logging.info("Contacting broker...")
-    logging.info("broker object %s", broker)
+# The RPC port of a node, the ports it binds by default are counted down from it
+RPC_PORT = 5558
 
-    # Add myself to the brokers node list
-    logging.info("Contacted broker...")
+
+def _cursor(key):
+    """Encode a directory key as an opaque list cursor"""
+    import base64
+    import json
+
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def _cursor_key(cursor):
+    import base64
+    import json
+
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
 
 
 class QueryClass(graphene.ObjectType):
@@ -64,109 +87,196 @@ class Z0DBNodeServer(Server):
 
         name = "NodeAPI"
 
-        def __init__(self):
+        def __init__(self, options=None):
             # self.fs = FileSystemFactory.get("SQLFileSystem")
             # self.fs = FileSystemFactory.get("S3FileSystem")
             self.fs = FileSystemFactory.get()
-            self.fs.setup()
+            self.fs.setup(options or {})
             self.fs.start()
             self.fs.registry["/hello"] = {"status": "ok", "message": "hello there"}
 
-            connection = self.fs.db.open()
+            options = options or {}
 
-            fsroot = connection.root()
-            logging.info("ROOT IS %s", [o for o in fsroot])
+            # The name other nodes and the broker know this node by
+            self.node = options.get("node", platform.node())
 
-            self.schemas = {}
+            # The broker's RPC host and port
+            host, _, port = options.get("broker", BROKER).partition(":")
+            self.broker = (host, port or str(RPC_PORT))
 
-            self.objects = Table("objects")
-            for oid in fsroot.uuids:
-                if type(fsroot.uuids[oid]) is dict:
-                    _obj = fsroot.uuids[oid]
-                else:
-                    _obj = dill.loads(fsroot.uuids[oid])
-                logging.info("Building schema for %s", _obj.__class__)
-                _fields, self.schema = self._make_graphql(_obj)
+            self.registrar = None
+            if not IS_BROKER:
+                self.registrar = Registrar(self.fs, *self.broker)
 
-                logging.info("_fields: %s", _fields)
-                self.schemas[_obj.__class__.__name__] = self.schema
+            # Publishes committed changes for client caches and other consumers
+            self.notifier = Notifier(
+                self.fs,
+                port=options.get("notify_port", RPC_PORT - 2),
+                keep=options.get("changes_keep", 100000),
+            )
 
-                try:
-                    logging.info("INSERT %s %s", oid, _obj)
-                    self.objects.insert(_obj)
-                except KeyError:
-                    self.objects.delete(id=oid)
-                    self.objects.insert(_obj)
+            # Directory path to BTree lookups shared by every operation
+            self.paths = PathCache()
 
-                try:
-                    self.objects.create_index("uuid", unique=True)
-                except:
-                    pass
+            # Payloads of objects owned by other nodes, by default only on the broker
+            self.remote = RemoteCache(
+                options.get("remote_cache", 64 * 2**20 if IS_BROKER else 0),
+                options.get("remote_ttl", 60),
+            )
+
+            # Seconds the broker waits for each node when it fans a query out
+            self.timeout = options.get("scatter_timeout", 10)
+
+            # The broker rebalances objects over the hash ring when nodes join
+            self.placement = options.get("placement", False)
 
-                for key in _fields.keys():
+            # Nodes each object is kept on when the broker rebalances
+            self.replicas = options.get("replicas", 1)
+
+            # Times a write is attempted when it conflicts with a concurrent one
+            self.attempts = options.get("attempts", 10)
+
+            with self.fs.connect() as connection:
+                fsroot = connection.root()
+                logging.info("ROOT IS %s", [o for o in fsroot])
+
+                # Worker threads add classes concurrently. types changes under the
+                # lock, each change raising types_version, and the schema built
+                # from the newest types wins
+                self.schema = None
+                self.types = {}
+                self.schema_lock = threading.Lock()
+                self.types_version = 0
+                self.schema_version = 0
+
+                if fsroot.uuids and not fsroot.indexed:
+                    # Filesystem created before the field indexes existed
+                    logging.info("Building field indexes")
+                    self.index()
+
+                # One object per class is enough to build its schema. Its indexed
+                # values are used, so the class doesn't have to be importable here
+                index = FieldIndex(fsroot)
+                for name, uuids in index.items("class"):
                     try:
-                        logging.info("Creating index: %s", key)
-                        self.objects.create_index(key, unique=False)
-                    except:
-                        pass
+                        data = index.values(uuids.minKey())
+                        data.pop("class", None)
+                        logging.info("Building schema for %s", name)
+                        self._make_graphql(name, data, build=False)
+                    except Exception as ex:
+                        logging.error("schema: %s %s", name, ex)
 
-        def graphql(self, query):
-            """Execute a graphql query"""
+                self._build_schema()
+
+        def graphql(self, query, fanout=True):
+            """Execute a graphql query
+
+            The broker also runs the query on every node and concatenates the lists
+            they return for each field
+            """
 
             import json
 
             logging.info("graphql: query: %s", query)
-            result = self.schema.execute(query)
-            logging.info("RESULT %s", json.dumps(result.data, indent=4))
+
+            loader = ObjectLoader(self)
+            try:
+                result = self.schema.execute(query, context_value={"loader": loader})
+                addresses = scatter.nodes(loader.fsroot) if IS_BROKER and fanout else []
+            finally:
+                loader.close()
+
+            if result.errors:
+                logging.error("graphql: %s", result.errors)
+            logging.debug("RESULT %s", json.dumps(result.data, indent=4))
+
+            if addresses:
+                return scatter.merge_data(
+                    [result.data]
+                    + scatter.gather(addresses, "graphql", [query, False], self.timeout)
+                )
 
             return result.data
 
         def hello(self, address):
             """Receive a hello from a client and check my root"""
             logging.info("HELLO FROM {}".format(address))
-            connection = self.fs.db.open()
-            import transaction
 
-            transaction.begin()
-            root = connection.root()
-            transaction.commit()
+            with self.fs.connect() as connection:
+                logging.info("HELLO root has %s entries", len(connection.root()))
 
-        def registry(self):
-            """Return the registry for this node"""
+        def stats(self):
+            """Return connection pool and cache statistics for this node"""
+            stats = self.fs.pool.stats()
+            stats["paths"] = self.paths.stats()
+            stats["clients"] = clients.stats()
+            stats["remote"] = self.remote.stats()
 
-            import platform
+            return stats
 
-            for name in self.fs.registry:
-                logging.info("NAME OBJ: %s", self.fs.registry[name])
+        def changes(self, since=0, size=1000):
+            """Return up to size of this node's changes numbered after since
 
-            registry = [
-                self.fs.registry[name]
-                for name in self.fs.registry
-                if "type" in self.fs.registry[name]
-                and self.fs.registry[name]["type"] == "file"
-            ]
+            Pass the returned seq back as since for the next ones. The log only keeps
+            the latest changes, when the first one returned isn't since + 1 some were
+            missed.
+            """
+            with self.fs.connect() as connection:
+                fsroot = connection.root()
 
-            return {"registry": registry, "host": platform.node()}
+                changes = [
+                    dict(change)
+                    for change in islice(
+                        fsroot.changes.values(min=since, excludemin=True), size
+                    )
+                ]
 
-        def query(self, path, page=0, size=-1):
-            """Invoke the query operation of an object"""
+            return {
+                "changes": changes,
+                "seq": changes[-1]["seq"] if changes else since,
+            }
 
-            import transaction
+        def registry(self):
+            """Return the registry for this node"""
 
-            tx_mgr = transaction.TransactionManager()
+            with self.fs.connect() as connection:
+                fsroot = connection.root()
 
-            connection = self.fs.db.open(tx_mgr)
+                registry = [
+                    file
+                    for file in fsroot.registry.values()
+                    if "type" in file and file["type"] == "file"
+                ]
+
+            return {"registry": registry, "host": self.node}
+
+        def query(self, path, page=0, size=-1):
+            """Invoke the query operation of an object"""
 
-            fsroot = connection.root()
             obj = self.getobject(path, True)
             logging.info("query: obj %s %s", obj, type(obj))
             if hasattr(obj, "query"):
                 # Object implements query method and receives the database reference
                 # From there, the query method can scan the database and build a list of
                 # results
-                with tx_mgr:
+                loaded = [obj]
+
+                def run(fsroot):
+                    # A retried transaction queries the object as it is now
+                    obj = loaded.pop() if loaded else self.getobject(path, True)
+
+                    before = self._snapshot(obj, obj.query)
                     r = obj.query(self)
-                    fsroot.uuids[obj.uuid] = dill.dumps(obj)
+                    file = self._write_back(fsroot, path, obj.uuid, obj, before)
+                    if file:
+                        self._changed(
+                            fsroot, path, obj.uuid, file["version"], op="query"
+                        )
+
+                    return r
+
+                with self.fs.connect() as connection:
+                    r = self._transact(connection, run)
 
                 logging.info("QUERY R %s %s", type(r), r)
                 return dill.dumps(r)
@@ -175,7 +285,7 @@ class Z0DBNodeServer(Server):
             """Retrieve an object from the database"""
             import json
 
-            connection = self.fs.db.open()
+            connection = self.fs.pool.checkout()
 
             fsroot = connection.root()
             try:
@@ -185,25 +295,36 @@ class Z0DBNodeServer(Server):
                 logging.info("getobject: object %s", obj)
 
                 if nodill:
-                    the_obj = dill.loads(fsroot.uuids[obj["uuid"]])
+                    the_obj = self._load_object(fsroot, obj["uuid"])
                     return the_obj
 
                 if obj["type"] == "reference":
+                    version = obj.get("version", 0)
+
+                    payload = self.remote.get(obj["uuid"], version)
+                    if payload is not None:
+                        logging.info("getobject: %s from remote cache", obj["uuid"])
+                        return payload
+
                     logging.info("getobject: fetch file %s from %s", obj, obj["node"])
                     node = fsroot.registry["/nodes/" + obj["node"]]
                     logging.info("getobject: remote node %s", str(node))
                     _remote = urlparse(node["id"])
-                    client = Client(_remote.hostname, _remote.port)
-                    _obj = client.getobject(path, nodill)
-                    logging.info("getobject: remote object %s", str(_obj))
-                    if nodill:
-                        return _obj
-                    else:
-                        return dill.dumps(_obj)
+                    with clients.client(_remote.hostname, _remote.port) as client:
+                        # Passed on as the owner stored it, without decoding
+                        payload = client.getpayload(path)
+
+                    if type(payload) in (bytes, list):
+                        self.remote.put(obj["uuid"], version, payload)
+
+                    return payload
 
                 if obj["type"] == "file":
                     the_obj = fsroot.uuids[obj["uuid"]]
                     logging.info("getobject: return file %s", obj)
+                    if isinstance(the_obj, Payload):
+                        # Out-of-band frames go back exactly as they were stored
+                        return list(the_obj.frames)
                     return the_obj
 
                 if obj["type"] == "node":
@@ -221,190 +342,334 @@ class Z0DBNodeServer(Server):
                 logging.error(ex)
                 if not IS_BROKER:
                     logging.info("Contacting broker %s", BROKER)
-                    broker = Client(BROKER, "5558")
-                    obj = broker.getobject(path, nodill)
+                    with clients.client(*self.broker) as broker:
+                        obj = broker.getobject(path, nodill)
                     logging.info("getobject: from broker %s", obj)
                     return dill.dumps(obj)
             finally:
-                connection.close()
+                self.fs.pool.checkin(connection)
 
         def get(self, path, page=0, size=-1):
             """Get a file pointer"""
 
-            connection = self.fs.db.open()
+            connection = self.fs.pool.checkout()
 
             try:
                 fsroot = connection.root()
                 logging.info("get: path = %s", path)
 
-                if path in fsroot.registry:
-                    obj = fsroot.registry[path]
+                return self._stat(fsroot, path)
+            finally:
+                self.fs.pool.checkin(connection)
 
-                    if obj["type"] == "directory":
-                        obj["size"] = len(obj["dir"])
-                    else:
-                        obj["size"] = obj["size"]
-
-                    logging.info("get: obj %s", obj)
-                    file = {
-                        "date": obj["date"],
-                        "path": obj["path"],
-                        "name": obj["name"],
-                        "id": obj["id"],
-                        "perms": obj["perms"],
-                        "source": obj["source"] if "source" in obj else "",
-                        "type": obj["type"],
-                        "class": obj.__class__.__name__,
-                        "size": obj["size"],
-                        "version": obj["version"] if "version" in obj else 0,
-                    }
+        def stat_many(self, paths):
+            """Get the file pointers of many paths from one connection"""
 
-                    return file
-                else:
-                    return {"error": True, "message": "Path not found"}
-            finally:
-                connection.close()
+            connection = self.fs.pool.checkout()
 
-        def getdir(self, path, page=0, size=-1):
-            """Get all the objects in a directory"""
+            try:
+                fsroot = connection.root()
+                logging.info("stat_many: %s paths", len(paths))
+
+                return [self._stat(fsroot, path) for path in paths]
+            finally:
+                self.fs.pool.checkin(connection)
 
-            connection = self.fs.db.open()
+        def _stat(self, fsroot, path):
+            """Return the attributes of the file pointer at path"""
+            if path not in fsroot.registry:
+                return {"error": True, "message": "Path not found"}
 
-            fsroot = connection.root()
-            logging.info("getdir: path = %s", path)
             obj = fsroot.registry[path]
 
             if obj["type"] == "directory":
-                return [dill.dumps(obj["dir"][o]) for o in obj["dir"]]
+                size = len(obj["dir"])
+            else:
+                size = obj["size"]
+
+            logging.info("get: obj %s", obj)
+            return {
+                "date": obj["date"],
+                "path": obj["path"],
+                "name": obj["name"],
+                "id": obj["id"],
+                "perms": obj["perms"],
+                "source": obj["source"] if "source" in obj else "",
+                "type": obj["type"],
+                "class": obj.__class__.__name__,
+                "size": size,
+                "version": obj["version"] if "version" in obj else 0,
+            }
 
-            if isinstance(obj, BTrees.OOBTree.OOBTree):
+        def getdir(self, path, page=0, size=-1):
+            """Get all the objects in a directory, or one page of size objects"""
+            from itertools import islice
+
+            connection = self.fs.pool.checkout()
+
+            try:
+                fsroot = connection.root()
+                logging.info("getdir: path = %s", path)
+                obj = fsroot.registry[path]
+
+                if obj["type"] != "directory":
+                    return obj
+
+                names = obj["dir"].keys()
                 if size > 0 and page > 0:
-                    for i in range(0, page):
-                        offset = (page - 1) * size
-                        sublist = obj[offset : offset + size]
-                        return [dill.dumps(obj[o]) for o in sublist]
-                else:
-                    count = 0
-                    objs = []
-                    for o in obj:
-                        objs.append(o)
-                        if count >= 100:
-                            break
-                        count += 1
-                    return [dill.dumps(obj[o]) for o in objs]
-            else:
-                return obj
+                    names = islice(names, (page - 1) * size, page * size)
+
+                return [dill.dumps(obj["dir"][name]) for name in names]
+            finally:
+                self.fs.pool.checkin(connection)
 
         def mkdir(self, path):
             """Make a new directory object"""
+            logging.info("mkdir: path is %s", path)
 
-            import transaction
-
-            tx_mgr = transaction.TransactionManager()
+            with self.fs.connect() as connection:
+                self._transact(connection, lambda fsroot: self._mkdir(fsroot, path))
 
-            connection = self.fs.db.open(tx_mgr)
+        def _mkdir(self, fsroot, path):
+            import datetime
 
-            fsroot = connection.root()
-            logging.info("mkdir: path is %s", path)
-            try:
-                fsroot.registry[path]
+            if path in fsroot.registry:
                 raise Exception("Path {} already exists".format(path))
-            except KeyError:
-                import datetime
 
-                logging.info("mkdir: making new path is %s", path)
-                splits = path.split("/")
-                name = path.rsplit("/")[-1]
+            logging.info("mkdir: making new path is %s", path)
+            name = path.rsplit("/")[-1]
+
+            dir_obj = {
+                "date": str(datetime.datetime.now().strftime("%b %d %Y %H:%M:%S")),
+                "path": path,
+                "name": path,
+                "id": path,
+                "perms": "rwxrwxrwx",
+                "type": "directory",
+                "size": 0,
+                "dir": BTrees.OOBTree.BTree(),
+            }
+            parent = path[: -len(name) - 1]
 
-                dir_obj = {
-                    "date": str(datetime.datetime.now().strftime("%b %d %Y %H:%M:%S")),
-                    "path": path,
-                    "name": path,
-                    "id": path,
-                    "perms": "rwxrwxrwx",
-                    "type": "directory",
-                    "size": 0,
-                    "dir": BTrees.OOBTree.BTree(),
-                }
-                paths = splits[1:]
-                dir = fsroot.objects
+            try:
+                dir = self.paths.resolve(fsroot, parent)
+            except (KeyError, NotADirectoryError):
+                raise Exception("Path {} not found".format(parent))
 
-                with tx_mgr:
-                    for p in paths:
-                        logging.info("mkdir: name %s p %s of paths %s", name, p, paths)
-                        try:
-                            file = dir[p]
-                            if file["type"] == "directory":
-                                dir = file["dir"]
-                        except KeyError:
-                            if p != name:
-                                raise Exception("Path {} not found".format(p))
+            if name in dir:
+                raise Exception("Path {} already exists".format(path))
 
-                            logging.info("{} directory created".format(p))
-                            dir[name] = dir_obj
-                            fsroot.registry[path] = dir_obj
+            logging.info("{} directory created".format(name))
+            dir[name] = dir_obj
+            fsroot.registry[path] = dir_obj
+            self._changed(fsroot, path, op="mkdir", directory=True)
 
         def rm(self, path):
             """Remove an object"""
-            import transaction
+            logging.info("rm: path is %s", path)
+
+            with self.fs.connect() as connection:
+                self._transact(connection, lambda fsroot: self._remove(fsroot, path))
 
-            tx_mgr = transaction.TransactionManager()
+        def _remove(self, fsroot, path):
+            """Remove an object or empty directory within the current transaction"""
+            if "/" not in path.rstrip("/"):
+                raise Exception("Path {} not found".format(path))
 
-            connection = self.fs.db.open(tx_mgr)
+            parent, name = path.rstrip("/").rsplit("/", 1)
 
-            fsroot = connection.root()
             try:
-                paths = path.split("/")[1:]
-                logging.info("rm: path is %s", path)
-                dir = fsroot.objects
-                file = None
+                dir = self.paths.resolve(fsroot, parent)
+                file = dir[name]
+            except (KeyError, NotADirectoryError) as ex:
+                logging.error(ex)
+                raise Exception("Path {} not found".format(path))
 
-                with tx_mgr:
-                    for p in paths:
-                        logging.info("rm: p %s of paths %s", p, paths)
-                        try:
-                            file = dir[p]
-                            logging.info("file: %s", file)
-                            if file["type"] == "directory":
-                                dir = file["dir"]
-                                logging.info("dir: %s", list(dir))
-                            elif file["type"] == "file":
-                                logging.info("rm: removing %s", file)
-                                del dir[p]
-                                transaction.commit()
-                                return
-                        except KeyError as ex:
-                            logging.error(ex)
-                            raise Exception("Path {} not found".format(path))
+            if file["type"] == "directory" and len(file["dir"]) > 0:
+                raise Exception("Directory {} not empty".format(path))
 
-                    if not file:
-                        raise Exception("Path {} not found".format(path))
+            logging.info("rm: removing %s", file)
+            del dir[name]
+            fsroot.registry.pop(path, None)
 
-                    if file and file["type"] == "directory" and len(file["dir"]) > 0:
-                        raise Exception("Directory {} not empty".format(path))
+            if "uuid" in file:
+                # Drop the object so searches no longer find it
+                FieldIndex(fsroot).unindex_object(file["uuid"])
+                fsroot.uuids.pop(file["uuid"], None)
 
-                    if file and dir != fsroot.objects:
-                        logging.info("dir %s", file)
-                        del file["parent"][p]
-                        transaction.commit()
+            self._changed(
+                fsroot,
+                path,
+                file.get("uuid"),
+                op="rm",
+                directory=file["type"] == "directory",
+            )
 
-            except KeyError as ex:
-                logging.error(ex)
-                raise Exception("Path {} not found".format(path))
+        def nodes(self):
+            """Return the RPC addresses of the nodes registered with the broker"""
+            with self.fs.connect() as connection:
+                return scatter.nodes(connection.root())
+
+        def rebalance(self):
+            """Have every node send the objects the ring places elsewhere to their owners
+
+            Returns the number of objects moved
+            """
+            addresses = self.nodes()
+            moved = 0
+
+            for address in addresses:
+                remote = urlparse(address)
+
+                # Nodes move a batch per call so no call outlasts the RPC timeout
+                while True:
+                    with clients.client(remote.hostname, remote.port) as client:
+                        _moved = client.call(
+                            "place", addresses, address, 1000, self.replicas
+                        )
+
+                    moved += _moved
+                    if _moved == 0:
+                        break
+
+            logging.info(
+                "rebalance: moved %s objects between %s nodes", moved, len(addresses)
+            )
+            return moved
+
+        def place(self, addresses, address, size=1000, replicas=1):
+            """Send up to size of my objects the ring places on other nodes to them
+
+            address is my own address among addresses. An object is kept when I am
+            one of its replicas nodes, otherwise it is removed here once all of its
+            owners have stored it. Returns the number moved.
+            """
+            from emerge.core.placement import HashRing
+
+            ring = HashRing(addresses)
+
+            with self.fs.connect() as connection:
+                fsroot = connection.root()
+
+                moves = {}
+                for key, file in fsroot.registry.items():
+                    if file.get("type") != "file" or "uuid" not in file:
+                        continue
+
+                    owners = ring.owners_of(key, replicas)
+                    if owners and address not in owners:
+                        moves[key] = owners
+
+                        if len(moves) == size:
+                            break
+
+                batches = {}
+                for key, owners in moves.items():
+                    for owner in owners:
+                        batches.setdefault(owner, [])
+                        batches[owner] += [key]
+
+                stored = {key: 0 for key in moves}
+
+                for owner, keys in batches.items():
+                    objects = []
+                    for key in keys:
+                        file = fsroot.registry[key]
+                        payload = self._load_payload(fsroot, file["uuid"])
+                        if type(payload) is not bytes:
+                            # Out-of-band frames
+                            payload = list(payload)
+
+                        objects += [[self._meta(file), payload]]
+
+                    remote = urlparse(owner)
+                    with clients.client(remote.hostname, remote.port) as client:
+                        results = client.call("put_many", objects)
+
+                    for key, result in zip(keys, results):
+                        if result["error"]:
+                            logging.error("place: %s not moved %s", key, result)
+                            continue
+
+                        stored[key] += 1
+
+                def remove(fsroot):
+                    moved = 0
+                    for key, owners in moves.items():
+                        # Another writer may have removed it meanwhile
+                        if stored[key] == len(owners) and key in fsroot.registry:
+                            self._remove(fsroot, key)
+                            moved += 1
+                    return moved
+
+                moved = self._transact(connection, remove)
+
+            logging.info("place: moved %s objects", moved)
+            return moved
+
+        def replicate(self, path, addresses):
+            """Send my copy of an object to the nodes in addresses holding an older one
+
+            A method run on one replica only changes that copy, the client asks it to
+            pass the change on. Returns the addresses that stored my copy.
+            """
+            with self.fs.connect() as connection:
+                fsroot = connection.root()
+
+                file = fsroot.registry.get(path)
+                if file is None or file.get("type") != "file":
+                    return []
+
+                version = file.get("version") or 0
+                meta = self._meta(file)
+                payload = self._load_payload(fsroot, file["uuid"])
+                if type(payload) is not bytes:
+                    # Out-of-band frames
+                    payload = list(payload)
+
+            stored = []
+
+            for address in addresses:
+                remote = urlparse(address)
+                with clients.client(remote.hostname, remote.port) as client:
+                    theirs = client.call("get", path)
+                    if not theirs.get("error") and theirs["version"] >= version:
+                        continue
+
+                    client.call("put", meta, payload)
+                    stored += [address]
+
+            logging.info("replicate: %s version %s to %s", path, version, stored)
+            return stored
+
+        def _meta(self, file):
+            """Rebuild the metadata an object was stored with from its file pointer"""
+            return {
+                "id": file["id"],
+                "path": file["path"],
+                "name": file["name"],
+                "source": file["source"],
+                "uuid": file["uuid"],
+                "type": file["type"],
+                "perms": file["perms"],
+                "class": file["class"],
+                "version": file["version"],
+                "fields": file["obj"],
+            }
 
         def cp(self, source, dest):
             """Copy object from one location to another"""
-            connection = self.fs.db.open()
 
-            fsroot = connection.root()
-            try:
-                _source = fsroot.objects[source]
-            except KeyError:
-                raise Exception("Path {} not found".format(source))
+            def copy(fsroot):
+                try:
+                    _source = fsroot.objects[source]
+                except KeyError:
+                    raise Exception("Path {} not found".format(source))
 
-            file = dill.dumps(_source)
+                fsroot.objects[dest] = dill.loads(dill.dumps(_source))
 
-            fsroot.objects[dest] = dill.loads(file)
+            with self.fs.connect() as connection:
+                self._transact(connection, copy)
 
         def dir(self, path):
             """List the objects in a directory path as a generator"""
@@ -414,265 +679,742 @@ class Z0DBNodeServer(Server):
                 yield self.getobject(oid, True)
 
         def list(self, path, nodill, offset=0, size=0):
-            """List/Retrieve the file pointers for a directory"""
+            """List/Retrieve the file pointers for a directory
 
-            connection = self.fs.db.open()
+            size > 0 returns size entries starting at offset, otherwise every entry
+            """
+            from itertools import islice
+
+            connection = self.fs.pool.checkout()
 
             try:
                 fsroot = connection.root()
                 logging.info("list: path %s", path)
-                logging.info("root id is %s", fsroot.objects)
-
-                logging.info("ROOT IS %s", [o for o in fsroot.objects])
-                if path != "/":
-                    paths = path.split("/")[1:]
-                    dir = fsroot.objects
-                    for p in paths:
-                        logging.info("list: p %s of paths %s", p, paths)
-                        try:
-                            file = dir[p]
-                            if file["type"] == "directory":
-                                dir = file["dir"]
-                            elif file["type"] == "file":
-                                if not nodill:
-                                    return dill.dumps(file)
-                                else:
-                                    return file
-                        except KeyError:
-                            raise Exception("Path {} not found".format(path))
-
-                    if dir == fsroot.objects:
-                        raise Exception("Path {} not found".format(path))
-                    obj = dir
-                    logging.info("found %s in %s %s", path, dir, len(obj))
-                else:
-                    obj = fsroot.objects
-                    logging.info("obj is self.fs.objects %s", len(obj))
 
-                files = []
+                obj = self._find(fsroot, path)
 
-                for name in obj:
-                    file = obj[name]
-                    if file["type"] == "directory":
-                        files += ["dir:" + file["name"]]
-                    elif file["type"] == "file" or file["type"] == "reference":
-                        files += [file["path"] + "/" + file["name"]]
-                    else:
-                        files += [file["path"]]
+                if type(obj) is dict:
+                    return obj if nodill else dill.dumps(obj)
 
-                    if len(files) >= 200:
-                        break
+                names = obj.keys()
+                if size > 0:
+                    names = islice(names, offset, offset + size)
+
+                files = [self._list_entry(obj[name]) for name in names]
 
                 if not nodill:
                     return dill.dumps(files)
                 else:
                     return files
             finally:
-                connection.close()
+                self.fs.pool.checkin(connection)
 
-        def execute(self, oid, method):
-            """Execute a method on an object"""
+        def listpage(self, path, cursor=None, size=1000):
+            """Return a page of directory entries and the cursor of the next page
 
-            import inspect
+            The cursor is None after the last page
+            """
+            from itertools import islice
 
-            import transaction
+            if size <= 0:
+                raise ValueError("Page size must be positive, got {}".format(size))
 
-            tx_mgr = transaction.TransactionManager()
-            connection = self.fs.db.open(tx_mgr)
+            connection = self.fs.pool.checkout()
 
-            fsroot = connection.root()
+            try:
+                fsroot = connection.root()
+                obj = self._find(fsroot, path)
 
-            with tx_mgr:
-                try:
-                    obj = fsroot.registry[oid]
-
-                    if obj["type"] == "directory":
-                        results = []
-                        for name in obj["dir"]:
-                            child = fsroot.registry[obj["path"] + "/" + name]
-                            logging.info("%s", child)
-                            the_obj = dill.loads(fsroot.uuids[child["uuid"]])
-
-                            if hasattr(the_obj, method):
-                                _method = getattr(the_obj, method)
-                                results += [_method()]
-                                fsroot.uuids[child["uuid"]] = dill.dumps(the_obj)
-                        return results
-                    else:
-                        the_obj = dill.loads(fsroot.uuids[obj["uuid"]])
+                if type(obj) is dict:
+                    raise Exception("Path {} is not a directory".format(path))
+
+                if cursor is None:
+                    names = obj.keys()
+                else:
+                    names = obj.keys(min=_cursor_key(cursor), excludemin=True)
+
+                # Read one more to know whether there is a next page
+                names = list(islice(names, size + 1))
+
+                files = [self._list_entry(obj[name]) for name in names[:size]]
+
+                cursor = None
+                if len(names) > size:
+                    cursor = _cursor(names[size - 1])
+
+                return {"files": files, "cursor": cursor}
+            finally:
+                self.fs.pool.checkin(connection)
+
+        @zerorpc.stream
+        def liststream(self, path, size=1000):
+            """Stream every entry of a directory, reading it a page at a time"""
+            cursor = None
+
+            while True:
+                page = self.listpage(path, cursor, size)
+
+                for file in page["files"]:
+                    yield file
+
+                cursor = page["cursor"]
+                if cursor is None:
+                    return
+
+        def _find(self, fsroot, path):
+            """Return the directory BTree or the file pointer at path"""
+            path = path.rstrip("/") or "/"
+
+            try:
+                return self.paths.resolve(fsroot, path)
+            except NotADirectoryError:
+                pass
+            except KeyError:
+                raise Exception("Path {} not found".format(path))
+
+            parent, name = path.rsplit("/", 1)
+
+            try:
+                return self.paths.resolve(fsroot, parent)[name]
+            except (KeyError, NotADirectoryError):
+                raise Exception("Path {} not found".format(path))
+
+        def _list_entry(self, file):
+            if file["type"] == "directory":
+                return "dir:" + file["name"]
+            elif file["type"] == "file" or file["type"] == "reference":
+                return file["path"] + "/" + file["name"]
+            else:
+                return file["path"]
+
+        def execute(self, oid, method, parallel=False):
+            """Execute a method on an object
+
+            With parallel the method is called on the objects of a directory in a pool
+            of worker processes
+            """
+            with self.fs.connect() as connection:
+                return self._transact(
+                    connection,
+                    lambda fsroot: self._execute(fsroot, oid, method, parallel),
+                )
+
+        def _execute(self, fsroot, oid, method, parallel):
+            """Execute a method within the current transaction"""
+            import inspect
+
+            try:
+                obj = fsroot.registry[oid]
+
+                if obj["type"] == "directory" and parallel:
+                    return self._execute_parallel(fsroot, obj, method)
+
+                if obj["type"] == "directory":
+                    results = []
+                    for name in obj["dir"]:
+                        child = fsroot.registry[obj["path"] + "/" + name]
+                        logging.info("%s", child)
+                        the_obj = self._load_object(fsroot, child["uuid"])
 
                         if hasattr(the_obj, method):
                             _method = getattr(the_obj, method)
-                            logging.info("Calling method %s on %s", method, the_obj)
-                            if "fs" in inspect.getfullargspec(_method).args:
-                                result = _method(fs=self)
-                            else:
-                                result = _method()
-                            logging.info("after method obj %s", str(the_obj))
-                            fsroot.uuids[obj["uuid"]] = dill.dumps(the_obj)
-                            logging.info("After calling method %s: %s", method, the_obj)
-                            logging.info("result: %s", result)
-                            return result
+                            before = self._snapshot(the_obj, _method)
+                            results += [_method()]
+                            file = self._write_back(
+                                fsroot,
+                                obj["path"] + "/" + name,
+                                child["uuid"],
+                                the_obj,
+                                before,
+                            )
+                            if not file:
+                                continue
+                            self._changed(
+                                fsroot,
+                                obj["path"] + "/" + name,
+                                child["uuid"],
+                                file["version"],
+                                op="execute",
+                            )
+                    return results
+                else:
+                    the_obj = self._load_object(fsroot, obj["uuid"])
+
+                    if hasattr(the_obj, method):
+                        _method = getattr(the_obj, method)
+                        before = self._snapshot(the_obj, _method)
+                        logging.info("Calling method %s on %s", method, obj["uuid"])
+                        if "fs" in inspect.getfullargspec(_method).args:
+                            result = _method(fs=self)
                         else:
-                            raise Exception("No such method on object")
-                except KeyError as ex:
-                    import traceback
+                            result = _method()
+                        file = self._write_back(
+                            fsroot, oid, obj["uuid"], the_obj, before
+                        )
+                        if file:
+                            self._changed(
+                                fsroot, oid, obj["uuid"], file["version"], op="execute"
+                            )
+                        logging.info("After calling method %s: %s", method, obj["uuid"])
+                        logging.info("result: %s", result)
+                        return result
+                    else:
+                        raise Exception("No such method on object")
+            except KeyError as ex:
+                import traceback
+
+                logging.info("%s", traceback.format_exc())
+                logging.error(ex)
+                return "No such object {}".format(oid)
 
-                    logging.info("%s", traceback.format_exc())
-                    logging.error(ex)
-                    return "No such object {}".format(oid)
+        def _execute_parallel(self, fsroot, directory, method):
+            """Call a method on every object of a directory in the process pool
+
+            Only the objects the method changed are written back, in the caller's
+            transaction
+            """
+            import gevent
+
+            from emerge.compute import parallel
+
+            paths = [directory["path"] + "/" + name for name in directory["dir"]]
+            children = [
+                (path, fsroot.registry[path])
+                for path in paths
+                if fsroot.registry[path]["type"] == "file"
+            ]
+
+            payloads = [
+                self._load_payload(fsroot, child["uuid"]) for path, child in children
+            ]
+
+            # Wait in a native thread so the node keeps serving other requests
+            calls = gevent.get_hub().threadpool.apply(
+                parallel.call_many, (payloads, method)
+            )
+
+            results = []
+            changed = 0
+
+            for (path, child), (called, result, payload, data) in zip(children, calls):
+                if not called:
+                    continue
+
+                results += [result]
+
+                if payload is not None:
+                    file = self._save_object(fsroot, path, child["uuid"], payload, data)
+                    self._changed(
+                        fsroot, path, child["uuid"], file["version"], op="execute"
+                    )
+                    changed += 1
+
+            logging.info(
+                "execute: %s on %s objects, %s changed", method, len(results), changed
+            )
+
+            return results
 
         def register(self, entry):
             """Add an object to the registry"""
 
             logging.info("BROKER:register %s", entry)
             file = EmergeFile(**entry)
-            self.store(entry["id"], entry["path"], entry["name"], "", dill.dumps(file))
+            self.put(serialize.meta(file), dill.dumps(file))
+            self.remote.invalidate(file.uuid)
+
+        def register_many(self, entries):
+            """Add a batch of objects to the registry"""
+
+            logging.info("BROKER:register_many %s entries", len(entries))
+
+            files = [EmergeFile(**entry) for entry in entries]
+            results = self.put_many(
+                [[serialize.meta(file), dill.dumps(file)] for file in files]
+            )
 
-        def searchtext(self, field, query):
-            """Search for objects using free text"""
+            # The owner registers again when it stores an object
+            for file in files:
+                self.remote.invalidate(file.uuid)
+
+            return results
+
+        def searchtext(self, field, query, limit=0, order=None, fanout=True):
+            """Search for objects using free text
+
+            order and limit work as for search, the broker also asks every node
+            """
             import json
 
-            base = getattr(self.objects.search, field)
-            results = base(query)
-            logging.debug("ST RESULTS %s", results)
-            _results = []
+            terms = [term.lower() for term in query.split()]
 
-            for result in results:
-                try:
-                    logging.info("JSON TRY %s", result)
-                    _results += [json.loads(str(result[0]))]
-                except Exception as ex:
-                    logging.error(ex)
-                    _results += [str(result)]
-                    logging.info("STRING LOADED")
+            required = [term[1:] for term in terms if term[0] == "+"]
+            excluded = [term[1:] for term in terms if term[0] == "-"]
+            optional = [term for term in terms if term[0] not in "+-"]
+
+            addresses = []
+
+            connection = self.fs.pool.checkout()
+
+            try:
+                fsroot = connection.root()
+
+                if IS_BROKER and fanout:
+                    addresses = scatter.nodes(fsroot)
+
+                # Match against the distinct values of the field index rather than
+                # every object
+                uuids = set()
+                for value, _uuids in FieldIndex(fsroot).items(field):
+                    if type(value) is not str:
+                        continue
+
+                    words = set(value.lower().split())
+
+                    if [term for term in required if term not in words]:
+                        continue
+                    if [term for term in excluded if term in words]:
+                        continue
+                    if optional and not [term for term in optional if term in words]:
+                        continue
+
+                    uuids.update(_uuids)
+
+                logging.debug("ST RESULTS %s", uuids)
+                _results = []
+
+                for uuid in sorted(uuids):
+                    result = self._load_object(fsroot, uuid)
+
+                    if addresses and self._is_reference(result):
+                        continue
+
+                    try:
+                        logging.info("JSON TRY %s", result)
+                        _results += [json.loads(str(result))]
+                    except Exception as ex:
+                        logging.error(ex)
+                        _results += [str(result)]
+                        logging.info("STRING LOADED")
+
+                    if limit and not order and len(_results) == limit:
+                        break
+            finally:
+                self.fs.pool.checkin(connection)
+
+            if addresses:
+                for rows in scatter.gather(
+                    addresses,
+                    "searchtext",
+                    [field, query, limit, order, False],
+                    self.timeout,
+                ):
+                    _results += rows
+
+            _results = scatter.merge(_results, order, limit)
 
             logging.info("SEARCHTEXT %s", _results)
             return _results
 
-        def search(self, where):
-            """Search for objects using an expression"""
-            import json
+        def search(self, where, limit=0, order=None, fanout=True):
+            """Search for objects using an expression or a predicate tree
 
-            lamd = dill.loads(where)
-            logging.info("SEARCH LAMBDA: %s", lamd)
-            results = self.objects.where(lamd)
+            order names the field to sort on, "-field" sorts descending. The broker
+            also asks every node and merges their results.
+            """
+            addresses = []
 
-            _results = []
+            connection = self.fs.pool.checkout()
 
-            for result in results:
-                try:
-                    _results += [json.loads(str(result))]
-                except:
-                    _results += [str(result)]
+            try:
+                fsroot = connection.root()
+
+                if IS_BROKER and fanout:
+                    addresses = scatter.nodes(fsroot)
+
+                _results = []
+
+                for result in self._select(fsroot, where):
+                    # The nodes answer for the objects I only hold references to
+                    if addresses and self._is_reference(result):
+                        continue
+
+                    # Fields json can't encode are left out of the results
+                    _results += [serialize.fields(result) or str(result)]
+
+                    if limit and not order and len(_results) == limit:
+                        break
+            finally:
+                self.fs.pool.checkin(connection)
+
+            if addresses:
+                # Filters, order and limit are applied on the nodes
+                for rows in scatter.gather(
+                    addresses, "search", [where, limit, order, False], self.timeout
+                ):
+                    _results += rows
+
+            _results = scatter.merge(_results, order, limit)
 
             logging.info("SEARCH %s", _results)
             return _results
 
-        def _make_graphql(self, obj):
-            import json
-            from functools import partial
+        def _is_reference(self, obj):
+            if type(obj) is dict:
+                return obj.get("type") == "reference"
+
+            return getattr(obj, "type", None) == "reference"
+
+        def _select(self, fsroot, where, loader=None):
+            """Yield the objects matching a dilled lambda or a predicate tree
+
+            Predicate trees are planned against the field indexes and only the
+            residual is evaluated on the candidate objects. An opaque lambda can't
+            use the indexes and has to see every object. A loader batches and caches
+            the candidate loads for the rest of its request.
+            """
+            if type(where) is bytes:
+                lamd = dill.loads(where)
+                logging.info("SEARCH LAMBDA: %s", lamd)
+                uuids, residual = None, None
+            else:
+                validate(where)
+                lamd = None
+                uuids, residual = plan(where, FieldIndex(fsroot))
+                logging.info("SEARCH PLAN: %s uuids residual %s", uuids, residual)
 
-            if isinstance(obj, EmergeFile):
-                data = json.loads(str(obj))
+            if uuids is None:
+                uuids = fsroot.uuids
             else:
-                if type(obj) is dict:
-                    data = obj
+                uuids = sorted(uuids)
+
+            if loader is None:
+                objs = (self._load_object(fsroot, uuid) for uuid in uuids)
+            else:
+                objs = loader.load_many(list(uuids))
+
+            for obj in objs:
+                if lamd is not None:
+                    try:
+                        if not lamd(obj):
+                            continue
+                    except AttributeError:
+                        continue
+                elif residual is not None and not evaluate(residual, obj):
+                    continue
+
+                yield obj
+
+        def _transact(self, connection, work):
+            """Run work(fsroot) in a transaction and commit it
+
+            The transaction is run again from the start when it conflicts with one
+            committed by another connection, after a short random wait so writers
+            that conflicted don't collide again. Returns what work returned in the
+            attempt that committed. The wait yields to the node's other requests.
+            """
+            import gevent
+
+            attempts = connection.transaction_manager.attempts(self.attempts)
+            for number, attempt in enumerate(attempts):
+                if number > 0:
+                    gevent.sleep(random.uniform(0, 0.01 * 2 ** min(number, 6)))
+                with attempt:
+                    result = work(connection.root())
+
+            return result
+
+        def _load_object(self, fsroot, uuid):
+            """Load an object from the uuids registry"""
+            if type(fsroot.uuids[uuid]) is dict:
+                return fsroot.uuids[uuid]
+
+            if isinstance(fsroot.uuids[uuid], Payload):
+                return serialize.loads(fsroot.uuids[uuid].frames)
+
+            return dill.loads(fsroot.uuids[uuid])
+
+        def _snapshot(self, obj, method):
+            """Return an object's state before calling method
+
+            None when the method is marked readonly and the object needs no write back
+            """
+            if type(obj) is dict or getattr(method, "readonly", False):
+                return None
+
+            return serialize.state(obj)
+
+        def _write_back(self, fsroot, path, uuid, obj, before):
+            """Write an object back if its state changed since the before snapshot
 
-            fields = {"uuid": graphene.String()}
+            Returns the updated file pointer, None when the object was unchanged
+            """
+            if before is None or serialize.state(obj) == before:
+                return None
+
+            # Saved with the version _save_object gives its file pointer
+            obj.version = (fsroot.registry[path].get("version") or 0) + 1
+
+            # Written in the format the object was stored with
+            oob = isinstance(fsroot.uuids.get(uuid), Payload)
+            return self._save_object(
+                fsroot, path, uuid, serialize.dumps(obj, oob), serialize.fields(obj)
+            )
+
+        def _save_object(self, fsroot, path, uuid, payload, data):
+            """Save a changed object's payload, file pointer and field indexes
+
+            The version is raised so replicas and caches can tell the new state from
+            the old one. Returns the updated file pointer.
+            """
+            self._save_payload(fsroot, uuid, payload)
+
+            # The registry and the directory each keep their own copy of the pointer
+            file = fsroot.registry[path]
+            file = dict(
+                file,
+                obj=data,
+                size=serialize.size(payload),
+                version=(file.get("version") or 0) + 1,
+            )
+            fsroot.registry[path] = file
+
+            try:
+                self.paths.resolve(fsroot, file["path"])[file["id"]] = file
+            except (KeyError, NotADirectoryError):
+                logging.error("write back: no directory for %s", path)
+
+            self._index_object(fsroot, uuid, file["class"], data)
+
+            # Registering again makes the broker drop the payload it cached
+            if not IS_BROKER:
+                self._register(fsroot, file)
+
+            return file
+
+        def _load_payload(self, fsroot, uuid):
+            """Return the stored dill blob or out-of-band frames of an object"""
+            payload = fsroot.uuids[uuid]
+
+            if isinstance(payload, Payload):
+                return payload.frames
+
+            return payload
+
+        def _save_payload(self, fsroot, uuid, payload):
+            """Write a dill blob or out-of-band frames to the uuids registry
+
+            Out-of-band objects keep their frames in their own record
+            """
+            if type(payload) is not list:
+                fsroot.uuids[uuid] = payload
+                return
+
+            record = fsroot.uuids.get(uuid)
+
+            if isinstance(record, Payload):
+                record.frames = Payload(payload).frames
+            else:
+                fsroot.uuids[uuid] = Payload(payload)
+
+        def _changed(
+            self, fsroot, path, uuid=None, version=0, op="store", directory=False
+        ):
+            """Record a change to path, it is published once the transaction commits"""
+            from uuid import uuid4
+
+            txn = fsroot._p_jar.transaction_manager.get()
+
+            try:
+                changes = txn.data(self)
+            except KeyError:
+                # One id for all the changes of a transaction, also kept in its metadata
+                txn_id = txn.extension.setdefault("emerge_txn", uuid4().hex)
+
+                changes = {"txn": txn_id, "changes": [], "directories": []}
+                txn.set_data(self, changes)
+                txn.addBeforeCommitHook(self._record_changes, (fsroot, changes))
+                txn.addAfterCommitHook(self._publish_changes, (changes,))
+
+            changes["changes"] += [
+                {
+                    "op": op,
+                    "path": path,
+                    "uuid": uuid,
+                    "version": version,
+                    "node": self.node,
+                    "txn": changes["txn"],
+                }
+            ]
+
+            if directory:
+                changes["directories"] += [path]
+
+        def _record_changes(self, fsroot, changes):
+            """Write the changes of a transaction as one record just before it commits
+
+            Records are keyed by transaction id, so concurrent commits add them far
+            apart in the outbox instead of all at its end.
+            """
+            import time
+
+            fsroot.unpublished[changes["txn"]] = {
+                "time": time.time_ns(),
+                "changes": changes["changes"],
+            }
+
+        def _publish_changes(self, success, changes):
+            if not success:
+                return
+
+            # Only directory changes can leave stale path lookups behind
+            for path in changes["directories"]:
+                self.paths.invalidate(path)
+
+            self.notifier.notify()
+
+            # Objects written back by execute or query are registered again
+            if self.registrar:
+                self.registrar.notify()
+
+        def _index_object(self, fsroot, uuid, name, data):
+            """Add an object's fields to the persistent field indexes"""
+            values = dict(data)
+            values["class"] = name
+
+            FieldIndex(fsroot).index_object(uuid, values)
+
+        def _make_graphql(self, name, data, build=True):
+            """Add a class to the graphql schema from the field data of one of its objects
+
+            Types are cached by class name and only rebuilt when an object brings
+            fields the cached type doesn't have. Returns the fields of the class and
+            the root schema covering every class.
+            """
+            from functools import partial
+
+            types = {"uuid": graphene.String}
 
             for key, value in data.items():
                 if type(value) is str:
-                    fields[key] = graphene.String()
+                    types[key] = graphene.String
 
                 if type(value) is int:
-                    fields[key] = graphene.Int()
+                    types[key] = graphene.Int
 
                 if type(value) is float:
-                    fields[key] = graphene.Float()
+                    types[key] = graphene.Float
 
-            logging.info("FIELDS: %s %s", obj.__class__.__name__, fields)
-            item = type(
-                obj.__class__.__name__ + "Resolver", (graphene.ObjectType,), fields
-            )
-            setattr(graphene.types.objecttype, item.__name__, item)
+            with self.schema_lock:
+                if name in self.types:
+                    cached = self.types[name]["types"]
+                    if all(cached.get(key) is types[key] for key in types):
+                        return self.types[name]["fields"], self.schema
 
-            def resolver(root, info, **kwargs):
-                import json
+                    # Keep the fields other objects of the class brought along
+                    types = dict(cached, **types)
 
-                connection = self.fs.db.open()
+                fields = {key: _type() for key, _type in types.items()}
 
-                fsroot = connection.root()
-                logging.info("resolve_widget: kwargs %s %s", info.field_name, kwargs)
+                logging.info("FIELDS: %s %s", name, fields)
+                item = type(name + "Resolver", (graphene.ObjectType,), fields)
+                setattr(graphene.types.objecttype, item.__name__, item)
 
-                # use search indices
-                def search_func(o):
-                    logging.info("search_func: %s %s", o, kwargs)
-                    for key, val in kwargs.items():
-                        if val:
-                            value = getattr(o, key)
-                            logging.info("search_func: val %s value %s", val, value)
-                            if value != val:
-                                logging.info("search_func: returning False")
-                                return False
-                    logging.info("search_func: returning True")
-                    return True
-
-                results = self.objects.where(search_func)
-                logging.info("resolver RESULTS %s", [str(result) for result in results])
+                def resolver(root, info, **kwargs):
+                    import json
 
-                try:
-                    _results = [json.loads(str(result)) for result in results]
                     logging.info(
-                        "resolver _results1 %s", [result for result in _results]
+                        "resolve_widget: kwargs %s %s", info.field_name, kwargs
                     )
-                    fobjs = []
-                    for result in _results:
-                        robj = json.loads(str(dill.loads(fsroot.uuids[result["uuid"]])))
-                        logging.info("R %s", robj)
-                        fobjs += [robj]
-
-                    logging.info("FOBJS %s", fobjs)
-                    _results = [item(**result) for result in fobjs]
-                except Exception as ex:
-                    logging.error(ex)
-                logging.info("resolver _results2 %s", _results)
 
-                if info.field_name.find("List") >= 0:
-                    return _results
-                else:
-                    return _results[0]
+                    # use search indices
+                    where = ["and", ["==", "class", name]]
+                    for key, val in kwargs.items():
+                        if key == "where":
+                            if val is not None:
+                                where += [json.loads(val)]
+                        elif val is not None:
+                            where += [["==", key, val]]
+
+                    # Only build the fields the query selects
+                    selected = selected_fields(info, fields)
+
+                    _results = []
+                    for result in info.context["loader"].select(where):
+                        if type(result) is dict:
+                            values = {key: result.get(key) for key in selected}
+                        else:
+                            values = {
+                                key: getattr(result, key, None) for key in selected
+                            }
+                        _results += [item(**values)]
 
-            qfields = {
-                obj.__class__.__name__: graphene.Field(item, **fields),
-                obj.__class__.__name__ + "List": graphene.List(item),
-            }
-            params = {}
+                    logging.info("resolver: %s results", len(_results))
 
-            for key in fields.keys():
-                params[key] = None
+                    if info.field_name.find("List") >= 0:
+                        return _results
+                    else:
+                        return _results[0] if _results else None
 
-            logging.info("make_grapql: params: %s", params)
-            qfields["resolve_" + obj.__class__.__name__] = partial(resolver, **params)
-            qfields["resolve_" + obj.__class__.__name__ + "List"] = partial(
-                resolver, **params
-            )
-            logging.info("make_grapql: fields: %s", fields)
-            logging.info("make_grapql: qfields: %s", qfields)
-            query = type(obj.__class__.__name__ + "Query", (QueryClass,), qfields)
+                # where takes a json predicate tree, e.g. "[\"<\", \"unit_price\", 20]"
+                args = {key: _type() for key, _type in types.items()}
+                args["where"] = graphene.String()
+
+                qfields = {
+                    name: graphene.Field(item, **args),
+                    name + "List": graphene.Field(graphene.List(item), **args),
+                }
+                params = {}
+
+                for key in args.keys():
+                    params[key] = None
+
+                logging.info("make_grapql: params: %s", params)
+                qfields["resolve_" + name] = partial(resolver, **params)
+                qfields["resolve_" + name + "List"] = partial(resolver, **params)
+                logging.info("make_grapql: qfields: %s", qfields)
+
+                self.types[name] = {
+                    "types": types,
+                    "fields": fields,
+                    "qfields": qfields,
+                }
+                self.types_version += 1
+
+            if build:
+                self._build_schema()
+
+            return fields, self.schema
+
+        def _build_schema(self):
+            """Combine the query fields of every class into one root schema
+
+            The schema is built from a snapshot of the types and replaces the current
+            one unless a schema of newer types was swapped in meanwhile
+            """
+            with self.schema_lock:
+                version = self.types_version
+                types = list(self.types.values())
+
+            qfields = {}
+            for entry in types:
+                qfields.update(entry["qfields"])
+
+            if len(qfields) == 0:
+                return
+
+            query = type("Query", (QueryClass,), qfields)
             setattr(graphene.types.objecttype, query.__name__, query)
             logging.info("make_grapql: query: %s", query)
 
             schema = graphene.Schema(query=query)
-            logging.info(
-                "_make_graphql: schema %s %s ::%s:: %s",
-                schema,
-                item,
-                item.name,
-                fields,
-            )
 
-            return fields, schema
+            with self.schema_lock:
+                if version >= self.schema_version:
+                    self.schema = schema
+                    self.schema_version = version
+
+            logging.info("_build_schema: schema for %s classes", len(types))
 
         def _make_paths(self, paths, root, fsroot):
             import datetime
@@ -699,7 +1441,7 @@ class Z0DBNodeServer(Server):
                         "perms": "rwxrwxrwx",
                         "parent": root,
                         "type": "directory",
-                        "node": platform.node(),
+                        "node": self.node,
                         "size": 0,
                         "dir": BTrees.OOBTree.BTree(),
                     }
@@ -725,246 +1467,291 @@ class Z0DBNodeServer(Server):
 
         def index(self):
             """Recreate all the searchable indexes"""
+
             logging.info("index: started...")
-            connection = self.fs.db.open()
-            try:
-                fsroot = connection.root()
-                for uuid in fsroot.uuids:
-                    _obj = fsroot.uuids[uuid]
-                    try:
-                        the_obj = dill.loads(fsroot.uuids[uuid])
 
-                        _fields, self.schema = self._make_graphql(the_obj)
+            connection = self.fs.pool.checkout()
+            tx_mgr = connection.transaction_manager
+            try:
+                with tx_mgr:
+                    fsroot = connection.root()
+                    FieldIndex(fsroot).clear()
 
-                        logging.info("_fields: %s", _fields)
-                        self.schemas[the_obj.__class__.__name__] = self.schema
+                    for uuid in fsroot.uuids:
                         try:
-                            self.objects.create_index("uuid", unique=True)
-                        except:
-                            pass
-
-                        for key in _fields.keys():
-                            try:
-                                self.objects.create_index(key, unique=False)
-                            except:
-                                pass
-                            try:
-                                logging.info("Creating index: %s", key)
-                                self.objects.create_search_index(key, force=True)
-                            except Exception as ex:
-                                logging.error(ex)
-                    except:
-                        pass
+                            the_obj = self._load_object(fsroot, uuid)
+                            name = the_obj.__class__.__name__
+                            data = serialize.fields(the_obj)
+                            self._index_object(fsroot, uuid, name, data)
+                            self._make_graphql(name, data, build=False)
+                        except Exception as ex:
+                            logging.error("index: %s %s", uuid, ex)
+
+                self._build_schema()
 
             finally:
-                connection.close()
+                self.fs.pool.checkin(connection)
 
             return True
 
         def store(self, id, path, name, source, obj):
-            """Store an object in the database"""
-            import datetime
-            import json
-            from uuid import uuid4
+            """Store a dilled object in the database
 
-            import dill
-            import transaction
+            Kept for older clients, the object is unpickled here to read its metadata.
+            Clients send put() the metadata and payload instead.
+            """
+            return self.put(*self._unpack(id, path, name, source, obj))
 
-            tx_mgr = transaction.TransactionManager()
+        def store_many(self, objects):
+            """Store a batch of dilled objects in a single transaction
 
-            if type(obj) is dict:
-                _obj = obj
-                # Add this node name to object
-                _obj["node"] = platform.node()
-            else:
-                # If not a dict then must be dilled
-                _obj = dill.loads(obj)
-                _obj.node = platform.node()
+            Returns a result for each object, in the order they were given
+            """
+            results = [None] * len(objects)
+            unpacked = []
+            positions = []
 
-            connection = self.fs.db.open(tx_mgr)
+            for i, obj in enumerate(objects):
+                try:
+                    unpacked += [self._unpack(*obj)]
+                    positions += [i]
+                except Exception as ex:
+                    logging.error("store_many: %s %s", obj[0], ex)
+                    results[i] = {"error": True, "id": obj[0], "message": str(ex)}
 
-            try:
-                with tx_mgr:
-                    fsroot = connection.root()
+            for i, result in zip(positions, self.put_many(unpacked)):
+                results[i] = result
 
-                    # Make graphql schema for object
-                    logging.info("1_OBJ %s %s", type(_obj), obj)
-                    _fields, self.schema = self._make_graphql(_obj)
+            return results
 
-                    # Store the updated schema
-                    logging.info("_fields: %s", _fields)
-                    self.schemas[_obj.__class__.__name__] = self.schema
+        def _unpack(self, id, path, name, source, obj):
+            """Return the metadata and payload of a dilled object"""
+            from uuid import uuid4
 
-                    # Store the objects class in the classes registry
-                    logging.info("2_OBJ %s %s", _obj.__class__, _obj)
-                    # transaction.begin()
-                    fsroot.classes[_obj.__class__.__name__] = dill.dumps(_obj.__class__)
-                    # transaction.commit()
+            # Either a dill blob or oob frames
+            _obj = serialize.loads(obj)
+            _obj.node = self.node
 
-                    # Ensure object has a unique identifier
-                    _uuid = str(uuid4())
+            # Ensure a uuid or use existing one
+            if _obj.uuid is None or len(_obj.uuid) == 0:
+                _obj.uuid = str(uuid4())
 
-                    # BEGIN TRANSACTION
-                    # transaction.begin()
+            meta = serialize.meta(_obj, source)
+            meta.update({"id": id, "path": path, "name": name})
 
-                    # Ensure a uuid or use existing one
-                    if _obj.uuid is None or len(_obj.uuid) == 0:
-                        _obj.uuid = _uuid
-                    else:
-                        _uuid = _obj.uuid
+            return meta, serialize.dumps(_obj, oob=type(obj) is list)
 
-                    # Place object in uuids registry for future lookups
-                    fsroot.uuids[_uuid] = dill.dumps(_obj)
+        def put(self, meta, payload):
+            """Store an object from its metadata and serialized payload
 
-                    logging.info("NODE is %s", platform.node())
+            The payload is kept exactly as it was sent and is only unpickled when a
+            method, query or search needs the object.
+            """
 
-                    # Create the file pointer
-                    file = {
-                        "date": str(
-                            datetime.datetime.now().strftime("%b %d %Y %H:%M:%S")
-                        ),
-                        "path": _obj.path,
-                        "name": _obj.name,
-                        "id": _obj.id,
-                        "perms": _obj.perms,
-                        "source": source,
-                        "type": _obj.type,
-                        "class": _obj.__class__.__name__,
-                        "size": len(obj),
-                        "node": platform.node(),
-                        "uuid": _uuid,
-                        "obj": json.loads(str(_obj)),
-                        "version": _obj.version if _obj.version else 0,
-                    }
+            with self.fs.connect() as connection:
+                file = self._transact(
+                    connection, lambda fsroot: self._put(fsroot, meta, payload)
+                )
 
-                    logging.info("STORE: %s", file)
+            if self.registrar:
+                self.registrar.notify()
 
-                    # If the path is already created, set the directory to that path
-                    if path in fsroot.objects:
-                        directory = fsroot.objects[path]
-                        logging.info("Found %s in root.objects", path)
-                    else:
-                        # Create all the BTree objects for each section in the path
-                        paths = path.split("/")[1:]
-                        root = _root = fsroot.objects
-                        logging.info("store: paths: %s", paths)
-                        logging.info("root id %s", root)
-
-                        """ Create BTree directories for each subpath if it doesn't exist
-                        then set the directory to the last BTree in the path """
-                        root, directory = self._make_paths(paths, root, fsroot)
-
-                    logging.info("Adding file  %s to directory  [%s]", id, directory)
-
-                    # Add the file pointer to the directory object
-                    directory[id] = file
-
-                    # Add the file pointer to the path registry
-                    if path[-1] != "/" and len(name) > 0:
-                        fsroot.registry[path + "/" + name] = file
-                        logging.info(
-                            "Adding to registry2 %s %s", path + "/" + name, file
-                        )
+            return file["uuid"]
 
-                        if not IS_BROKER:
-                            broker = Client(BROKER, "5558")
-                            logging.info("broker object %s", broker)
-
-                            # Add my object reference to the brokers directory,
-                            # pointing back to me
-                            logging.info(
-                                "registering %s",
-                                {
-                                    "path": file["path"],
-                                    "name": file["name"],
-                                    "type": "reference",
-                                    "id": file["id"],
-                                    "uuid": file["uuid"],
-                                    "node": platform.node(),
-                                },
-                            )
-                            broker.register(
-                                {
-                                    "path": file["path"],
-                                    "name": file["name"],
-                                    "type": "reference",
-                                    "id": file["id"],
-                                    "uuid": file["uuid"],
-                                    "node": platform.node(),
-                                }
-                            )
-                    else:
-                        fsroot.registry[path + name] = file
-                        logging.info("Adding to registry3 %s %s", path + name, file)
-
-                        if not IS_BROKER:
-                            broker = Client(BROKER, "5558")
-                            logging.info("broker object %s", broker)
-
-                            # Add my object reference to the brokers directory,
-                            # pointing back to me
-                            logging.info(
-                                "registering %s",
-                                {
-                                    "path": file["path"],
-                                    "name": file["name"],
-                                    "type": "reference",
-                                    "id": file["id"],
-                                    "uuid": file["uuid"],
-                                    "node": platform.node(),
-                                },
-                            )
-                            broker.register(
-                                {
-                                    "path": file["path"],
-                                    "name": file["name"],
-                                    "type": "reference",
-                                    "id": file["id"],
-                                    "uuid": file["uuid"],
-                                    "node": platform.node(),
-                                }
-                            )
+        def put_many(self, objects):
+            """Store a batch of [meta, payload] objects in a single transaction
+
+            The whole batch is written optimistically. Objects that fail are reported
+            and left out, the transaction is aborted and the rest written again, so a
+            bad object never costs the good ones a savepoint each.
+            """
 
-                    logging.info("3_OBJ str %s %s", _uuid, str(_obj))
+            results = {}
+            pending = list(range(len(objects)))
 
-                    # Insert object in the searchable index
+            def put(fsroot):
+                classes = set()
+                stored = {}
+                failed = {}
+
+                for i in pending:
+                    meta, payload = objects[i]
                     try:
-                        self.objects.insert(_obj)
-                    except KeyError:
-                        logging.error("KeyError")
-                        self.objects.delete(uuid=_uuid)
-                        self.objects.insert(_obj)
+                        file = self._put(fsroot, meta, payload, classes)
+                        stored[i] = {
+                            "error": False,
+                            "id": meta["id"],
+                            "uuid": file["uuid"],
+                        }
+                    except TransientError:
+                        # Conflicts retry the whole transaction
+                        raise
                     except Exception as ex:
-                        # TODO: Objects with subobjects trigger this
-                        logging.error(ex)
+                        logging.error("put_many: %s %s", meta.get("id"), ex)
+                        failed[i] = {
+                            "error": True,
+                            "id": meta.get("id"),
+                            "message": str(ex),
+                        }
 
-                    # CREATE INDEXES
-                    # Might need to separate this out into its own operation
+                if failed:
+                    # A failed object may have left changes behind
+                    fsroot._p_jar.transaction_manager.abort()
 
-                    # Create uuid index if it's not already there
-                    try:
-                        self.objects.create_index("uuid", unique=True)
-                    except:
-                        pass
+                return stored, failed
 
-                    # Ensure there are indexes for the fields of the object
-                    """
-                    for key in _fields.keys():
-                        try:
-                            self.objects.create_index(key, unique=False)
-                        except:
-                            pass
-                        try:
-                            logging.info("Creating index: %s", key)
-                            self.objects.create_search_index(key, force=True)
-                        except Exception as ex:
-                            logging.error(ex)
-                    """
-                    # transaction.commit()
-                    # COMPLETE TRANSACTION
+            with self.fs.connect() as connection:
+                while pending:
+                    stored, failed = self._transact(connection, put)
 
-            finally:
-                connection.close()
+                    results.update(failed)
+
+                    if failed:
+                        pending = list(stored)
+                    else:
+                        results.update(stored)
+                        pending = []
+
+            if self.registrar:
+                self.registrar.notify()
+
+            logging.info("put_many: stored %s objects", len(results))
+            return [results[i] for i in range(len(objects))]
+
+        def _register(self, fsroot, file):
+            """Queue my object reference for the brokers directory, pointing back to me"""
+            entry = {
+                "path": file["path"],
+                "name": file["name"],
+                "type": "reference",
+                "id": file["id"],
+                "uuid": file["uuid"],
+                "version": file["version"],
+                "node": self.node,
+            }
+            logging.info("registering %s", entry)
+
+            # Written in the storing transaction, the registrar sends it after commit
+            fsroot.outbox[file["uuid"]] = outbox_record(entry)
+
+        def _put(self, fsroot, meta, payload, classes=None):
+            """Store an object within the current transaction and return its file pointer
+
+            classes holds the class names already recorded in this transaction, their
+            class entry is only written once per batch
+            """
+            import datetime
+
+            name = meta["class"]
+            path = meta["path"]
+            _uuid = meta["uuid"]
+
+            if not _uuid:
+                raise Exception("Object {} has no uuid".format(meta["id"]))
+
+            if classes is None or name not in classes:
+                # Store the objects class source in the classes registry, only
+                # rewriting it when it changed
+                if fsroot.classes.get(name) != meta["source"]:
+                    fsroot.classes[name] = meta["source"]
+
+                if classes is not None:
+                    classes.add(name)
+
+            data = meta["fields"]
+
+            logging.info("NODE is %s", self.node)
+
+            # A reference points at the node that owns the object
+            node = self.node
+            if meta["type"] == "reference":
+                node = data.get("node") or node
+            elif data.get("node") != node:
+                # The object names the node holding it, as stored ones do
+                data = dict(data, node=node)
+                payload = self._set_node(payload, node)
+
+            # Place the payload in uuids registry for future lookups
+            self._save_payload(fsroot, _uuid, payload)
+
+            # Add the class to the graphql schema if it brings new fields
+            self._make_graphql(name, data)
+
+            # Create the file pointer
+            file = {
+                "date": str(datetime.datetime.now().strftime("%b %d %Y %H:%M:%S")),
+                "path": path,
+                "name": meta["name"],
+                "id": meta["id"],
+                "perms": meta["perms"],
+                "source": meta["source"],
+                "type": meta["type"],
+                "class": name,
+                "size": serialize.size(payload),
+                "node": node,
+                "uuid": _uuid,
+                "obj": data,
+                "version": meta["version"],
+            }
+
+            logging.info("STORE: %s", file)
+            # If the path is already created, set the directory to that path
+            try:
+                directory = self.paths.resolve(fsroot, path)
+                logging.info("Found %s in path cache", path)
+            except KeyError:
+                # Create all the BTree objects for each section in the path
+                paths = path.split("/")[1:]
+                root = fsroot.objects
+                logging.info("store: paths: %s", paths)
+
+                """ Create BTree directories for each subpath if it doesn't exist
+                then set the directory to the last BTree in the path """
+                root, directory = self._make_paths(paths, root, fsroot)
+
+            logging.info("Adding file  %s to directory  [%s]", meta["id"], directory)
+
+            # Add the file pointer to the directory object
+            directory[meta["id"]] = file
+
+            # Add the file pointer to the path registry
+            if path[-1] != "/" and len(meta["name"]) > 0:
+                key = path + "/" + meta["name"]
+            else:
+                key = path + meta["name"]
+
+            fsroot.registry[key] = file
+            logging.info("Adding to registry %s %s", key, file)
+
+            self._changed(fsroot, key, _uuid, file["version"], op="store")
+
+            if not IS_BROKER:
+                self._register(fsroot, file)
+
+            logging.info("3_OBJ str %s %s", _uuid, data)
+
+            # Add the object to the searchable indexes
+            self._index_object(fsroot, _uuid, name, data)
+
+            return file
+
+        def _set_node(self, payload, node):
+            """Return the payload of the object with its node set to node
+
+            An object whose class isn't importable here keeps its payload, only its
+            fields name the node
+            """
+            try:
+                obj = serialize.loads(payload)
+            except Exception as ex:
+                logging.warning("put: can't set node on object %s", ex)
+                return payload
+
+            if not hasattr(obj, "node"):
+                return payload
+
+            obj.node = node
+            return serialize.dumps(obj, oob=type(payload) is list)
 
         def get_data(self, oid):
             """Return the data for an object id"""
@@ -973,10 +1760,24 @@ class Z0DBNodeServer(Server):
 
             return obj.data
 
-    def __init__(self, port=5558):
-        self.rpcport = port
+    def __init__(self, port=RPC_PORT, options=None):
+        self.rpcport = int(port)
+        self.options = options = dict(options or {})
         logging.info("Starting NodeServer on port: {}".format(port))
-        self.api = self.NodeAPI()
+
+        # Nodes sharing a machine need their own ports and name, by default both
+        # are derived from the RPC port
+        options.setdefault("notify_port", self.rpcport - 2)
+        options.setdefault("node", "{}:{}".format(platform.node(), self.rpcport))
+
+        # The host name in the address other nodes call this node at
+        self.host = options.get("host", platform.node())
+
+        self.api = self.NodeAPI(options)
+
+        # The broker listens for nodes saying hello one below its RPC port
+        broker = self.rpcport if IS_BROKER else int(self.api.broker[1])
+        self.port = options.get("hello_port", broker - 1)
 
     def shutdown(self) -> bool:
         import os
@@ -999,36 +1800,37 @@ class Z0DBNodeServer(Server):
 
     def setup(self, options=None) -> bool:
         if options is None:
-            options = {}
-        import socket
-        from contextlib import closing
-
+            options = self.options
         import zerorpc
         import zmq
 
         logging.debug("[NodeServer] Setup...")
 
-        def find_free_port():
-            with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-                s.bind(("", 0))
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                return s.getsockname()[1]
-
-        self.rpcport = find_free_port()
-        self.port = "5557"  # find_free_port()
-        self.bindport = find_free_port()
-        self.rpcport = "5558"  # find_free_port()
-
         def start_rpc():
             """Listen for RPC events"""
+            workers = options.get("workers", 1)
+
+            if workers > 1:
+                # Concurrent clients are served by separate worker threads
+                RPCRouter(self.api, workers).run(
+                    "tcp://0.0.0.0:{}".format(self.rpcport)
+                )
+                return
+
             s = zerorpc.Server(self.api)
             s.bind("tcp://0.0.0.0:{}".format(self.rpcport))
             s.run()
 
+        def rebalance():
+            try:
+                self.api.rebalance()
+            except Exception as ex:
+                logging.error("rebalance: %s", ex)
+            finally:
+                clients.release()
+
         def get_messages():
             import json
-            import os
-            import platform
             from uuid import uuid4
 
             import transaction
@@ -1039,8 +1841,8 @@ class Z0DBNodeServer(Server):
 
             """ Connect to pub/sub address """
 
-            if "BROKER" in os.environ:
-                host = os.environ["BROKER"]
+            if not IS_BROKER:
+                host = self.api.broker[0]
                 self.socket.connect("tcp://{}:{}".format(host, self.port))
             else:
                 host = "0.0.0.0"
@@ -1066,13 +1868,15 @@ class Z0DBNodeServer(Server):
                     fsroot = connection.root()
                     client = zerorpc.Client()
                     client.connect(parts[3])
-                    client.hello("tcp://{}:{}".format(platform.node(), self.rpcport))
+                    client.hello("tcp://{}:{}".format(self.host, self.rpcport))
                     # host = parts[3].split(":")[1].rsplit("/")[-1]
+                    name = parts[2]
                     parse = urlparse(parts[3])
                     host = parse.hostname
                     port = parse.port
 
-                    if IS_BROKER and host != platform.node():
+                    # Nodes are told apart by name, several can share a host
+                    if IS_BROKER and name != self.api.node:
                         # Get registry from parts[3]
                         node = {"address": parts[3]}
                         self.api.fs.nodes[parts[3]] = node
@@ -1082,29 +1886,36 @@ class Z0DBNodeServer(Server):
                         except Exception as ex:
                             logging.error(ex)
 
-                        file = EmergeFile(id=host)
+                        file = EmergeFile(id=name)
                         file.type = "node"
-                        file.name = host
-                        file.path = "/nodes/" + host
+                        file.name = name
+                        file.path = "/nodes/" + name
                         file.size = 0
                         file.uuid = str(uuid4())
                         file.id = parts[3]
                         file.host = host
                         file.port = port
-                        file.node = platform.node()
+                        file.node = self.api.node
 
                         nodes = fsroot.registry["/nodes"]["dir"]
-                        if "/nodes/" + host not in nodes:
-                            nodes["/nodes/" + host] = json.loads(str(file))
+                        if "/nodes/" + name not in nodes:
+                            nodes["/nodes/" + name] = json.loads(str(file))
 
-                        fsroot.registry["/nodes/" + host] = json.loads(str(file))
+                        fsroot.registry["/nodes/" + name] = json.loads(str(file))
                         fsroot.uuids[file.uuid] = json.loads(str(file))
+                        self.api._index_object(
+                            fsroot, file.uuid, "dict", fsroot.uuids[file.uuid]
+                        )
                         logging.info("STORED /NODES dir %s", json.loads(str(file)))
                         transaction.commit()
 
                         registry = client.registry()
                         logging.info("REGISTRY[%s] %s", parts[3], registry)
 
+                        if self.api.placement:
+                            # Objects move to the node the ring now places them on
+                            threading.Thread(target=rebalance, daemon=True).start()
+
         self.process = threading.Thread(target=get_messages)
         self.rpc = threading.Thread(target=start_rpc)
         """ Add filesystem service """
@@ -1128,23 +1939,27 @@ class Z0DBNodeServer(Server):
 
         logging.debug("[NodeServer] start...")
 
-        context = zmq.Context()
-        socket = context.socket(zmq.PUB)
-        socket.connect("tcp://broker:%s" % str(self.port))
-
-        # Receives a string format message
-
         self.process.start()
         self.rpc.start()
 
-        time.sleep(1)
-        import platform
+        if self.api.registrar:
+            self.api.registrar.start()
+
+        self.api.notifier.start()
 
-        message = "NODE HI {} {}".format(
-            platform.node(), "tcp://{}:{}".format(platform.node(), self.rpcport)
-        )
-        logging.info("Sending message: %s", message)
-        socket.send_string(message)
+        if not IS_BROKER:
+            # Say hello to the broker so it adds me to its nodes
+            context = zmq.Context()
+            socket = context.socket(zmq.PUB)
+            socket.connect("tcp://{}:{}".format(self.api.broker[0], self.port))
+
+            time.sleep(1)
+
+            message = "NODE HI {} {}".format(
+                self.api.node, "tcp://{}:{}".format(self.host, self.rpcport)
+            )
+            logging.info("Sending message: %s", message)
+            socket.send_string(message)
 
         [service.start() for service in self.services]
 
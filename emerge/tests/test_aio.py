@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+import pytest
+import zerorpc
+
+
+class API:
+    def echo(self, value):
+        return value
+
+    @zerorpc.stream
+    def count(self, n):
+        return iter(range(n))
+
+    def fail(self):
+        raise Exception("failed")
+
+
+@pytest.fixture(scope="module")
+def address():
+    import socket
+    from contextlib import closing
+
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    ready = threading.Event()
+
+    def serve():
+        server = zerorpc.Server(API())
+        server.bind("tcp://127.0.0.1:{}".format(port))
+        ready.set()
+        server.run()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait(10)
+
+    return "127.0.0.1", port
+
+
+def test_concurrent_calls_and_streams(address):
+    from emerge.core.aio import AsyncClient
+
+    async def main():
+        async with AsyncClient(*address) as fs:
+            results = await asyncio.gather(*[fs.call("echo", i) for i in range(200)])
+            assert results == list(range(200))
+
+            # More results than the stream window
+            assert [i async for i in fs.stream("count", 250)] == list(range(250))
+
+            with pytest.raises(zerorpc.RemoteError):
+                await fs.call("fail")
+
+            assert fs.channels == {}
+
+    asyncio.run(main())
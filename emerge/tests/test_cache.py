@@ -0,0 +1,72 @@
+def test_cache_evicts_least_recently_used_by_size():
+    from emerge.core.cache import ObjectCache
+
+    cache = ObjectCache(100)
+
+    cache.put("/a", "A", 40, cache.token())
+    cache.put("/b", "B", 40, cache.token())
+    assert cache.get("/a") == "A"
+
+    cache.put("/c", "C", 40, cache.token())
+
+    assert cache.get("/b") is None
+    assert cache.get("/a") == "A"
+    assert cache.get("/c") == "C"
+    assert cache.bytes == 80
+
+    cache.put("/big", "BIG", 101, cache.token())
+    assert cache.get("/big") is None
+
+
+def test_cache_invalidate():
+    from emerge.core.cache import ObjectCache
+
+    cache = ObjectCache(100)
+
+    cache.put("/dir/a", "A", 1, cache.token())
+    cache.put("/dir/b", "B", 1, cache.token())
+    cache.put("/dirty", "D", 1, cache.token())
+
+    cache.invalidate("/dir")
+
+    assert cache.get("/dir/a") is None
+    assert cache.get("/dir/b") is None
+    assert cache.get("/dirty") == "D"
+
+    # A change that arrives during a fetch keeps the fetched object out
+    token = cache.token()
+    cache.invalidate("/other")
+    cache.put("/dir/a", "A", 1, token)
+    assert cache.get("/dir/a") is None
+
+
+def test_remote_cache_versions():
+    from emerge.core.cache import RemoteCache
+
+    cache = RemoteCache(10)
+
+    cache.put("a", 0, b"12345")
+    assert cache.get("a", 0) == b"12345"
+    assert cache.get("a", 1) is None
+
+    # A new registration drops every version
+    cache.put("a", 1, [b"12", b"34"])
+    cache.invalidate("a")
+    assert cache.get("a", 0) is None
+    assert cache.get("a", 1) is None
+    assert cache.bytes == 0
+
+    cache.put("b", 0, b"123456")
+    cache.put("c", 0, b"123456")
+    assert cache.get("b", 0) is None
+    assert cache.stats()["entries"] == 1
+
+
+def test_remote_cache_expires():
+    from emerge.core.cache import RemoteCache
+
+    cache = RemoteCache(10, ttl=-1)
+
+    cache.put("a", 0, b"1")
+    assert cache.get("a", 0) is None
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,37 @@
+from click.testing import CliRunner
+
+
+def test_ls_long_stats_large_directories_in_pages():
+    from emerge.cli import ls
+
+    names = ["/big/f{:04d}".format(i) for i in range(2500)] + ["dir:/big/sub"]
+
+    class Client:
+        pages = []
+
+        def list(self, directory, offset=0, size=0):
+            return names
+
+        def stat_many(self, paths):
+            self.pages += [len(paths)]
+            return [
+                {
+                    "perms": "rwxrwxrwx",
+                    "size": 10,
+                    "type": "directory" if path == "/big/sub" else "file",
+                    "version": 0,
+                    "date": "Jan 01 2024 00:00:00",
+                    "name": path.rsplit("/", 1)[1],
+                }
+                for path in paths
+            ]
+
+    client = Client()
+    result = CliRunner().invoke(ls, ["-l", "/big"], obj={"client": client})
+
+    assert result.exit_code == 0, result.output
+    assert client.pages == [1000, 1000, 501]
+
+    rows = result.output.splitlines()
+    assert len(rows) == 2501
+    assert rows[-1].split()[-1] == "f0000"
@@ -4,3 +4,27 @@ def test_client_create():
     client = Client("0.0.0.0", "5558")
 
     assert client is not None
+
+
+def test_store_batch_chunks():
+    from emerge.core.client import StoreBatch
+
+    class Stub:
+        def __init__(self):
+            self.calls = []
+
+        def store_many(self, objs):
+            self.calls += [list(objs)]
+            return [{"error": obj < 0, "id": obj} for obj in objs]
+
+    stub = Stub()
+    batch = StoreBatch(stub, size=2)
+
+    for obj in [1, -2, 3, 4, 5]:
+        batch.store(obj)
+
+    batch.flush()
+
+    assert stub.calls == [[1, -2], [3, 4], [5]]
+    assert len(batch.results) == 5
+    assert batch.errors == [{"error": True, "id": -2}]
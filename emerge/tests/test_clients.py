@@ -0,0 +1,35 @@
+import threading
+
+
+def test_clients_are_reused_per_thread():
+    from emerge.core.pool import ClientPool
+
+    clients = ClientPool()
+
+    client = clients.get("127.0.0.1", 5999)
+    assert clients.get("127.0.0.1", "5999") is client
+
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(clients.get("127.0.0.1", 5999))
+    )
+    thread.start()
+    thread.join()
+    assert other[0] is not client
+
+    clients.discard("127.0.0.1", 5999)
+    assert clients.get("127.0.0.1", 5999) is not client
+
+    assert clients.stats()["hits"] == 1
+    assert clients.stats()["misses"] == 3
+    assert clients.stats()["failed"] == 1
+
+
+def test_idle_clients_are_evicted():
+    from emerge.core.pool import ClientPool
+
+    clients = ClientPool(idle=-1)
+
+    client = clients.get("127.0.0.1", 5999)
+    assert clients.get("127.0.0.1", 5999) is not client
+    assert clients.stats()["evicted"] == 1
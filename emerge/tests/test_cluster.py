@@ -0,0 +1,150 @@
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+
+import pytest
+
+from emerge.core.objects import EmergeFile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@dataclass
+class Counter(EmergeFile):
+    n: int = 0
+
+    def bump(self):
+        self.n += 100
+        return self.n
+
+
+def start(tmp_path, name, port, environ):
+    """Start a node process in its own directory, it keeps its database there"""
+    directory = tmp_path / name
+    directory.mkdir()
+
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in ["ISBROKER", "BROKER"]
+    }
+    env.update(environ, PYTHONPATH=ROOT)
+
+    with open(directory / "node.log", "w") as log:
+        return subprocess.Popen(
+            [sys.executable, "-c", "from emerge.cli import cli; cli()"]
+            + ["node", "start", "-p", str(port), "--host", "127.0.0.1"],
+            cwd=directory,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+
+
+def free_ports():
+    """Return a port the broker and two nodes 10 apart can count their ports from
+
+    Ports are picked below the range the system hands out to outgoing connections
+    """
+    while True:
+        port = random.randrange(10000, 30000, 10)
+
+        try:
+            for offset in range(-2, 21):
+                with socket.socket() as s:
+                    s.bind(("0.0.0.0", port + offset))
+        except OSError:
+            continue
+
+        return port
+
+
+@pytest.fixture
+def cluster(tmp_path):
+    """A broker and two nodes sharing this machine, returns the broker's port"""
+    from emerge.core.client import Z0RPCClient as Client
+
+    port = free_ports()
+
+    processes = [start(tmp_path, "broker", port, {"ISBROKER": "1"})]
+    broker = Client("127.0.0.1", port)
+
+    try:
+        # Nodes only say hello once, so the broker has to be listening first
+        broker.client.hello("test", timeout=30)
+
+        for i in range(1, 3):
+            processes += [
+                start(
+                    tmp_path,
+                    "node{}".format(i),
+                    port + 10 * i,
+                    {"BROKER": "127.0.0.1:{}".format(port)},
+                )
+            ]
+
+        deadline = time.monotonic() + 30
+        while len(broker.nodes()) < 2:
+            assert time.monotonic() < deadline, "nodes didn't join the broker"
+            time.sleep(0.2)
+
+        yield port
+    finally:
+        broker.close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def test_run_is_replicated(cluster):
+    from emerge.core.client import ClusterClient
+    from emerge.core.client import Z0RPCClient as Client
+
+    client = ClusterClient("127.0.0.1", cluster, replicas=2)
+    addresses = client.nodes()
+
+    # Both nodes joined although they share a host
+    assert sorted(addresses) == [
+        "tcp://127.0.0.1:{}".format(cluster + 10),
+        "tcp://127.0.0.1:{}".format(cluster + 20),
+    ]
+
+    client.store(Counter(id="c", name="c", path="/counters"))
+
+    assert client.run("/counters/c", "bump") == 100
+
+    for port in [cluster + 10, cluster + 20]:
+        node = Client("127.0.0.1", port)
+        try:
+            assert node.get("/counters/c")["version"] == 2
+            assert node.getobject("/counters/c", False).n == 100
+        finally:
+            node.close()
+
+
+def test_run_on_directory_reaches_every_node(cluster):
+    import json
+
+    from emerge.core.client import ClusterClient
+    from emerge.core.client import Z0RPCClient as Client
+
+    client = ClusterClient("127.0.0.1", cluster)
+
+    names = ["c{}".format(i) for i in range(10)]
+    client.store_many([Counter(id=name, name=name, path="/counters") for name in names])
+
+    # The ring spread the directory over both nodes
+    for port in [cluster + 10, cluster + 20]:
+        node = Client("127.0.0.1", port)
+        try:
+            assert 0 < node.get("/counters")["size"] < 10
+        finally:
+            node.close()
+
+    assert client.run("/counters", "bump") == [100] * 10
+    assert sorted(json.loads(client.getobject("/counters", False))) == names
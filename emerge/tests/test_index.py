@@ -0,0 +1,41 @@
+def make_index():
+    from types import SimpleNamespace
+
+    import BTrees.OOBTree
+
+    from emerge.fs.index import FieldIndex
+
+    fsroot = SimpleNamespace(
+        indexes=BTrees.OOBTree.BTree(), indexed=BTrees.OOBTree.BTree()
+    )
+    return FieldIndex(fsroot)
+
+
+def test_index_lookup_and_range():
+    index = make_index()
+
+    index.index_object("a", {"name": "widget", "price": 5, "words": ["x"]})
+    index.index_object("b", {"name": "gadget", "price": 7.5})
+    index.index_object("c", {"name": "widget", "price": 10})
+
+    assert index.lookup("name", "widget") == {"a", "c"}
+    assert index.lookup("price", 7.5) == {"b"}
+    assert index.lookup("words", ["x"]) == set()
+    assert index.range("price", low=6) == {"b", "c"}
+    assert index.range("price", high=7.5, excludehigh=True) == {"a"}
+    assert index.range("name", low="h") == {"a", "c"}
+
+
+def test_index_reindex_and_unindex():
+    index = make_index()
+
+    index.index_object("a", {"name": "widget", "price": 5})
+    index.index_object("a", {"name": "gadget", "price": 5})
+
+    assert index.lookup("name", "widget") == set()
+    assert index.lookup("name", "gadget") == {"a"}
+
+    index.unindex_object("a")
+
+    assert index.lookup("price", 5) == set()
+    assert list(index.items("name")) == []
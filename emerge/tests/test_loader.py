@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+
+def field_nodes(query):
+    from graphql import parse
+
+    return parse(query).definitions[0].selection_set.selections
+
+
+def test_selected_fields():
+    from emerge.node.loader import selected_fields
+
+    fields = ["uuid", "name", "price"]
+
+    info = SimpleNamespace(field_nodes=field_nodes("{ a { price __typename name } }"))
+    assert selected_fields(info, fields) == ["price", "name"]
+
+    info = SimpleNamespace(field_nodes=field_nodes("{ a { ...on A { name } } }"))
+    assert selected_fields(info, fields) == fields
+
+
+def test_loader_caches_objects():
+    from emerge.node.loader import ObjectLoader
+
+    loads = []
+
+    class API:
+        fs = SimpleNamespace(
+            pool=SimpleNamespace(checkout=lambda: SimpleNamespace(root=lambda: None))
+        )
+
+        def _load_object(self, fsroot, uuid):
+            loads.append(uuid)
+            return uuid.upper()
+
+    loader = ObjectLoader(API())
+
+    assert loader.load_many(["a", "b"]) == ["A", "B"]
+    assert loader.load_many(["b", "c"]) == ["B", "C"]
+    assert loads == ["a", "b", "c"]
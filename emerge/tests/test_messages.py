@@ -0,0 +1,108 @@
+import pytest
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    import emerge.zmq.message
+
+    connection = fakeredis.FakeRedis()
+    monkeypatch.setattr(emerge.zmq.message, "redis_connection", connection)
+
+    return connection
+
+
+def test_read_marker_expires_with_message(redis):
+    from emerge.zmq.message import (
+        get_msgs_with_read_state,
+        get_topic_msg_read_key,
+        mark_msgs_as_read,
+        write_msg,
+    )
+
+    write_msg("news", "1", "hello", ttl=60)
+    write_msg("news", "2", "world", ttl=60)
+
+    assert get_msgs_with_read_state("news", ["1", "2", "3"], "sub") == [
+        ("1", False, b"hello"),
+        ("2", False, b"world"),
+        ("3", False, None),
+    ]
+
+    mark_msgs_as_read("news", ["1", "3"], "sub")
+
+    assert 0 < redis.ttl(get_topic_msg_read_key("news", "1", "sub")) <= 60
+    assert not redis.exists(get_topic_msg_read_key("news", "3", "sub"))
+    assert [
+        read for _, read, _ in get_msgs_with_read_state("news", ["1", "2"], "sub")
+    ] == [
+        True,
+        False,
+    ]
+
+
+def test_pending_messages_are_processed_once(redis, monkeypatch):
+    import emerge.zmq.subscriber as subscriber
+    from emerge.zmq.message import write_msg
+
+    for i in range(1200):
+        write_msg("news", str(i), "message {}".format(i))
+
+    received = []
+    monkeypatch.setattr(subscriber, "sub_id", "sub")
+    monkeypatch.setattr(
+        subscriber, "process_raw_msg", lambda topic, msg: received.append(msg)
+    )
+
+    subscriber.process_pending_msgs("news")
+    assert len(received) == 1200
+    assert len(set(received)) == 1200
+
+    subscriber.process_pending_msgs("news")
+    assert len(received) == 1200
+
+
+@pytest.fixture
+def streams(redis, monkeypatch):
+    import emerge.zmq.settings
+    import emerge.zmq.streams
+
+    monkeypatch.setattr(emerge.zmq.streams, "redis_connection", redis)
+    monkeypatch.setattr(emerge.zmq.settings, "MSG_BACKEND", "streams")
+
+    return redis
+
+
+def test_stream_replays_in_order_from_each_offset(streams, monkeypatch):
+    import emerge.zmq.subscriber as subscriber
+    from emerge.zmq.streams import add_msg, create_group, read_msgs
+
+    create_group("news", "late")
+    for i in range(1200):
+        add_msg("news", "message {}".format(i))
+
+    received = []
+    monkeypatch.setattr(subscriber, "sub_id", "early")
+    monkeypatch.setattr(
+        subscriber, "process_raw_msg", lambda topic, msg: received.append(msg)
+    )
+
+    subscriber.process_pending_stream_msgs("news")
+    assert received == ["message {}".format(i).encode() for i in range(1200)]
+
+    add_msg("news", "more")
+    subscriber.process_stream_msgs("news")
+    assert received[1200:] == [b"more"]
+
+    # The other group keeps its own offset, unacknowledged messages come back
+    assert len(read_msgs("news", "late", count=10)) == 10
+    assert len(read_msgs("news", "late", pending=True, count=100)) == 10
+
+
+def test_stream_is_trimmed(streams):
+    from emerge.zmq.streams import add_msg, get_topic_stream_key
+
+    for i in range(500):
+        add_msg("news", "message {}".format(i), maxlen=100)
+
+    assert streams.xlen(get_topic_stream_key("news")) < 500
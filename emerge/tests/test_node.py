@@ -0,0 +1,414 @@
+from dataclasses import dataclass
+
+import pytest
+
+from emerge.core.objects import EmergeFile
+
+
+@dataclass
+class Item(EmergeFile):
+    n: int = 0
+
+    def bump(self):
+        self.n += 100
+        return self.n
+
+    def peek(self):
+        return self.n
+
+
+@dataclass
+class Part(EmergeFile):
+    weight: float = 0.0
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.setenv("ISBROKER", "1")
+    monkeypatch.chdir(tmp_path)
+
+    from emerge.node.server import NodeServer
+
+    api = NodeServer.NodeAPI()
+    yield api
+    api.fs.db.close()
+
+
+def items(*names, path="/inv"):
+    from emerge.core.client import _pack
+
+    return [
+        _pack(Item(id=name, name=name, path=path, n=i)) for i, name in enumerate(names)
+    ]
+
+
+def test_put_many_reports_failed_objects(api):
+    api.put_many(items("a"))
+
+    good = items("b", "c")
+    # A path through a file and an object without a uuid
+    bad = items("x", path="/inv/a") + items("y")
+    bad[1][0]["uuid"] = ""
+
+    results = api.put_many([good[0], bad[0], good[1], bad[1]])
+
+    assert [(r["id"], r["error"]) for r in results] == [
+        ("b", False),
+        ("x", True),
+        ("c", False),
+        ("y", True),
+    ]
+    assert "no uuid" in results[3]["message"]
+    assert sorted(api.listpage("/inv")["files"]) == ["/inv/a", "/inv/b", "/inv/c"]
+
+
+def test_store_many_keeps_the_order_of_legacy_payloads(api):
+    import dill
+
+    def legacy(name):
+        return [
+            name,
+            "/inv",
+            name,
+            "",
+            dill.dumps(Item(id=name, name=name, path="/inv")),
+        ]
+
+    # A payload that doesn't unpack fails before the others are stored
+    results = api.store_many(
+        [["x", "/inv", "x", "", b"garbage"], legacy("d"), legacy("e")]
+    )
+
+    assert [(r["id"], r["error"]) for r in results] == [
+        ("x", True),
+        ("d", False),
+        ("e", False),
+    ]
+    assert sorted(api.listpage("/inv")["files"]) == ["/inv/d", "/inv/e"]
+
+
+def test_registrar_keeps_rejected_registrations(api):
+    from emerge.node.registrar import Registrar, outbox_record
+
+    with api.fs.connect() as connection:
+        with connection.transaction_manager:
+            for uuid in ["good", "bad", "later"]:
+                connection.root().outbox[uuid] = outbox_record({"uuid": uuid})
+
+    class Broker:
+        def register_many(self, entries):
+            return [
+                {"error": entry["uuid"] == "bad", "id": entry["uuid"]}
+                for entry in entries
+            ]
+
+    registrar = Registrar(api.fs, "broker", size=2)
+
+    assert registrar.flush(Broker()) == 2
+    assert registrar.rejected == 1
+
+    with api.fs.connect() as connection:
+        assert list(connection.root().outbox.keys()) == ["bad"]
+
+
+def test_registrar_sends_in_order_and_retries(api):
+    from emerge.node.registrar import Registrar
+
+    # Keyed by uuid, sent in the order the registrations were made
+    with api.fs.connect() as connection:
+        with connection.transaction_manager:
+            for time, uuid in [(3, "a"), (1, "c"), (2, "b"), (4, "d")]:
+                connection.root().outbox[uuid] = {
+                    "time": time,
+                    "entry": {"uuid": uuid},
+                }
+
+    class Broker:
+        def __init__(self, reject=(), newer=False):
+            self.reject = reject
+            self.newer = newer
+            self.sent = []
+
+        def register_many(self, entries):
+            self.sent += [entry["uuid"] for entry in entries]
+
+            # A newer registration of d is made while its batch is being sent
+            if self.newer and "d" in self.sent[-len(entries) :]:
+                with api.fs.connect() as connection:
+                    with connection.transaction_manager:
+                        connection.root().outbox["d"] = {
+                            "time": 5,
+                            "entry": {"uuid": "d", "version": 1},
+                        }
+
+            return [
+                {"error": entry["uuid"] in self.reject, "id": entry["uuid"]}
+                for entry in entries
+            ]
+
+    registrar = Registrar(api.fs, "broker", size=3)
+
+    broker = Broker(reject=["b"], newer=True)
+    assert registrar.flush(broker) == 3
+    assert broker.sent == ["c", "b", "a", "d"]
+    assert registrar.rejected == 1
+
+    # The rejected entry and the newer registration are sent again
+    broker = Broker()
+    assert registrar.flush(broker) == 2
+    assert broker.sent == ["b", "d"]
+    assert registrar.rejected == 0
+
+    with api.fs.connect() as connection:
+        assert len(connection.root().outbox) == 0
+
+
+def test_search_sees_execute_changes(api):
+    from emerge.core.query import field
+
+    api.put_many(items("a", "b", "c"))
+
+    assert api.execute("/inv/b", "bump") == 101
+
+    found = api.search((field("n") > 50).to_list())
+    assert [obj["name"] for obj in found] == ["b"]
+    assert sorted(obj["name"] for obj in api.search((field("n") < 3).to_list())) == [
+        "a",
+        "c",
+    ]
+
+    with api.fs.connect() as connection:
+        fsroot = connection.root()
+        assert fsroot.registry["/inv/b"]["obj"]["n"] == 101
+        assert fsroot.objects["inv"]["dir"]["b"]["obj"]["n"] == 101
+
+        # Written back under a new version, in the pointer and the object
+        assert fsroot.registry["/inv/b"]["version"] == 1
+        assert fsroot.registry["/inv/a"]["version"] == 0
+    assert api.getobject("/inv/b", True).version == 1
+
+
+def test_restart_without_object_classes(api, tmp_path, monkeypatch):
+    import sys
+
+    from emerge.core.client import _pack
+    from emerge.node.server import NodeServer
+
+    modules = tmp_path / "modules"
+    modules.mkdir()
+    (modules / "gizmo.py").write_text(
+        "from dataclasses import dataclass\n"
+        "from emerge.core.objects import EmergeFile\n"
+        "@dataclass\n"
+        "class Gizmo(EmergeFile):\n"
+        "    size: int = 0\n"
+    )
+
+    monkeypatch.syspath_prepend(str(modules))
+    import gizmo
+
+    api.put(*_pack(gizmo.Gizmo(id="g", name="g", path="/gizmos", size=3)))
+    api.fs.db.close()
+
+    # The node restarts where the class isn't importable
+    monkeypatch.delitem(sys.modules, "gizmo")
+    sys.path.remove(str(modules))
+
+    restarted = NodeServer.NodeAPI()
+    try:
+        assert restarted.types["Gizmo"]["types"]["size"].__name__ == "Int"
+    finally:
+        restarted.fs.db.close()
+
+
+def test_search_sees_parallel_execute_changes(api):
+    from emerge.compute import parallel
+    from emerge.core.query import field
+
+    api.put_many(items("a", "b", "c"))
+
+    assert sorted(api.execute("/inv", "bump", parallel=True)) == [100, 101, 102]
+
+    assert sorted(obj["name"] for obj in api.search((field("n") > 50).to_list())) == [
+        "a",
+        "b",
+        "c",
+    ]
+    assert api.search((field("n") < 3).to_list()) == []
+    assert [api.get("/inv/" + name)["version"] for name in "abc"] == [1, 1, 1]
+    assert api.getobject("/inv/c", True).version == 1
+
+    parallel.pool.shutdown()
+    parallel.pool = None
+
+
+def test_listpage_rejects_empty_pages(api):
+    api.put_many(items("a", "b"))
+
+    with pytest.raises(ValueError):
+        api.listpage("/inv", size=0)
+
+    with pytest.raises(ValueError):
+        list(api.liststream("/inv", 0))
+
+    assert list(api.liststream("/inv", 1)) == ["/inv/a", "/inv/b"]
+
+
+def test_changes_are_recorded_once_per_transaction(api):
+    api.mkdir("/inv")
+    api.put_many(items("a", "b", "c"))
+
+    with pytest.raises(Exception):
+        api.mkdir("/inv")
+
+    with api.fs.connect() as connection:
+        records = list(connection.root().unpublished.values())
+
+    assert [[change["op"] for change in r["changes"]] for r in records] in (
+        [["mkdir"], ["store", "store", "store"]],
+        [["store", "store", "store"], ["mkdir"]],
+    )
+
+    changes = list(api.notifier.flush())
+    assert [(c["seq"], c["op"]) for c in changes] == [
+        (1, "mkdir"),
+        (2, "store"),
+        (3, "store"),
+        (4, "store"),
+    ]
+    assert api.changes(2)["seq"] == 4
+
+
+def test_concurrent_writers(api):
+    import threading
+
+    from emerge.core.query import field
+
+    errors = []
+
+    def writer(thread):
+        try:
+            names = ["t{}-{}".format(thread, i) for i in range(30)]
+            for obj in items(*names):
+                api.put(*obj)
+            api.put_many(items(*[name + "-batch" for name in names[:10]]))
+            api.execute("/inv/" + names[0], "bump")
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(list(api.liststream("/inv"))) == 160
+    assert len(api.search((field("n") >= 100).to_list())) == 4
+
+
+def test_execute_registers_changed_objects_again(api, monkeypatch):
+    from emerge.node import server
+
+    api.put_many(items("a", "b"))
+
+    monkeypatch.setattr(server, "IS_BROKER", False)
+    api.execute("/inv/b", "bump")
+    assert api.execute("/inv/a", "peek") == 0
+
+    with api.fs.connect() as connection:
+        fsroot = connection.root()
+        uuid = fsroot.registry["/inv/b"]["uuid"]
+
+        assert list(fsroot.outbox.keys()) == [uuid]
+
+
+def test_concurrent_new_classes(api, tmp_path, monkeypatch):
+    import threading
+
+    from emerge.core.client import _pack
+
+    modules = tmp_path / "modules"
+    modules.mkdir()
+    (modules / "kinds.py").write_text(
+        "from dataclasses import dataclass\n"
+        "from emerge.core.objects import EmergeFile\n"
+        + "".join(
+            "@dataclass\n"
+            "class Kind{0}(EmergeFile):\n"
+            "    size{0}: int = 0\n".format(i)
+            for i in range(6)
+        )
+    )
+
+    monkeypatch.syspath_prepend(str(modules))
+    import kinds
+
+    errors = []
+
+    def writer(thread):
+        try:
+            cls = getattr(kinds, "Kind{}".format(thread))
+            for i in range(5):
+                name = "k{}-{}".format(thread, i)
+                api.put(*_pack(cls(id=name, name=name, path="/kinds")))
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+
+    query = str(api.schema)
+    for i in range(6):
+        assert "Kind{}".format(i) in api.types
+        assert "Kind{}List".format(i) in query
+
+
+def test_put_names_the_node(api):
+    from emerge.core.query import field
+
+    api.put_many(items("a"))
+    api.put(*items("b")[0])
+
+    assert api.node
+    assert [obj["node"] for obj in api.search((field("n") >= 0).to_list())] == [
+        api.node,
+        api.node,
+    ]
+    assert api.getobject("/inv/b", True).node == api.node
+
+
+def test_stat_many(api):
+    api.put_many(items("a", "b"))
+
+    stats = api.stat_many(["/inv/b", "/inv", "/inv/missing", "/inv/a"])
+
+    assert [(s.get("type"), s.get("name")) for s in stats] == [
+        ("file", "b"),
+        ("directory", "/inv"),
+        (None, None),
+        ("file", "a"),
+    ]
+    assert stats[1]["size"] == 2
+    assert stats[2] == {"error": True, "message": "Path not found"}
+    assert stats[0] == api.get("/inv/b")
+
+
+def test_second_class_keeps_the_first_in_the_schema(api):
+    from emerge.core.client import _pack
+
+    api.put_many(items("a", "b"))
+    api.put(*_pack(Part(id="p", name="p", path="/parts", weight=1.5)))
+
+    assert api.types["Item"]["types"]["n"].__name__ == "Int"
+    assert api.types["Part"]["types"]["weight"].__name__ == "Float"
+
+    result = api.graphql("{ ItemList { name n } PartList { name weight } }", False)
+
+    assert sorted(item["name"] for item in result["ItemList"]) == ["a", "b"]
+    assert result["PartList"] == [{"name": "p", "weight": 1.5}]
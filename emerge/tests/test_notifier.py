@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import BTrees.LOBTree
+import BTrees.OOBTree
+import transaction
+import ZODB
+
+
+def test_notifier_numbers_committed_changes():
+    from emerge.node.notifier import Notifier
+
+    db = ZODB.DB(None)
+    tx_mgr = transaction.TransactionManager()
+    connection = db.open(tx_mgr)
+    fsroot = connection.root()
+
+    with tx_mgr:
+        fsroot.unpublished = BTrees.OOBTree.BTree()
+        fsroot.changes = BTrees.LOBTree.BTree()
+
+    def record(txn, time, *paths):
+        fsroot.unpublished[txn] = {
+            "time": time,
+            "changes": [{"op": "store", "path": path, "txn": txn} for path in paths],
+        }
+
+    # Keyed by transaction, numbered in commit order
+    with tx_mgr:
+        record("b", 2, "/b0", "/b1")
+        record("a", 1, "/a0")
+        record("c", 3, "/c0", "/c1")
+
+    # Aborted changes are never published
+    tx_mgr.begin()
+    record("aborted", 0, "/aborted")
+    tx_mgr.abort()
+
+    notifier = Notifier(SimpleNamespace(db=db), size=2, keep=3)
+
+    changes = list(notifier.flush())
+    assert [(c["seq"], c["path"]) for c in changes] == [
+        (1, "/a0"),
+        (2, "/b0"),
+        (3, "/b1"),
+        (4, "/c0"),
+        (5, "/c1"),
+    ]
+
+    with tx_mgr:
+        record("d", 4, "/d0")
+
+    assert [c["seq"] for c in notifier.flush()] == [6]
+
+    tx_mgr.begin()
+    assert len(fsroot.unpublished) == 0
+    assert list(fsroot.changes.keys()) == [4, 5, 6]
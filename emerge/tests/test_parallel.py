@@ -0,0 +1,47 @@
+from dataclasses import dataclass
+
+from emerge.core.objects import EmergeFile, readonly
+
+
+@dataclass
+class Counter(EmergeFile):
+    count: int = 0
+
+    def peek(self):
+        return self.count
+
+    def bump(self):
+        self.count += 1
+        return self.count
+
+    @readonly
+    def scratch(self):
+        self.count = -1
+        return self.count
+
+
+def test_call_returns_changed_state_only():
+    from emerge.compute.parallel import call
+    from emerge.core import serialize
+
+    payload = serialize.dumps(Counter(id="c", name="c", count=1))
+
+    assert call(payload, "peek") == (True, 1, None, None)
+    assert call(payload, "missing") == (False, None, None, None)
+    assert call(payload, "scratch") == (True, -1, None, None)
+
+    called, result, after, fields = call(payload, "bump")
+    assert (called, result) == (True, 2)
+    assert serialize.loads(after).count == 2
+    assert fields["count"] == 2
+
+
+def test_call_keeps_out_of_band_format():
+    from emerge.compute.parallel import call
+    from emerge.core import serialize
+
+    frames = serialize.dumps(Counter(id="c", name="c", count=1), oob=True)
+
+    called, result, after, fields = call(frames, "bump")
+    assert type(after) is list
+    assert serialize.loads(after).count == 2
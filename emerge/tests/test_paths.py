@@ -0,0 +1,57 @@
+def make_root():
+    import BTrees.OOBTree
+    import transaction
+    import ZODB
+
+    db = ZODB.DB(None)
+    connection = db.open()
+    fsroot = connection.root()
+    fsroot.objects = BTrees.OOBTree.BTree()
+
+    inner = BTrees.OOBTree.BTree()
+    inner["file"] = {"type": "file", "uuid": "u1"}
+    outer = BTrees.OOBTree.BTree()
+    outer["inner"] = {"type": "directory", "dir": inner}
+    fsroot.objects["outer"] = {"type": "directory", "dir": outer}
+    transaction.commit()
+
+    return db, fsroot, inner
+
+
+def test_resolve_caches_directories():
+    import pytest
+
+    from emerge.fs.paths import PathCache
+
+    db, fsroot, inner = make_root()
+    paths = PathCache()
+
+    assert paths.resolve(fsroot, "/") is fsroot.objects
+    assert paths.resolve(fsroot, "/outer/inner/") is inner
+    assert set(paths.entries) == {"/outer", "/outer/inner"}
+
+    # Another connection gets its own copy from the cached oid
+    other = db.open().root()
+    resolved = paths.resolve(other, "/outer/inner")
+    assert resolved is not inner
+    assert resolved._p_oid == inner._p_oid
+
+    with pytest.raises(NotADirectoryError):
+        paths.resolve(fsroot, "/outer/inner/file")
+
+    with pytest.raises(KeyError):
+        paths.resolve(fsroot, "/outer/missing")
+
+
+def test_invalidate_drops_subpaths():
+    from emerge.fs.paths import PathCache
+
+    db, fsroot, inner = make_root()
+    paths = PathCache(size=1)
+
+    paths.resolve(fsroot, "/outer/inner")
+    assert list(paths.entries) == ["/outer/inner"]
+
+    paths.resolve(fsroot, "/outer")
+    paths.invalidate("/outer")
+    assert len(paths.entries) == 0
@@ -0,0 +1,47 @@
+from collections import Counter
+
+
+def test_ring_spreads_keys_and_moves_few():
+    from emerge.core.placement import HashRing
+
+    keys = ["/inventory/item{}".format(i) for i in range(3000)]
+
+    ring = HashRing(["tcp://a:5558", "tcp://b:5558", "tcp://c:5558"])
+    before = {key: ring.owner(key) for key in keys}
+
+    assert min(Counter(before.values()).values()) > 600
+
+    # Only keys taken over by the new node move
+    ring.add("tcp://d:5558")
+    moved = [key for key in keys if ring.owner(key) != before[key]]
+    assert {ring.owner(key) for key in moved} == {"tcp://d:5558"}
+    assert len(moved) < 1200
+
+    ring.remove("tcp://d:5558")
+    assert {key: ring.owner(key) for key in keys} == before
+
+
+def test_ring_owners():
+    from emerge.core.placement import HashRing
+
+    assert HashRing().owner("/a") is None
+
+    ring = HashRing(["a", "b", "c"])
+    owners = ring.owners_of("/a", 2)
+    assert len(set(owners)) == 2 and owners[0] == ring.owner("/a")
+    assert sorted(ring.owners_of("/a", 5)) == ["a", "b", "c"]
+
+
+def test_quorum():
+    import pytest
+
+    from emerge.core.client import _gather, _quorum
+
+    def fail():
+        raise Exception("down")
+
+    assert _quorum([lambda: 1, fail, lambda: 3], 2) == [1, 3]
+    assert _gather([lambda: 1, fail]) == [1, None]
+
+    with pytest.raises(Exception, match="1 of 3 replicas succeeded, 2 needed"):
+        _quorum([fail, lambda: 2, fail], 2)
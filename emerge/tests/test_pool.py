@@ -0,0 +1,57 @@
+import threading
+
+import transaction
+import ZODB
+
+
+def test_pool_reuses_connections():
+    from emerge.fs.filesystem import ConnectionPool
+
+    pool = ConnectionPool(ZODB.DB(None), size=1)
+
+    with pool.connection() as connection:
+        with connection.transaction_manager:
+            connection.root().value = 1
+
+    with pool.connection() as again:
+        assert again is connection
+        assert again.root().value == 1
+
+        # Uncommitted changes are discarded on checkin
+        again.root().value = 2
+
+    with pool.connection() as again:
+        assert again.root().value == 1
+
+        # Only size connections are kept idle
+        other = pool.checkout()
+        assert other is not again
+        pool.checkin(other)
+
+    stats = pool.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["idle"] == 1
+
+
+def test_pool_is_per_thread():
+    from emerge.fs.filesystem import ConnectionPool
+
+    pool = ConnectionPool(ZODB.DB(None))
+    pool.checkin(pool.checkout())
+
+    seen = []
+
+    def worker():
+        with pool.connection() as connection:
+            seen.append(connection)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+
+    with pool.connection() as connection:
+        assert connection is not seen[0]
+        assert isinstance(
+            connection.transaction_manager, transaction.TransactionManager
+        )
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+
+class Index:
+    """Answers lookups from a list of objects like the field indexes would"""
+
+    def __init__(self, objs):
+        self.objs = objs
+
+    def lookup(self, field, value):
+        return {o.uuid for o in self.objs if getattr(o, field, None) == value}
+
+    def range(self, field, low=None, high=None, excludelow=False, excludehigh=False):
+        uuids = set()
+        for o in self.objs:
+            value = getattr(o, field, None)
+            if low is not None and (value < low or excludelow and value == low):
+                continue
+            if high is not None and (value > high or excludehigh and value == high):
+                continue
+            uuids.add(o.uuid)
+        return uuids
+
+
+objs = [
+    SimpleNamespace(uuid="a", name="widget", price=5, tags=["x"]),
+    SimpleNamespace(uuid="b", name="gadget", price=10, tags=["y"]),
+    SimpleNamespace(uuid="c", name="widget", price=20, tags=["x", "y"]),
+]
+
+
+def test_predicate_round_trip():
+    from emerge.core.query import Predicate, field
+
+    where = (field("price") < 10) & ~(field("name") == "gadget")
+
+    assert where.to_list() == [
+        "and",
+        ["<", "price", 10],
+        ["not", ["==", "name", "gadget"]],
+    ]
+    assert Predicate.from_list(where.to_list()).to_list() == where.to_list()
+
+
+def test_plan_uses_indexes():
+    from emerge.core.query import field, plan
+
+    uuids, residual = plan(
+        ((field("name") == "widget") & (field("price") >= 10)).to_list(), Index(objs)
+    )
+    assert uuids == {"c"}
+    assert residual is None
+
+    uuids, residual = plan(
+        ((field("name") == "widget") & field("tags").contains("y")).to_list(),
+        Index(objs),
+    )
+    assert uuids == {"a", "c"}
+    assert residual == ["contains", "tags", "y"]
+
+    uuids, residual = plan(
+        ((field("price") == 5) | field("tags").contains("y")).to_list(), Index(objs)
+    )
+    assert uuids is None
+
+
+def test_evaluate():
+    from emerge.core.query import evaluate, field
+
+    where = ((field("price") > 5) & field("tags").contains("y")).to_list()
+
+    assert [o.uuid for o in objs if evaluate(where, o)] == ["b", "c"]
+    assert evaluate(["<", "missing", 1], objs[0]) is False
+    assert evaluate(["<", "name", 1], objs[0]) is False
@@ -0,0 +1,74 @@
+def test_clients_are_pinned_to_workers():
+    from emerge.node.router import RPCRouter
+
+    router = RPCRouter(None, 3, clients=3)
+
+    assert [router.worker(client) for client in [b"a", b"b", b"c", b"a"]] == [
+        0,
+        1,
+        2,
+        0,
+    ]
+
+    # The quietest client is forgotten once there are too many
+    assert router.worker(b"d") == 0
+    assert b"b" not in router.assigned
+    assert router.worker(b"a") == 0
+
+
+def test_clients_are_served_by_different_workers():
+    import socket
+    import threading
+
+    import gevent
+    import zerorpc
+
+    from emerge.node.router import RPCRouter
+
+    class API:
+        def whoami(self, tag):
+            gevent.sleep(0.01)
+            return [tag, threading.current_thread().name]
+
+        @zerorpc.stream
+        def count(self, tag, n):
+            for i in range(n):
+                gevent.sleep(0.001)
+                yield [tag, i]
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    router = RPCRouter(API(), 3)
+    threading.Thread(
+        target=router.run, args=("tcp://127.0.0.1:{}".format(port),), daemon=True
+    ).start()
+
+    clients = []
+    for tag in ["a", "b", "c"]:
+        client = zerorpc.Client(timeout=10)
+        client.connect("tcp://127.0.0.1:{}".format(port))
+        clients += [(tag, client)]
+
+    def talk(tag, client):
+        workers = set()
+        for _ in range(5):
+            _tag, worker = client.whoami(tag)
+            assert _tag == tag
+            workers.add(worker)
+
+        assert list(client.count(tag, 20)) == [[tag, i] for i in range(20)]
+        return workers
+
+    try:
+        jobs = [gevent.spawn(talk, tag, client) for tag, client in clients]
+        gevent.joinall(jobs, raise_error=True)
+    finally:
+        for tag, client in clients:
+            client.close()
+
+    # Each client stays on one worker and no two share one
+    workers = [job.value for job in jobs]
+    assert [len(_workers) for _workers in workers] == [1, 1, 1]
+    assert len(set.union(*workers)) == 3
@@ -0,0 +1,26 @@
+def test_merge_orders_and_limits():
+    from emerge.node.scatter import merge
+
+    rows = [{"price": 3}, {"price": 1.5}, {"name": "none"}, "text", {"price": 2}]
+
+    assert merge(rows, "price") == [
+        {"price": 1.5},
+        {"price": 2},
+        {"price": 3},
+        {"name": "none"},
+        "text",
+    ]
+    assert merge(rows, "-price", 2) == [{"price": 3}, {"price": 2}]
+    assert merge(rows, None, 1) == [{"price": 3}]
+
+
+def test_merge_data():
+    from emerge.node.scatter import merge_data
+
+    assert merge_data(
+        [
+            None,
+            {"ItemList": [{"name": "a"}], "Item": None},
+            {"ItemList": [{"name": "b"}], "Item": {"name": "b"}},
+        ]
+    ) == {"ItemList": [{"name": "a"}, {"name": "b"}], "Item": {"name": "b"}}
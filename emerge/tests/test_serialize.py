@@ -0,0 +1,32 @@
+def test_oob_round_trip():
+    from emerge.core import serialize
+
+    obj = {"name": "blob", "data": b"x" * serialize.OOB_THRESHOLD, "small": b"y"}
+
+    frames = serialize.dumps(obj, oob=True)
+
+    assert len(frames) == 2
+    assert serialize.size(frames) > serialize.OOB_THRESHOLD
+    assert serialize.loads([bytes(frame) for frame in frames]) == obj
+    assert serialize.loads(serialize.dumps(obj)) == obj
+
+
+def test_meta_leaves_out_non_json_fields():
+    from dataclasses import dataclass
+
+    from emerge.core import serialize
+    from emerge.core.objects import EmergeFile
+
+    @dataclass
+    class Blob(EmergeFile):
+        size: int = 0
+        data: bytes = b""
+
+    obj = Blob(id="b1", name="b1", path="/blobs", uuid="u1", size=3, data=b"abc")
+    meta = serialize.meta(obj, "source")
+
+    assert meta["class"] == "Blob"
+    assert meta["uuid"] == "u1"
+    assert meta["source"] == "source"
+    assert meta["fields"]["size"] == 3
+    assert "data" not in meta["fields"]
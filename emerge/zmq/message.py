@@ -28,8 +28,7 @@ def extract_msg_id_from_topic_msg_key(topic_msg_key):
 
 def write_msg(topic, msg_id, msg, ttl=180):
     msg_key = get_topic_msg_key(topic, msg_id)
-    redis_connection.set(msg_key, msg)
-    redis_connection.expire(msg_key, ttl)
+    redis_connection.set(msg_key, msg, ex=ttl)
 
 
 def get_msg(topic, msg_id):
@@ -44,16 +43,36 @@ def get_msg_by_key(topic_msg_key):
 
 def pop_msg(topic, msg_id):
     msg_key = get_topic_msg_key(topic, msg_id)
-    msg = redis_connection.get(msg_key)
-    redis_connection.delete(msg_key)
+    pipe = redis_connection.pipeline()
+    pipe.get(msg_key)
+    pipe.delete(msg_key)
+    msg, _ = pipe.execute()
     return msg
 
 
 def mark_msg_as_read(topic, msg_id, sub_id):
-    topic_msg_read_key = get_topic_msg_read_key(topic, msg_id, sub_id)
-    msg_key = get_topic_msg_key(topic, msg_id)
-    redis_connection.set(topic_msg_read_key, 1)
-    redis_connection.expire(topic_msg_read_key, redis_connection.ttl(msg_key))
+    mark_msgs_as_read(topic, [msg_id], sub_id)
+
+
+def mark_msgs_as_read(topic, msg_ids, sub_id):
+    """Mark messages as read by sub_id in two round trips however many there are
+
+    A read marker expires with its message, messages that are already gone don't
+    get one.
+    """
+    if not msg_ids:
+        return
+
+    pipe = redis_connection.pipeline(transaction=False)
+    for msg_id in msg_ids:
+        pipe.pttl(get_topic_msg_key(topic, msg_id))
+    ttls = pipe.execute()
+
+    pipe = redis_connection.pipeline(transaction=False)
+    for msg_id, ttl in zip(msg_ids, ttls):
+        if ttl > 0:
+            pipe.set(get_topic_msg_read_key(topic, msg_id, sub_id), 1, px=ttl)
+    pipe.execute()
 
 
 def is_msg_read(topic, msg_id, sub_id):
@@ -61,6 +80,26 @@ def is_msg_read(topic, msg_id, sub_id):
     return redis_connection.get(topic_msg_read_key) is not None
 
 
-def get_msgs_for_topic(topic):
+def get_msgs_with_read_state(topic, msg_ids, sub_id):
+    """Return (msg_id, is_read, msg) for every message with one MGET"""
+    if not msg_ids:
+        return []
+
+    keys = []
+    for msg_id in msg_ids:
+        keys += [
+            get_topic_msg_read_key(topic, msg_id, sub_id),
+            get_topic_msg_key(topic, msg_id),
+        ]
+
+    values = redis_connection.mget(keys)
+
+    return [
+        (msg_id, values[2 * i] is not None, values[2 * i + 1])
+        for i, msg_id in enumerate(msg_ids)
+    ]
+
+
+def get_msgs_for_topic(topic, count=100):
     topic_key_pattern = get_topic_key_pattern(topic)
-    yield from redis_connection.scan_iter(match=topic_key_pattern, count=100)
+    yield from redis_connection.scan_iter(match=topic_key_pattern, count=count)
@@ -7,5 +7,7 @@ def get_msg(topic, msg_id): ...
 def get_msg_by_key(topic_msg_key): ...
 def pop_msg(topic, msg_id): ...
 def mark_msg_as_read(topic, msg_id, sub_id) -> None: ...
+def mark_msgs_as_read(topic, msg_ids, sub_id) -> None: ...
 def is_msg_read(topic, msg_id, sub_id): ...
-def get_msgs_for_topic(topic) -> None: ...
+def get_msgs_with_read_state(topic, msg_ids, sub_id): ...
+def get_msgs_for_topic(topic, count: int = ...) -> None: ...
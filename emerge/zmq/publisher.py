@@ -2,7 +2,9 @@ import uuid
 
 import zmq
 
+import emerge.zmq.settings as settings
 from emerge.zmq.message import write_msg
+from emerge.zmq.streams import add_msg
 
 pub = None
 
@@ -17,8 +19,11 @@ def connect(host="*", port=5555):
 
 
 def publish(topic, msg):
-    msg_id = str(uuid.uuid4())
-    write_msg(topic, msg_id, msg)
+    if settings.MSG_BACKEND == "streams":
+        msg_id = add_msg(topic, msg)
+    else:
+        msg_id = str(uuid.uuid4())
+        write_msg(topic, msg_id, msg)
 
     pub.send_string("{} {}".format(topic, msg_id))
 
@@ -1,2 +1,8 @@
 GLOBAL_TOPICS = ["GLOBAL", "GENERAL"]
 REDIS_CONF = {"REDIS_HOST": "127.0.0.1", "REDIS_PORT": 6379, "REDIS_DB": 0}
+# Messages fetched and acknowledged per round trip when catching up
+MSG_BATCH = 500
+# Where published messages are kept, "keys" for a key per message or "streams"
+MSG_BACKEND = "keys"
+# Messages kept per topic stream, trimmed approximately
+STREAM_MAXLEN = 10000
@@ -0,0 +1,65 @@
+""" Keep a topic's messages in a Redis stream read through consumer groups """
+import redis
+
+import emerge.zmq.settings as settings
+from emerge.zmq.connection import redis_connection
+
+
+def get_topic_stream_key(topic, delimiter=":"):
+    key = "TOPIC{delimiter}{topic}{delimiter}STREAM".format(
+        topic=topic, delimiter=delimiter
+    )
+    return key
+
+
+def add_msg(topic, msg, maxlen=None):
+    """Append a message to the topic's stream and return its id
+
+    The stream is trimmed to about maxlen messages, the oldest are dropped first.
+    """
+    msg_id = redis_connection.xadd(
+        get_topic_stream_key(topic),
+        {"msg": msg},
+        maxlen=maxlen or settings.STREAM_MAXLEN,
+        approximate=True,
+    )
+    return msg_id.decode()
+
+
+def create_group(topic, sub_id):
+    """Give sub_id its own offset in the topic, starting from the oldest message"""
+    try:
+        redis_connection.xgroup_create(
+            get_topic_stream_key(topic), sub_id, id="0", mkstream=True
+        )
+    except redis.ResponseError as ex:
+        if "BUSYGROUP" not in str(ex):
+            raise
+
+
+def read_msgs(topic, sub_id, pending=False, count=100):
+    """Return up to count (msg_id, msg) of the topic that sub_id hasn't read
+
+    With pending, the messages delivered to sub_id before that were never
+    acknowledged are returned instead.
+    """
+    streams = redis_connection.xreadgroup(
+        sub_id,
+        sub_id,
+        {get_topic_stream_key(topic): "0" if pending else ">"},
+        count=count,
+    )
+
+    return [
+        # A pending message trimmed off the stream comes back without fields
+        (msg_id.decode(), (fields or {}).get(b"msg"))
+        for _, entries in streams
+        for msg_id, fields in entries
+    ]
+
+
+def ack_msgs(topic, sub_id, msg_ids):
+    """Move sub_id's offset past messages it has processed"""
+    if not msg_ids:
+        return 0
+    return redis_connection.xack(get_topic_stream_key(topic), sub_id, *msg_ids)
@@ -0,0 +1,5 @@
+def get_topic_stream_key(topic, delimiter: str = ...): ...
+def add_msg(topic, msg, maxlen: int | None = ...): ...
+def create_group(topic, sub_id) -> None: ...
+def read_msgs(topic, sub_id, pending: bool = ..., count: int = ...): ...
+def ack_msgs(topic, sub_id, msg_ids): ...
@@ -3,11 +3,11 @@ import zmq
 import emerge.zmq.settings as settings
 from emerge.zmq.message import (
     extract_msg_id_from_topic_msg_key,
-    get_msg,
     get_msgs_for_topic,
-    is_msg_read,
-    mark_msg_as_read,
+    get_msgs_with_read_state,
+    mark_msgs_as_read,
 )
+from emerge.zmq.streams import ack_msgs, create_group, read_msgs
 
 sub_id = None
 
@@ -16,24 +16,74 @@ def process_raw_msg(topic, msg):
     print("Received on topic {}: {}".format(topic, msg))
 
 
-def fetch_and_process_msg(topic, msg_id):
+def fetch_and_process_msgs(topic, msg_ids):
+    """Process the unread messages of a batch, then acknowledge them together"""
     global sub_id
-    if not is_msg_read(topic, msg_id, sub_id):
-        msg = get_msg(topic, msg_id)
-        if msg is not None:
+    processed = []
+    for msg_id, is_read, msg in get_msgs_with_read_state(topic, msg_ids, sub_id):
+        if is_read:
+            print("Message has already been read!")
+        elif msg is not None:
             process_raw_msg(topic, msg)
-            mark_msg_as_read(topic, msg_id, sub_id)
-    else:
-        print("Message has already been read!")
+            processed.append(msg_id)
+    mark_msgs_as_read(topic, processed, sub_id)
+
+
+def fetch_and_process_msg(topic, msg_id):
+    fetch_and_process_msgs(topic, [msg_id])
 
 
 def process_pending_msgs(*topics):
     for topic in topics:
-        for topic_msg_key in get_msgs_for_topic(topic):
-            topic_msg_key = topic_msg_key.decode()
-            msg_id = extract_msg_id_from_topic_msg_key(topic_msg_key)
-            print("Pending message found on topic {}".format(topic))
-            fetch_and_process_msg(topic, msg_id)
+        msg_ids = []
+        for topic_msg_key in get_msgs_for_topic(topic, count=settings.MSG_BATCH):
+            msg_ids.append(extract_msg_id_from_topic_msg_key(topic_msg_key.decode()))
+            if len(msg_ids) == settings.MSG_BATCH:
+                print(
+                    "{} pending messages found on topic {}".format(len(msg_ids), topic)
+                )
+                fetch_and_process_msgs(topic, msg_ids)
+                msg_ids = []
+        if msg_ids:
+            print("{} pending messages found on topic {}".format(len(msg_ids), topic))
+            fetch_and_process_msgs(topic, msg_ids)
+
+
+def process_stream_msgs(topic, pending=False):
+    """Process the topic's stream from this subscriber's offset to its end
+
+    With pending, first process again what was delivered but not acknowledged
+    before the subscriber stopped.
+    """
+    global sub_id
+    while True:
+        msgs = read_msgs(topic, sub_id, pending=pending, count=settings.MSG_BATCH)
+        if not msgs:
+            if not pending:
+                return
+            pending = False
+            continue
+        for msg_id, msg in msgs:
+            if msg is not None:
+                process_raw_msg(topic, msg)
+        ack_msgs(topic, sub_id, [msg_id for msg_id, _ in msgs])
+
+
+def process_pending_stream_msgs(*topics):
+    for topic in topics:
+        create_group(topic, sub_id)
+        process_stream_msgs(topic, pending=True)
+
+
+def receive_msgs(sub):
+    """Wait for a message, then take whatever else has already arrived"""
+    topic_msgs = [sub.recv().decode()]
+    while len(topic_msgs) < settings.MSG_BATCH:
+        try:
+            topic_msgs.append(sub.recv(zmq.NOBLOCK).decode())
+        except zmq.Again:
+            break
+    return topic_msgs
 
 
 def subscribe(port, topics=[]):
@@ -49,14 +99,30 @@ def subscribe(port, topics=[]):
     for topic in topics:
         sub.setsockopt(zmq.SUBSCRIBE, topic.encode())
 
-    process_pending_msgs(*topics)
+    streams = settings.MSG_BACKEND == "streams"
+
+    if streams:
+        process_pending_stream_msgs(*topics)
+    else:
+        process_pending_msgs(*topics)
 
     while True:
-        topic_msg = sub.recv().decode()
-        print("New message: ", topic_msg)
-        for_topic = topic_msg[: topic_msg.find(" ")]
-        msg_id = topic_msg[topic_msg.find(" ") + 1 :]
-        fetch_and_process_msg(for_topic, msg_id)
+        if streams:
+            # Notifications only say there is something new, the stream has it in order
+            for for_topic in {
+                topic_msg[: topic_msg.find(" ")] for topic_msg in receive_msgs(sub)
+            }:
+                process_stream_msgs(for_topic)
+            continue
+
+        msg_ids = {}
+        for topic_msg in receive_msgs(sub):
+            print("New message: ", topic_msg)
+            for_topic = topic_msg[: topic_msg.find(" ")]
+            msg_id = topic_msg[topic_msg.find(" ") + 1 :]
+            msg_ids.setdefault(for_topic, []).append(msg_id)
+        for for_topic, ids in msg_ids.items():
+            fetch_and_process_msgs(for_topic, ids)
 
 
 if __name__ == "__main__":